@@ -11,13 +11,39 @@ CROP_MODE = True
 MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
+SCHEDULER_RESERVED_SLOTS = 8 # run_dpsk_ocr_server.py: engine slots kept free of bulk work for interactive requests
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
 PRINT_NUM_VIS_TOKENS = False
+PIXEL_DTYPE = 'float32' # preprocessed pixels held on the host until the encoder runs: 'float32', 'bfloat16' (half the memory), 'uint8' (a quarter, normalized on the GPU)
+MM_PREPROCESSOR_CACHE = False # vLLM's multimodal preprocessor cache (process/mm_cache.py): repeated pages skip re-processing; opt-in until tests/test_mm_cache.py passes with vllm installed (README); size: VLLM_MM_INPUT_CACHE_GIB (default 4), pinned with PIN_PIXELS
+PIN_PIXELS = False # page-lock the pixel tensors so the host-to-device copy can run asynchronously (pinned memory cannot be swapped)
+ENCODER_COMPILE = '' # torch.compile the vision encoder with static, bucketed shapes (deepencoder/compiled.py): '' off, 'default', 'reduce-overhead' (CUDA graphs), 'max-autotune'
+ENCODER_COMPILE_BUCKETS = (1, 2, 4, 6, 9) # crop batch sizes the local views are zero-padded to, one compiled graph each
+PROFILE_ENCODER = 0 # write torch profiler Chrome traces of this many vision encoder calls (deepencoder/profiling.py), 0: off
+PROFILE_ENCODER_SKIP = 2 # encoder calls to let pass before tracing (vLLM's dummy profiling run, warm-up)
+PROFILE_ENCODER_EVERY = 1 # then trace every n-th call
+PROFILE_DIR = '' # trace dir, '': OUTPUT_PATH/encoder_traces
+METRICS = True # in-process counters / histograms (preprocess time, tiles, vision tokens, SAM / CLIP / projector time, repeated pages): OUTPUT_PATH/metrics.json, server /metrics
 SKIP_REPEAT = True
+SAVE_LAYOUT_PDF = True # run_dpsk_ocr_pdf.py: write <name>_layouts.pdf; False skips it (render it later: python -m process.layout_pdf <pdf> <name>_det.mmd)
+FIGURE_FORMAT = 'jpg' # figure crops: 'jpg', 'png' (lossless) or 'webp'
+FIGURE_QUALITY = 95 # jpg / webp quality; webp with 100 is lossless
+FIGURE_DEDUP = True # write identical figure crops of a document once
+FIGURE_WORKERS = 8 # figure crop / encode / write threads, bounds concurrent figure I/O
+STRUCTURED_OUTPUT = 'jsonl' # per-page blocks (label, boxes, text, page size) as JSON lines next to the .mmd; 'jsonl.gz' to compress, '' to skip
+COLUMNAR_OUTPUT = '' # run_dpsk_ocr_eval_batch.py: 'arrow' or 'parquet' collects results as rows of OUTPUT_PATH/results.<part>.arrows|.parquet instead of two .md files per image (needs pyarrow)
+CHECKPOINT = True # journal every finished page to OUTPUT_PATH/journal.jsonl (pdf / eval runners)
+RESUME = True # skip pages and documents already finished in the journal of a previous run
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
+ENGINE = 'vllm' # 'vllm', or 'stub': replay canned outputs on CPU (pipeline benchmarks / tests without a GPU)
+STUB_TOKENS_PER_SEC = 2500 # aggregate decode rate of the stub engine, 0: as fast as possible
+STUB_OUTPUTS = '' # dir of recorded raw outputs (.mmd / _det.md) for the stub engine to replay; empty: built-in sample page
+SERVER_HOST = '0.0.0.0' # run_dpsk_ocr_server.py
+SERVER_PORT = 8000
 
 # TODO: change INPUT_PATH
 # .pdf: run_dpsk_ocr_pdf.py; 
+# dir of .pdf / .txt manifest (one pdf path per line): run_dpsk_ocr_pdf.py, outputs go to OUTPUT_PATH/<pdf name>/
 # .jpg, .png, .jpeg: run_dpsk_ocr_image.py; 
 # Omnidocbench images path: run_dpsk_ocr_eval_batch.py
 
@@ -6,7 +6,11 @@ from easydict import EasyDict as adict
 import torch
 from torch.nn import functional as F
 from torch import nn
-from flash_attn import flash_attn_qkvpacked_func, flash_attn_func
+try:
+    from flash_attn import flash_attn_qkvpacked_func, flash_attn_func
+except ImportError:
+    # only needed with use_flash_attn=True; the default sdpa path runs without it (e.g. on CPU)
+    flash_attn_qkvpacked_func = flash_attn_func = None
 # from optimus import flash_attn_func
 # from megatron.core import tensor_parallel
 # from megatron.core import parallel_state as mpu
@@ -129,7 +133,8 @@ class CLIPVisionEmbeddings(nn.Module):
         )
 
     def forward(self, pixel_values, patch_embeds):
-        batch_size = pixel_values.shape[0]
+        # pixel_values may be None when the patch embeddings come from SAM
+        batch_size = (patch_embeds if patch_embeds is not None else pixel_values).shape[0]
         # patch_embeds = self.patch_embedding(
         #     pixel_values
         # )  # shape = [*, width, grid, grid]
@@ -232,6 +237,8 @@ class NoTPAttention(torch.nn.Module):
         self.head_dim = cfg.hidden_size // cfg.num_attention_heads
         self.max_seq_len = cfg.seq_length
         self.use_flash_attention = cfg.use_flash_attn
+        if self.use_flash_attention and flash_attn_qkvpacked_func is None:
+            raise ImportError('use_flash_attn=True needs flash_attn: pip install flash-attn')
 
         self.qkv_proj = torch.nn.Linear(cfg.hidden_size, cfg.hidden_size * 3, bias=True)
         self.out_proj = torch.nn.Linear(cfg.hidden_size, cfg.hidden_size, bias=True)
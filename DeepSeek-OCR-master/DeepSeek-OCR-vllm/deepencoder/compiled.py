@@ -0,0 +1,175 @@
+"""
+torch.compile for the vision encoder with static shapes (ENCODER_COMPILE in config.py).
+
+The number of local crops changes from page to page (MIN_CROPS..MAX_CROPS), and every
+new batch size would be another compile. Crops are zero-padded up to the next bucket
+(1, 2, 4, 6 or 9 by default) instead, so the encoder only ever sees the global view
+([1, 3, BASE_SIZE, BASE_SIZE]) and one shape per bucket. The padded rows are dropped
+from the output. With mode='reduce-overhead' each shape is captured as a CUDA graph.
+
+Every image in SAM, CLIP-L and the projector is processed independently, so padding
+does not change the real rows; parity() checks this against eager mode.
+
+    python -m deepencoder.compiled --device cpu    # bucketing, hit rate and parity with inductor on CPU
+"""
+import torch
+
+from deepencoder.stages import EncoderStages
+
+CROP_BUCKETS = (1, 2, 4, 6, 9)
+
+
+def bucket_for(num_images, buckets=CROP_BUCKETS):
+    """smallest bucket that holds num_images, the largest one for chunks"""
+    for bucket in buckets:
+        if num_images <= bucket:
+            return bucket
+    return buckets[-1]
+
+
+def split_batches(num_images, buckets=CROP_BUCKETS):
+    """(start, end) chunks of at most the largest bucket"""
+    chunks = []
+    start = 0
+    while num_images - start > buckets[-1]:
+        chunks.append((start, start + buckets[-1]))
+        start += buckets[-1]
+    chunks.append((start, num_images))
+    return chunks
+
+
+def _raise_recompile_limit(num_shapes):
+    # dynamo keeps a bounded number of graphs per function (8 by default); one per
+    # bucket plus the global view must fit, or the last buckets would fall back to eager
+    config = torch._dynamo.config
+    name = 'recompile_limit' if hasattr(config, 'recompile_limit') else 'cache_size_limit'
+    setattr(config, name, max(getattr(config, name), num_shapes))
+
+
+class CompiledEncoder(EncoderStages):
+    """
+    encoder(images) == encoder.encode_view(images) for a batch of global views or crops,
+    through one compiled graph per padded shape.
+    """
+
+    def __init__(self, sam_model, vision_model, projector, buckets=CROP_BUCKETS, mode=None, backend='inductor'):
+        self.sam_model = sam_model
+        self.vision_model = vision_model
+        self.projector = projector
+        self.buckets = tuple(sorted(buckets))
+        self.mode = mode
+        self.cudagraphs = mode is not None and 'reduce-overhead' in mode
+        # two image sizes (global view, crops), a few dtypes / devices at most
+        _raise_recompile_limit(2 * (len(self.buckets) + 1))
+        self.compiled = torch.compile(self.encode_view, mode=mode, backend=backend, dynamic=False)
+        self.shapes = set()
+        self.hits = 0
+        self.misses = 0
+        self.num_images = 0
+        self.num_padded = 0
+
+    def _run(self, images):
+        key = (tuple(images.shape), images.dtype, images.device)
+        if key in self.shapes:
+            self.hits += 1
+        else:
+            # first call of a shape: dynamo traces and compiles it
+            self.misses += 1
+            self.shapes.add(key)
+        if self.cudagraphs:
+            torch.compiler.cudagraph_mark_step_begin()
+            # the graph's output buffers are reused by the next replay
+            return self.compiled(images).clone()
+        return self.compiled(images)
+
+    def __call__(self, images):
+        outputs = []
+        for start, end in split_batches(images.size(0), self.buckets):
+            chunk = images[start:end]
+            num_real = end - start
+            bucket = bucket_for(num_real, self.buckets)
+            if bucket > num_real:
+                chunk = torch.cat([chunk, chunk.new_zeros((bucket - num_real,) + tuple(chunk.shape[1:]))])
+            self.num_images += num_real
+            self.num_padded += bucket - num_real
+            outputs.append(self._run(chunk)[:num_real])
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs)
+
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else None
+
+    def stats(self):
+        return {
+            'graphs': len(self.shapes),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+            'padded_fraction': self.num_padded / (self.num_images + self.num_padded) if self.num_images else None,
+        }
+
+    @torch.no_grad()
+    def parity(self, images):
+        """compiled (padded) vs eager (unpadded) on the same images"""
+        eager = self.encode_view(images).float()
+        compiled = self(images).float()
+        cosine = torch.nn.functional.cosine_similarity(eager.flatten(1), compiled.flatten(1), dim=-1)
+        return {
+            'max_abs_diff': (eager - compiled).abs().max().item(),
+            'max_abs': eager.abs().max().item(),
+            'min_cosine': cosine.min().item(),
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from addict import Dict
+    from easydict import EasyDict as adict
+
+    from deepencoder.sam_vary_sdpa import ImageEncoderViT, build_sam_vit_b
+    from deepencoder.clip_sdpa import VitModel, build_clip_l, vit_model_cfg
+    from deepencoder.build_linear import MlpProjector
+
+    parser = argparse.ArgumentParser(description='compiled encoder: bucketing, cache hit rate and eager parity')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--mode', default=None, help="torch.compile mode, e.g. 'reduce-overhead' (CUDA graphs)")
+    parser.add_argument('--full', action='store_true', help='the real SAM-B / CLIP-L at 1024 / 640 instead of a 2-layer model at 256 / 160')
+    parser.add_argument('--crops', default='0,3,6,2,4,9,5,1,6,3,12', help='crops per page of the simulated request stream')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+    if args.full:
+        base_size, image_size = 1024, 640
+        sam_model = build_sam_vit_b()
+        vision_model = build_clip_l()
+    else:
+        # same architecture, shallow and small, so inductor compiles each shape on CPU in well under a minute
+        base_size, image_size = 256, 160
+        sam_model = ImageEncoderViT(depth=2, embed_dim=768, img_size=base_size, mlp_ratio=4,
+                                    norm_layer=torch.nn.LayerNorm, num_heads=12, patch_size=16, qkv_bias=True,
+                                    use_rel_pos=True, global_attn_indexes=[1], window_size=14, out_chans=256)
+        vision_model = VitModel(cfg=adict(vit_model_cfg, num_layers=2))
+    projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=1280))
+    for module in (sam_model, vision_model, projector):
+        module.to(device, dtype).eval()
+
+    encoder = CompiledEncoder(sam_model, vision_model, projector, mode=args.mode)
+    worst = {'max_abs_diff': 0.0, 'min_cosine': 1.0}
+    with torch.no_grad():
+        for num_crops in [int(n) for n in args.crops.split(',')]:
+            views = [torch.randn(1, 3, base_size, base_size, device=device, dtype=dtype)]
+            if num_crops:
+                views.append(torch.randn(num_crops, 3, image_size, image_size, device=device, dtype=dtype))
+            start = time.perf_counter()
+            for images in views:
+                result = encoder.parity(images)
+                worst['max_abs_diff'] = max(worst['max_abs_diff'], result['max_abs_diff'])
+                worst['min_cosine'] = min(worst['min_cosine'], result['min_cosine'])
+            print(f'{num_crops:>3} crops -> buckets {[bucket_for(end - start_, encoder.buckets) for start_, end in split_batches(num_crops)] if num_crops else []}'
+                  f', {(time.perf_counter() - start) * 1000:.0f} ms, max abs diff {result["max_abs_diff"]:.2e}')
+
+    print(encoder.stats())
+    print(f'parity: max abs diff {worst["max_abs_diff"]:.2e}, min cosine {worst["min_cosine"]:.6f}')
@@ -0,0 +1,195 @@
+"""
+Opt-in torch.profiler traces of the vision encoder (PROFILE_ENCODER in config.py).
+
+While a trace is recording, every SAM block (marked global or window attention), every
+CLIP-L layer, their attention / MLP halves, the necks and the projector are wrapped in a
+record_function range through forward hooks, so the model code is unchanged and the hooks
+cost nothing outside of a trace. Each sampled encoder call writes a Chrome trace
+(chrome://tracing, ui.perfetto.dev) plus a key_averages table:
+
+    <trace dir>/encoder-000-1024x640-tiles3x2.json
+    <trace dir>/encoder-000-1024x640-tiles3x2.txt
+
+Standalone on random weights, on CPU or GPU, without vLLM or a checkpoint:
+
+    python -m deepencoder.profiling --mode gundam --tiles 2x3 --device cpu
+"""
+import os
+from contextlib import contextmanager, nullcontext
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+from deepencoder.stages import encode_view
+
+
+def block_ranges(sam_model=None, vision_model=None, projector=None):
+    """(range name, module) for everything worth a range in the encoder"""
+    ranges = []
+    if sam_model is not None:
+        ranges.append(('sam', sam_model))
+        ranges.append(('sam.patch_embed', sam_model.patch_embed))
+        for idx, block in enumerate(sam_model.blocks):
+            name = f'sam.block{idx:02d}.{"global" if block.window_size == 0 else "window"}'
+            ranges.append((name, block))
+            ranges.append((name + '.attn', block.attn))
+            ranges.append((name + '.mlp', block.mlp))
+        ranges.append(('sam.neck', sam_model.neck))
+        ranges.append(('sam.net_2', sam_model.net_2))
+        ranges.append(('sam.net_3', sam_model.net_3))
+    if vision_model is not None:
+        ranges.append(('clip', vision_model))
+        ranges.append(('clip.embeddings', vision_model.embeddings))
+        for idx, layer in enumerate(vision_model.transformer.layers):
+            name = f'clip.layer{idx:02d}'
+            ranges.append((name, layer))
+            ranges.append((name + '.attn', layer.self_attn))
+            ranges.append((name + '.mlp', layer.mlp))
+    if projector is not None:
+        ranges.append(('projector', projector))
+    return ranges
+
+
+def attach_ranges(ranges):
+    """wraps each module's forward in record_function(name); returns the hook handles"""
+    handles = []
+    for name, module in ranges:
+        stack = []
+
+        def enter(module, inputs, name=name, stack=stack):
+            context = record_function(name)
+            context.__enter__()
+            stack.append(context)
+
+        def exit(module, inputs, output, stack=stack):
+            if stack:
+                stack.pop().__exit__(None, None, None)
+
+        handles.append(module.register_forward_pre_hook(enter))
+        handles.append(module.register_forward_hook(exit))
+    return handles
+
+
+class EncoderProfiler:
+    """
+    Traces num_traces encoder calls: after `skip` calls (vLLM's dummy profiling run and
+    warm-up), every `every`-th call is traced until num_traces traces are written.
+
+        with profiler.trace(tag):
+            features = encode(images)
+    """
+
+    def __init__(self, ranges, num_traces, trace_dir, skip=0, every=1, record_shapes=True):
+        self.ranges = ranges
+        self.num_traces = num_traces
+        self.trace_dir = trace_dir
+        self.skip = skip
+        self.every = max(every, 1)
+        self.record_shapes = record_shapes
+        self.num_calls = 0
+        self.num_written = 0
+
+    def sampled(self):
+        idx = self.num_calls - self.skip
+        return self.num_written < self.num_traces and idx >= 0 and idx % self.every == 0
+
+    @contextmanager
+    def trace(self, tag=''):
+        """tag: string or callable, only evaluated for sampled calls"""
+        sampled = self.sampled()
+        self.num_calls += 1
+        if not sampled:
+            yield
+            return
+        if callable(tag):
+            tag = tag()
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        handles = attach_ranges(self.ranges)
+        try:
+            with profile(activities=activities, record_shapes=self.record_shapes) as prof:
+                with record_function(f'encoder {tag}'.strip()):
+                    yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        os.makedirs(self.trace_dir, exist_ok=True)
+        name = f'encoder-{self.num_written:03d}' + (f'-{tag}' if tag else '')
+        path = os.path.join(self.trace_dir, name + '.json')
+        prof.export_chrome_trace(path)
+        sort_by = 'cuda_time_total' if ProfilerActivity.CUDA in activities else 'cpu_time_total'
+        with open(os.path.join(self.trace_dir, name + '.txt'), 'w', encoding='utf-8') as afile:
+            afile.write(prof.key_averages().table(sort_by=sort_by, row_limit=80))
+        self.num_written += 1
+        print(f'encoder trace: {path}')
+
+
+def maybe_trace(profiler, tag=''):
+    return profiler.trace(tag) if profiler is not None else nullcontext()
+
+
+MODES = {
+    # name: (base_size, image_size, crop_mode), as in config.py
+    'tiny': (512, 512, False),
+    'small': (640, 640, False),
+    'base': (1024, 1024, False),
+    'large': (1280, 1280, False),
+    'gundam': (1024, 640, True),
+}
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    from addict import Dict
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from deepencoder.sam_vary_sdpa import build_sam_vit_b
+    from deepencoder.clip_sdpa import build_clip_l
+    from deepencoder.build_linear import MlpProjector
+
+    parser = argparse.ArgumentParser(description='profile the vision encoder on random weights')
+    parser.add_argument('--mode', choices=list(MODES), default='gundam')
+    parser.add_argument('--tiles', default='2x3', help='local tiles (width x height) in crop mode; an A4 page at 144 dpi gets 2x3')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dtype', choices=['bfloat16', 'float32'], default='bfloat16')
+    parser.add_argument('--traces', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--out', default='encoder_traces')
+    args = parser.parse_args()
+
+    base_size, image_size, crop_mode = MODES[args.mode]
+    num_tiles = tuple(int(n) for n in args.tiles.split('x')) if crop_mode else (1, 1)
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    sam_model = build_sam_vit_b().to(device, dtype).eval()
+    vision_model = build_clip_l().to(device, dtype).eval()
+    projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=1280)).to(device, dtype).eval()
+
+    global_view = torch.randn(1, 3, base_size, base_size, device=device, dtype=dtype)
+    tiles = None
+    if num_tiles[0] * num_tiles[1] > 1:
+        tiles = torch.randn(num_tiles[0] * num_tiles[1], 3, image_size, image_size, device=device, dtype=dtype)
+
+    def encode():
+        if tiles is not None:
+            encode_view(sam_model, vision_model, projector, tiles)
+        encode_view(sam_model, vision_model, projector, global_view)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    profiler = EncoderProfiler(block_ranges(sam_model, vision_model, projector), args.traces, args.out, skip=args.warmup)
+    tag = f'{base_size}x{image_size}-tiles{num_tiles[0]}x{num_tiles[1]}'
+    with torch.no_grad():
+        for _ in range(args.warmup + args.traces):
+            start = time.perf_counter()
+            with profiler.trace(tag):
+                encode()
+            print(f'{tag}: {(time.perf_counter() - start) * 1000:.1f} ms')
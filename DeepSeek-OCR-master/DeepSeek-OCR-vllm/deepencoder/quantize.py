@@ -0,0 +1,210 @@
+"""
+int8 quantization of the vision encoder's nn.Linear layers (SAM's qkv / proj / MLP,
+CLIP-L's qkv_proj / out_proj / fc1 / fc2 and the projector), for encoding on CPU nodes.
+
+    'dynamic'  torch.ao quantize_dynamic: int8 weights, activations quantized per call,
+               int8 GEMMs (fbgemm / onednn). CPU only, on a float32 encoder.
+    'weight'   int8 weights with one scale per output channel: 4x smaller than float32,
+               any device and dtype, but not faster. Only storage shrinks: every call
+               dequantizes the weight to the input dtype and runs the float GEMM.
+               torch's int8 weight-only kernel (aten._weight_int8pack_mm) is built for
+               a few rows at a time (decoding); at the encoder's 100-4096 rows per view
+               it measured 3x (bfloat16) to 50x (float32) slower on CPU than dequantizing.
+
+Convolutions (SAM's patch embedding and neck), the norms and attention itself stay in
+floating point. Accuracy is checked as the cosine similarity of the projected features
+against the unquantized encoder, on real pages with the checkpoint's weights:
+
+    python -m deepencoder.quantize --weights /path/to/DeepSeek-OCR --pages /data/pages --modes tiny,base,gundam
+"""
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+SCHEMES = ('dynamic', 'weight')
+
+
+class Int8WeightLinear(nn.Module):
+    """nn.Linear with a symmetric per-output-channel int8 weight"""
+
+    def __init__(self, weight_int8, scale, bias=None):
+        super().__init__()
+        self.in_features = weight_int8.size(1)
+        self.out_features = weight_int8.size(0)
+        self.register_buffer('weight_int8', weight_int8)
+        self.register_buffer('scale', scale)
+        self.bias = nn.Parameter(bias, requires_grad=False) if bias is not None else None
+
+    @classmethod
+    def from_linear(cls, linear):
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        weight_int8 = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(weight_int8, scale.to(linear.weight.dtype), bias)
+
+    def forward(self, x):
+        # x @ (q * s).T == (x @ q.T) * s, so the scale is applied to the output. The int8
+        # weight is converted whole on every call (N * K work next to the M * N * K GEMM,
+        # and a transient float copy of the weight), see the module docstring
+        output = F.linear(x, self.weight_int8.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            output = output + self.bias.to(x.dtype)
+        return output
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}'
+
+
+def _replace_linears(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int8WeightLinear.from_linear(child))
+        else:
+            _replace_linears(child)
+    return module
+
+
+def quantize_linears(module, scheme='dynamic'):
+    """quantizes module's nn.Linear layers in place and returns it"""
+    if scheme == 'dynamic':
+        from torch.ao.quantization import quantize_dynamic
+
+        if next(module.parameters()).dtype != torch.float32:
+            raise ValueError("scheme='dynamic' needs a float32 module, use scheme='weight' for bfloat16")
+        return quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if scheme == 'weight':
+        return _replace_linears(module)
+    raise ValueError(f'scheme must be one of {SCHEMES}, got {scheme!r}')
+
+
+def quantize_encoder(encoder, scheme='dynamic'):
+    """a quantized copy of an EncoderStages module (e.g. DeepEncoder); encoder is unchanged"""
+    encoder = copy.deepcopy(encoder)
+    for module in (encoder.sam_model, encoder.vision_model, encoder.projector):
+        quantize_linears(module, scheme)
+    return encoder
+
+
+def linear_bytes(module):
+    """bytes of the weights in module's (quantized) linear layers"""
+    total = 0
+    for child in module.modules():
+        if isinstance(child, Int8WeightLinear):
+            total += child.weight_int8.numel() + child.scale.numel() * child.scale.element_size()
+        elif isinstance(child, nn.Linear):
+            total += child.weight.numel() * child.weight.element_size()
+        elif callable(getattr(child, 'weight', None)):
+            # torch.ao dynamic quantized Linear: weight() unpacks the int8 weight
+            total += child.weight().numel()
+    return total
+
+
+@torch.no_grad()
+def embedding_similarity(reference, quantized, images):
+    """cosine similarity of the projected features, per image token, against the reference"""
+    expected = reference.encode_view(images).float()
+    actual = quantized.encode_view(images).float()
+    cosine = F.cosine_similarity(expected, actual, dim=-1)
+    return {
+        'min_cosine': cosine.min().item(),
+        'mean_cosine': cosine.mean().item(),
+        'max_abs_diff': (expected - actual).abs().max().item(),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import io
+    import os
+    import time
+
+    import fitz
+    from PIL import Image
+
+    from deepencoder.profiling import MODES
+    from deepencoder.stages import DeepEncoder
+    from process.image_process import DeepseekOCRProcessor, normalize_pixels
+
+    def load_pages(path, max_pages, dpi=144):
+        """page images of a .pdf / image or a directory of them, rasterized like run_dpsk_ocr_pdf.py"""
+        paths = sorted(os.path.join(path, name) for name in os.listdir(path)) if os.path.isdir(path) else [path]
+        pages = []
+        for page_path in paths:
+            if page_path.lower().endswith('.pdf'):
+                with fitz.open(page_path) as pdf_document:
+                    for page in pdf_document:
+                        pixmap = page.get_pixmap(matrix=fitz.Matrix(dpi / 72.0, dpi / 72.0), alpha=False)
+                        pages.append(Image.open(io.BytesIO(pixmap.tobytes('png'))).convert('RGB'))
+            elif page_path.lower().endswith(('.jpg', '.jpeg', '.png')):
+                pages.append(Image.open(page_path).convert('RGB'))
+        return pages[:max_pages]
+
+    def page_views(pages, base_size, image_size, crop_mode):
+        """the global view and the local tiles of each page, as tokenize_with_images cuts them in this mode"""
+        processor = DeepseekOCRProcessor()
+        processor.base_size, processor.image_size = base_size, image_size
+        views = []
+        for page in pages:
+            _, pixel_values, images_crop, _, images_spatial_crop, _, _ = processor.tokenize_with_images(
+                images=[page], bos=True, eos=True, cropping=crop_mode)[0]
+            views.append(normalize_pixels(pixel_values, torch.float32))
+            if images_spatial_crop[0].prod() > 1:
+                views.append(normalize_pixels(images_crop[0], torch.float32))
+        return views
+
+    parser = argparse.ArgumentParser(description='int8 encoder on CPU: cosine similarity and throughput per mode')
+    parser.add_argument('--weights', default=None, help='checkpoint directory or repo id; random weights if not given')
+    parser.add_argument('--schemes', default='dynamic,weight')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--pages', default=None, help='.pdf / page images or a directory of them; random views if not given')
+    parser.add_argument('--max-pages', type=int, default=4)
+    parser.add_argument('--tiles', type=int, default=6, help='local tiles per page in crop mode, without --pages')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    reference = DeepEncoder.from_pretrained(args.weights) if args.weights else DeepEncoder()
+    reference = reference.float().eval()
+    encoders = {'float32': reference}
+    for scheme in args.schemes.split(','):
+        encoders[scheme] = quantize_encoder(reference, scheme).eval()
+
+    for name, encoder in encoders.items():
+        print(f'{name}: linear weights {linear_bytes(encoder) / 2 ** 20:.0f} MiB')
+
+    pages = load_pages(args.pages, args.max_pages) if args.pages else None
+
+    print(f'{"mode":<8} {"encoder":<8} {"images/s":>9} {"s/page":>7} {"min cos":>8} {"mean cos":>9}')
+    with torch.no_grad():
+        for mode in args.modes.split(','):
+            base_size, image_size, crop_mode = MODES[mode]
+            if pages:
+                views = page_views(pages, base_size, image_size, crop_mode)
+            else:
+                views = [torch.randn(1, 3, base_size, base_size)]
+                if crop_mode:
+                    views.append(torch.randn(args.tiles, 3, image_size, image_size))
+            num_images = sum(view.size(0) for view in views)
+            num_pages = len(pages) if pages else 1
+
+            for name, encoder in encoders.items():
+                for view in views:
+                    encoder.encode_view(view)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    for view in views:
+                        encoder.encode_view(view)
+                run_time = (time.perf_counter() - start) / args.repeat
+
+                line = f'{mode:<8} {name:<8} {num_images / run_time:>9.2f} {run_time / num_pages:>7.2f}'
+                if encoder is not reference:
+                    similarity = [embedding_similarity(reference, encoder, view) for view in views]
+                    line += (f' {min(s["min_cosine"] for s in similarity):>8.5f}'
+                             f' {sum(s["mean_cosine"] for s in similarity) / len(similarity):>9.5f}')
+                print(line)
@@ -0,0 +1,152 @@
+"""
+The vision encoder as three stages, so their outputs can be cached, batched or computed
+elsewhere independently:
+
+    sam_features = self.encode_sam(images)              # [n, 1024, h/64, w/64]
+    clip_features = self.encode_clip(sam_features)      # [n, 1 + h/64 * w/64, 1024]
+    features = self.project(sam_features, clip_features)  # [n, h/64 * w/64, 1280]
+    embeds = self.format_image_features(global_features, local_features, crop_shape)
+
+CLIP-L never sees the pixels: SAM's output replaces its patch embedding, so encode_clip
+only needs the SAM features (e.g. ones computed for an earlier request).
+
+DeepEncoder is the same encoder outside vLLM, loaded from the model checkpoint:
+
+    encoder = DeepEncoder.from_pretrained(MODEL_PATH).to('cuda', torch.bfloat16).eval()
+"""
+import glob
+import os
+
+import torch
+import torch.nn as nn
+
+
+def encode_sam(sam_model, images):
+    return sam_model(images)
+
+
+def encode_clip(vision_model, sam_features):
+    # CLIPVisionEmbeddings skips its own patch_embedding when given patch_embeds
+    return vision_model(None, sam_features)
+
+
+def project(projector, sam_features, clip_features):
+    # CLIP's class token is dropped, the rest lines up with SAM's 16x16 grid
+    features = torch.cat((clip_features[:, 1:], sam_features.flatten(2).permute(0, 2, 1)), dim=-1)
+    return projector(features)
+
+
+def encode_view(sam_model, vision_model, projector, images):
+    """SAM -> CLIP-L -> projector for one view (the global view or the local crops)"""
+    sam_features = encode_sam(sam_model, images)
+    return project(projector, sam_features, encode_clip(vision_model, sam_features))
+
+
+class EncoderStages:
+    """
+    Mixin for anything with sam_model, vision_model and projector attributes. It adds no
+    parameters or submodules, so checkpoint weight names are unchanged.
+    """
+
+    def encode_sam(self, images):
+        return encode_sam(self.sam_model, images)
+
+    def encode_clip(self, sam_features):
+        return encode_clip(self.vision_model, sam_features)
+
+    def project(self, sam_features, clip_features):
+        return project(self.projector, sam_features, clip_features)
+
+    def encode_view(self, images, view=None):
+        """view: 'global' or 'local', for subclasses that time or route the two separately"""
+        return encode_view(self.sam_model, self.vision_model, self.projector, images)
+
+    def format_image_features(self, global_features, local_features=None, crop_shape=None):
+        """
+        projected features of one image -> its embedding sequence: the local tiles as one
+        grid, then the global view, each row ending in image_newline, then view_seperator.
+        Needs image_newline and view_seperator attributes.
+        """
+        _, hw, n_dim = global_features.shape
+        h = w = int(hw ** 0.5)
+
+        global_features = global_features.view(h, w, n_dim)
+
+        global_features = torch.cat(
+            [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
+        )
+
+        global_features = global_features.view(-1, n_dim)
+
+        if local_features is None:
+            return torch.cat([global_features, self.view_seperator[None, :]], dim=0)
+
+        _2, hw2, n_dim2 = local_features.shape
+        h2 = w2 = int(hw2 ** 0.5)
+
+        width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
+
+        local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
+        local_features = torch.cat(
+            [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
+        )
+        local_features = local_features.view(-1, n_dim2)
+
+        return torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
+
+    def encode_image(self, global_view, crops=None, crop_shape=None):
+        """
+        one preprocessed image -> its [num_image_tokens, n_embed] embedding sequence, what the
+        model merges at the image tokens; crops: [num_tiles, 3, h, w] or None
+        crop_shape: (num_width_tiles, num_height_tiles)
+        """
+        local_features = self.encode_view(crops, 'local') if crops is not None else None
+        global_features = self.encode_view(global_view, 'global')
+        return self.format_image_features(global_features, local_features, crop_shape)
+
+
+class DeepEncoder(EncoderStages, nn.Module):
+    """
+    SAM-B + CLIP-L + projector, plus the image_newline / view_seperator embeddings, with
+    the same parameter names as in DeepseekOCRForCausalLM (and 'model.' in the checkpoint).
+    """
+
+    def __init__(self, n_embed=1280):
+        super().__init__()
+        from addict import Dict
+
+        from deepencoder.sam_vary_sdpa import build_sam_vit_b
+        from deepencoder.clip_sdpa import build_clip_l
+        from deepencoder.build_linear import MlpProjector
+
+        self.sam_model = build_sam_vit_b()
+        self.vision_model = build_clip_l()
+        self.projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
+        self.image_newline = nn.Parameter(torch.zeros(n_embed))
+        self.view_seperator = nn.Parameter(torch.zeros(n_embed))
+
+    @classmethod
+    def from_pretrained(cls, model_path):
+        """model_path: a local checkpoint directory or a Hugging Face repo id"""
+        from safetensors import safe_open
+
+        if not os.path.isdir(model_path):
+            from huggingface_hub import snapshot_download
+
+            model_path = snapshot_download(model_path, allow_patterns=['*.safetensors', '*.json'])
+
+        encoder = cls()
+        state_dict = {}
+        for path in sorted(glob.glob(os.path.join(model_path, '*.safetensors'))):
+            with safe_open(path, framework='pt') as afile:
+                for name in afile.keys():
+                    if name.startswith(('model.sam_model.', 'model.vision_model.', 'model.projector.',
+                                        'model.image_newline', 'model.view_seperator')):
+                        state_dict[name[len('model.'):]] = afile.get_tensor(name)
+
+        missing, unexpected = encoder.load_state_dict(state_dict, strict=False)
+        # CLIP's patch_embedding is never used (SAM replaces it) and may not be stored
+        missing = [name for name in missing if 'patch_embedding' not in name and 'position_ids' not in name]
+        if missing or unexpected:
+            raise ValueError(f'encoder weights in {model_path} do not match: missing {missing}, unexpected {unexpected}')
+        return encoder
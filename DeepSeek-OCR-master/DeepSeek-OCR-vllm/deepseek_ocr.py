@@ -1,6 +1,7 @@
 
 """Inference-only Deepseek-OCR model compatible with HuggingFace weights."""
 import math
+import os
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List, Literal, Optional, Set, Tuple, TypedDict, Union
 
@@ -28,7 +29,9 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, normalize_pixels)
+from process.image_tokens import num_image_tokens, token_table, worst_case_grid, worst_case_image_size
+from process.mm_cache import PayloadKeyedCache
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -40,9 +43,17 @@ from vllm.model_executor.models.utils import (AutoWeightsLoader, WeightsMapper,
 from deepencoder.sam_vary_sdpa import build_sam_vit_b
 from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
+from deepencoder.profiling import EncoderProfiler, block_ranges, maybe_trace
+from deepencoder.compiled import CompiledEncoder
+from deepencoder.stages import EncoderStages
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT, PROFILE_ENCODER, PROFILE_ENCODER_SKIP, PROFILE_ENCODER_EVERY, PROFILE_DIR, OUTPUT_PATH, ENCODER_COMPILE, ENCODER_COMPILE_BUCKETS
+from metrics import REGISTRY, TOKEN_BUCKETS, StageTimer
+
+# per image and view (global / local tiles); CUDA events, resolved without a device sync
+ENCODER_TIMER = StageTimer(REGISTRY.histogram('ocr_encoder_seconds', 'SAM / CLIP / projector time per image and view'))
+VISION_TOKENS_PER_IMAGE = REGISTRY.histogram('ocr_vision_tokens_per_image', 'vision embeddings produced per image', buckets=TOKEN_BUCKETS)
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -63,53 +74,23 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              image_width: int,
                              image_height: int,
                              cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
-
-        if CROP_MODE:
-            if image_width <= 640 and image_height <= 640:
-                crop_ratio = [1, 1]
-            else:
-                # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
-
-                # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
-
-                # print('===========')
-                # print('crop_ratio ', crop_ratio)
-                # print('============')
-                
-            num_width_tiles, num_height_tiles = crop_ratio
-        else:
-            num_width_tiles = num_height_tiles = 1
-
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+        # tile grid of the image (count_tiles) -> precomputed count for the mode, called for
+        # every prompt update, so no processor is built here
+        return num_image_tokens(image_width, image_height, cropping)
 
     def get_image_size_with_most_features(self) -> ImageSize:
+        # an image cut into the tile grid with the most tokens for MIN_CROPS..MAX_CROPS (a
+        # tall 1 x MAX_CROPS strip in crop mode), so profiling reserves memory for the real
+        # worst case; a fixed 1280x1280 image only gets 2x2 tiles
+        width, height = worst_case_image_size()
+        return ImageSize(width=width, height=height)
 
-        if IMAGE_SIZE == 1024 and BASE_SIZE == 1280:
-            return ImageSize(width=1024*2, height=1024*2)
-        return ImageSize(width=640*2, height=640*2)
+    def get_mm_max_tokens_per_item(
+        self,
+        seq_len: int,
+        mm_counts: Mapping[str, int],
+    ) -> Mapping[str, int]:
+        return {"image": token_table()[worst_case_grid()]}
 
 
 class DeepseekOCRDummyInputsBuilder(
@@ -149,7 +130,12 @@ class DeepseekOCRDummyInputsBuilder(
 
 class DeepseekOCRMultiModalProcessor(
         BaseMultiModalProcessor[DeepseekOCRProcessingInfo]):
-    
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.cache is not None:
+            # pretokenized pages are keyed by a digest of their tensors (process/mm_cache.py)
+            self.cache = PayloadKeyedCache(self.cache)
 
     def _call_hf_processor(
         self,
@@ -183,7 +169,8 @@ class DeepseekOCRMultiModalProcessor(
         return dict(
             pixel_values=MultiModalFieldConfig.batched("image"),
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
-            # image_embeds=MultiModalFieldConfig.batched("image2"),
+            # precomputed global_local_features, passed through from ImageEmbeddingItems
+            image_embeds=MultiModalFieldConfig.batched("image"),
             images_crop=MultiModalFieldConfig.batched("image"),
         )
 
@@ -207,17 +194,9 @@ class DeepseekOCRMultiModalProcessor(
             if isinstance(images, ImageEmbeddingItems):
                 num_image_tokens = images.get_feature_size(item_idx)
             else:
-
-                
-                width = images[0][-1][0][0]
-                height = images[0][-1][0][1]
-
-                num_image_tokens = self.info.get_num_image_tokens(
-                    image_width=width,
-                    image_height=height,
-                    # flag = True,
-                    cropping=CROP_MODE,
-                )
+                # the count tokenize_with_images laid out, whatever cropping it was called
+                # with: a cache hit expands the prompt with it instead of the payload's input_ids
+                num_image_tokens = images.get(item_idx)[5][0]
             return [image_token_id] * num_image_tokens
 
         return [
@@ -228,37 +207,12 @@ class DeepseekOCRMultiModalProcessor(
             )
         ]
 
-    def _cached_apply_hf_processor(
-        self,
-        prompt: Union[str, list[int]],
-        mm_data_items: MultiModalDataItems,
-        hf_processor_mm_kwargs: Mapping[str, object],
-    ) -> tuple[list[int], MultiModalKwargs, bool]:
-        # The processor logic is different for len(images) <= 2 vs > 2
-        # Since the processing cache assumes that the processor output is
-        # invariant of how many images are passed per prompt, we only
-        # perform caching for the most common case
-        if mm_data_items.get_count("image", strict=False) > 2:
-            # This code path corresponds to the cache being disabled
-            return self._apply_hf_processor_main(
-                prompt=prompt,
-                mm_items=mm_data_items,
-                hf_processor_mm_kwargs=hf_processor_mm_kwargs,
-                enable_hf_prompt_update=True,
-            )
-
-        return super()._cached_apply_hf_processor(
-            prompt=prompt,
-            mm_data_items=mm_data_items,
-            hf_processor_mm_kwargs=hf_processor_mm_kwargs,
-        )
-
 
 @MULTIMODAL_REGISTRY.register_processor(
     DeepseekOCRMultiModalProcessor,
     info=DeepseekOCRProcessingInfo,
     dummy_inputs=DeepseekOCRDummyInputsBuilder)
-class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
+class DeepseekOCRForCausalLM(nn.Module, EncoderStages, SupportsMultiModal, SupportsPP):
 
     hf_to_vllm_mapper = WeightsMapper(orig_to_new_prefix={
         "language.": "language_model.",
@@ -292,10 +246,27 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         self.projector =  MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
+
+        self.encoder_profiler = None
+        if PROFILE_ENCODER:
+            self.encoder_profiler = EncoderProfiler(
+                block_ranges(self.sam_model, self.vision_model, self.projector), PROFILE_ENCODER,
+                PROFILE_DIR or os.path.join(OUTPUT_PATH, 'encoder_traces'),
+                skip=PROFILE_ENCODER_SKIP, every=PROFILE_ENCODER_EVERY)
     
         # self.sam_model = torch.compile(self.sam_model, mode="reduce-overhead")
         # self.vision_model = torch.compile(self.vision_model, mode="reduce-overhead")
         # self.projector = torch.compile(self.projector, mode="max-autotune")
+        self.compiled_encoder = None
+        if ENCODER_COMPILE:
+            # compiled lazily per padded shape, the first time during vLLM's profiling run
+            self.compiled_encoder = CompiledEncoder(
+                self.sam_model, self.vision_model, self.projector, buckets=ENCODER_COMPILE_BUCKETS,
+                mode=None if ENCODER_COMPILE == 'default' else ENCODER_COMPILE)
+            REGISTRY.gauge('ocr_encoder_compile_hits', 'encoder calls that reused a compiled graph',
+                           function=lambda: self.compiled_encoder.hits)
+            REGISTRY.gauge('ocr_encoder_compile_misses', 'encoder calls that compiled a new shape',
+                           function=lambda: self.compiled_encoder.misses)
 
 
 
@@ -336,6 +307,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        image_embeds = kwargs.pop("image_embeds", None)
+
+        if image_embeds is not None:
+            # [num_image_tokens, n_embed] per image, e.g. from run_dpsk_ocr_encode.py
+            if not isinstance(image_embeds, (torch.Tensor, list)):
+                raise ValueError("Incorrect type of image embeddings. "
+                                 f"Got type: {type(image_embeds)}")
+            return {"image_embeds": flatten_bn(image_embeds)}
 
 
         if pixel_values is None or torch.sum(pixel_values).item() == 0:
@@ -361,6 +340,18 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
     
 
 
+    def encode_view(self, images, view=None):
+        """EncoderStages.encode_view with each stage timed, or through the compiled encoder"""
+        if self.compiled_encoder is not None:
+            with ENCODER_TIMER.time(images.device, stage='compiled', view=view):
+                return self.compiled_encoder(images)
+        with ENCODER_TIMER.time(images.device, stage='sam', view=view):
+            sam_features = self.encode_sam(images)
+        with ENCODER_TIMER.time(images.device, stage='clip', view=view):
+            clip_features = self.encode_clip(sam_features)
+        with ENCODER_TIMER.time(images.device, stage='projector', view=view):
+            return self.project(sam_features, clip_features)
+
     def _pixel_values_to_embedding(
         self,
         pixel_values: torch.Tensor,
@@ -381,87 +372,32 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # print(pixel_values.shape)
 
 
-        with torch.no_grad():
+        def trace_tag():
+            width_tiles, height_tiles = images_spatial_crop[0][0].tolist()
+            return f'{BASE_SIZE}x{IMAGE_SIZE}-tiles{width_tiles}x{height_tiles}-images{images_spatial_crop.size(0)}'
+
+        with torch.no_grad(), maybe_trace(self.encoder_profiler, trace_tag):
             for jdx in range(images_spatial_crop.size(0)):
                 # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
+                patches = normalize_pixels(images_crop[jdx][0], torch.bfloat16) # batch_size = 1
                 image_ori = pixel_values[jdx]
                 crop_shape = images_spatial_crop[jdx][0]
 
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
-
-
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
-
-
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('PATCHES: ', local_features.shape)
-                        print('=====================')
-
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    _2, hw2, n_dim2 = local_features.shape
-                    h2 = w2 = int(hw2 ** 0.5)
-
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
-
-                    local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
-                    local_features = torch.cat(
-                        [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
-                    )
-                    local_features = local_features.view(-1, n_dim2)
-
-                    global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
-                else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('NO PATCHES')
-                        print('=====================')
-
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
-                    global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
-
+                local_features = None
+                # no crop: a 1x1 grid and an all-zero images_crop placeholder (all-black crops
+                # are zero too with PIXEL_DTYPE = 'uint8', so the grid decides)
+                if crop_shape[0] > 1 or crop_shape[1] > 1:
+                    local_features = self.encode_view(patches, 'local')
+                global_features = self.encode_view(image_ori, 'global')
+
+                if PRINT_NUM_VIS_TOKENS:
+                    print('=====================')
+                    print('BASE: ', global_features.shape)
+                    print('PATCHES: ', local_features.shape if local_features is not None else 'NO PATCHES')
+                    print('=====================')
+
+                global_local_features = self.format_image_features(global_features, local_features, crop_shape)
+                VISION_TOKENS_PER_IMAGE.observe(global_local_features.shape[0])
                 images_in_this_batch.append(global_local_features)
 
         return images_in_this_batch
@@ -472,7 +408,8 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
 
         # image_input: [pixel_values, images_crop, images_spatial_crop]
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        # uint8 pixels are normalized here, after the host-to-device copy
+        pixel_values = normalize_pixels(image_input[0], torch.bfloat16)
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
@@ -500,6 +437,10 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         image_input = self._parse_and_validate_image_input(**kwargs)
         if image_input is None:
             return None
+        if isinstance(image_input, dict):
+            # precomputed: SAM / CLIP-L are skipped and the embeddings merged as they are
+            dtype = self.image_newline.dtype
+            return [embeds.to(self.image_newline.device, dtype) for embeds in image_input["image_embeds"]]
         vision_embeddings = self._process_image_input(image_input)
         return vision_embeddings
     
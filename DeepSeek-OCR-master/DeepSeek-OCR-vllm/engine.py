@@ -0,0 +1,301 @@
+"""
+Engine interface shared by the runners.
+
+ENGINE = 'vllm' drives the real model through vLLM; ENGINE = 'stub' replays canned
+grounding-markdown outputs at a fixed token rate on CPU, so rasterization, preprocessing,
+caching and post-processing can be benchmarked and regression-tested without a GPU.
+vLLM is only imported when the real engine is built.
+"""
+import asyncio
+import glob
+import os
+import re
+import time
+from collections import deque
+
+from config import MODEL_PATH, ENGINE, STUB_TOKENS_PER_SEC, STUB_OUTPUTS, MM_PREPROCESSOR_CACHE
+
+
+def engine_args(**overrides):
+    args = dict(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True,
+        max_model_len=8192,
+        tensor_parallel_size=1,
+        disable_mm_preprocessor_cache=not MM_PREPROCESSOR_CACHE,
+    )
+    args.update(overrides)
+    return args
+
+
+def register_model():
+    from vllm.model_executor.models.registry import ModelRegistry
+    from deepseek_ocr import DeepseekOCRForCausalLM
+
+    ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+
+
+def build_sampling_params(**kwargs):
+    if ENGINE == 'stub':
+        return StubSamplingParams(**kwargs)
+
+    from vllm import SamplingParams
+    return SamplingParams(**kwargs)
+
+
+def build_engine(**overrides):
+    """synchronous engine for the batch runners"""
+    if ENGINE == 'stub':
+        return StubEngine(max_num_seqs=overrides.get('max_num_seqs', 256))
+
+    return VLLMEngine(**engine_args(**overrides))
+
+
+def build_async_engine(**overrides):
+    """engine with the AsyncLLMEngine `generate(request, sampling_params, request_id)` interface"""
+    if ENGINE == 'stub':
+        return StubAsyncEngine()
+
+    from vllm import AsyncLLMEngine
+    from vllm.engine.arg_utils import AsyncEngineArgs
+
+    register_model()
+    return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**engine_args(**overrides)))
+
+
+class OCREngine:
+    """
+    add_request / step / has_unfinished_requests follow vLLM's LLMEngine, so runners can
+    stream finished requests out while new ones are still being added.
+    """
+
+    def add_request(self, request_id, request, sampling_params):
+        raise NotImplementedError
+
+    def step(self):
+        raise NotImplementedError
+
+    def has_unfinished_requests(self):
+        raise NotImplementedError
+
+    def generate(self, requests, sampling_params):
+        for idx, request in enumerate(requests):
+            self.add_request(str(idx), request, sampling_params)
+
+        finished = {}
+        while self.has_unfinished_requests():
+            for output in self.step():
+                if output.finished:
+                    finished[output.request_id] = output
+        return [finished[str(idx)] for idx in range(len(requests))]
+
+
+class VLLMEngine(OCREngine):
+
+    def __init__(self, **kwargs):
+        from vllm import LLM
+
+        register_model()
+        self.llm = LLM(**kwargs)
+        self.llm_engine = self.llm.llm_engine
+
+    def add_request(self, request_id, request, sampling_params):
+        self.llm_engine.add_request(request_id, request, sampling_params)
+
+    def step(self):
+        return self.llm_engine.step()
+
+    def has_unfinished_requests(self):
+        return self.llm_engine.has_unfinished_requests()
+
+    def generate(self, requests, sampling_params):
+        return self.llm.generate(requests, sampling_params=sampling_params)
+
+
+STUB_PAGE = (
+    '<|ref|>title<|/ref|><|det|>[[62, 48, 540, 82]]<|/det|>\n# Annual Report\n\n'
+    '<|ref|>text<|/ref|><|det|>[[62, 100, 936, 210]]<|/det|>\n'
+    'The quarterly figures are summarized below. Revenue grew in every region, '
+    'with the strongest growth in the second half of the year.\n\n'
+    '<|ref|>equation<|/ref|><|det|>[[300, 222, 700, 260]]<|/det|>\n'
+    '\\[\nr \\coloneqq \\frac{R_t - R_{t-1}}{R_{t-1}} \\quad (1)\n\\]\n\n'
+    '<|ref|>table<|/ref|><|det|>[[62, 280, 936, 520]]<|/det|>\n'
+    '<table><tr><td>Region</td><td>Q1</td><td>Q2</td><td>Q3</td><td>Q4</td></tr>'
+    '<tr><td>North</td><td>12.1</td><td>13.4</td><td>15.0</td><td>16.2</td></tr>'
+    '<tr><td>South</td><td>9.8</td><td>10.1</td><td>11.7</td><td>12.9</td></tr></table>\n\n'
+    '<|ref|>image<|/ref|><|det|>[[62, 540, 500, 860]]<|/det|>\n\n'
+    '<|ref|>image_caption<|/ref|><|det|>[[62, 868, 500, 900]]<|/det|>\n'
+    '<center>Figure 1: Revenue by region.</center>\n\n'
+    '<|ref|>text<|/ref|><|det|>[[520, 540, 936, 900]]<|/det|>\n'
+    'Operating costs stayed flat while headcount increased slightly.'
+)
+
+STUB_EOS = '<｜end▁of▁sentence｜>'
+
+
+def load_stub_outputs(path=STUB_OUTPUTS):
+    """recorded raw outputs (one page per file, or pages split like the pdf runner's _det.mmd)"""
+    if not path:
+        return [STUB_PAGE]
+
+    outputs = []
+    for file_path in sorted(glob.glob(os.path.join(path, '*'))):
+        with open(file_path, 'r', encoding='utf-8') as afile:
+            text = afile.read()
+        outputs.extend(page.replace(STUB_EOS, '').strip('\n') for page in text.split('\n<--- Page Split --->\n') if page.strip())
+    return outputs or [STUB_PAGE]
+
+
+def split_stub_tokens(text):
+    # roughly one token per word piece, enough to pace the output
+    return re.findall(r'<\|[^|]*\|>|\s*[^\s<]+|\s+|<', text)
+
+
+def count_prompt_tokens(request):
+    try:
+        image = request['multi_modal_data']['image']
+        if hasattr(image, 'shape'):
+            # precomputed image embeddings [num_images, num_image_tokens, n_embed]
+            return int(image.shape[0] * image.shape[1])
+        return int(image[0][0].shape[-1])
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return 0
+
+
+class StubSamplingParams:
+
+    def __init__(self, max_tokens=8192, include_stop_str_in_output=False, **kwargs):
+        self.max_tokens = max_tokens
+        self.include_stop_str_in_output = include_stop_str_in_output
+        self.extra = kwargs
+
+
+class StubRequestMetrics:
+
+    def __init__(self, arrival_time):
+        self.arrival_time = arrival_time
+        self.first_scheduled_time = None
+        self.first_token_time = None
+        self.finished_time = None
+
+
+class StubCompletionOutput:
+
+    def __init__(self, text, token_ids, finish_reason=None):
+        self.index = 0
+        self.text = text
+        self.token_ids = token_ids
+        self.finish_reason = finish_reason
+
+
+class StubRequestOutput:
+    """the attributes of vLLM's RequestOutput the runners use"""
+
+    def __init__(self, request_id, text, num_tokens, prompt_token_ids, finished, metrics, finish_reason=None):
+        self.request_id = request_id
+        self.outputs = [StubCompletionOutput(text, range(num_tokens), finish_reason)]
+        self.prompt_token_ids = prompt_token_ids
+        self.finished = finished
+        self.metrics = metrics
+
+
+class StubRequest:
+
+    def __init__(self, request_id, text, sampling_params, num_prompt_tokens):
+        self.request_id = request_id
+        tokens = split_stub_tokens(text)
+        self.truncated = len(tokens) > sampling_params.max_tokens
+        self.tokens = tokens[:sampling_params.max_tokens] or ['']
+        if sampling_params.include_stop_str_in_output and len(self.tokens) < sampling_params.max_tokens:
+            self.tokens.append(STUB_EOS)
+        self.num_prompt_tokens = num_prompt_tokens
+        self.num_generated = 0
+        self.text = ''
+        self.metrics = StubRequestMetrics(time.time())
+
+    def advance(self):
+        self.text += self.tokens[self.num_generated]
+        self.num_generated += 1
+        now = time.time()
+        if self.metrics.first_token_time is None:
+            self.metrics.first_token_time = now
+        finished = self.num_generated >= len(self.tokens)
+        finish_reason = None
+        if finished:
+            self.metrics.finished_time = now
+            finish_reason = 'length' if self.truncated else 'stop'
+        return StubRequestOutput(self.request_id, self.text, self.num_generated,
+                                 [0] * self.num_prompt_tokens, finished, self.metrics, finish_reason)
+
+
+class StubEngine(OCREngine):
+    """
+    Deterministic CPU stand-in for vLLM: the n-th request added gets the n-th canned output
+    (cycling), and every step decodes one token for each of up to max_num_seqs running
+    requests, paced so the whole engine produces tokens_per_sec.
+    """
+
+    def __init__(self, tokens_per_sec=STUB_TOKENS_PER_SEC, outputs=None, max_num_seqs=256):
+        self.tokens_per_sec = tokens_per_sec
+        self.outputs = outputs or load_stub_outputs()
+        self.max_num_seqs = max_num_seqs
+        self.num_added = 0
+        self.waiting = deque()
+        self.running = []
+
+    def add_request(self, request_id, request, sampling_params):
+        text = self.outputs[self.num_added % len(self.outputs)]
+        self.num_added += 1
+        self.waiting.append(StubRequest(request_id, text, sampling_params, count_prompt_tokens(request)))
+
+    def has_unfinished_requests(self):
+        return bool(self.waiting or self.running)
+
+    def step(self):
+        while self.waiting and len(self.running) < self.max_num_seqs:
+            request = self.waiting.popleft()
+            request.metrics.first_scheduled_time = time.time()
+            self.running.append(request)
+
+        start = time.perf_counter()
+        outputs = [request.advance() for request in self.running]
+        self.running = [request for request, output in zip(self.running, outputs) if not output.finished]
+
+        if self.tokens_per_sec:
+            remaining = len(outputs) / self.tokens_per_sec - (time.perf_counter() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+        return outputs
+
+
+class StubAsyncEngine:
+    """async counterpart of StubEngine; concurrent requests share the token rate"""
+
+    def __init__(self, tokens_per_sec=STUB_TOKENS_PER_SEC, outputs=None):
+        self.tokens_per_sec = tokens_per_sec
+        self.outputs = outputs or load_stub_outputs()
+        self.num_added = 0
+        self.num_running = 0
+
+    async def generate(self, request, sampling_params, request_id):
+        text = self.outputs[self.num_added % len(self.outputs)]
+        self.num_added += 1
+        stub_request = StubRequest(request_id, text, sampling_params, count_prompt_tokens(request))
+        stub_request.metrics.first_scheduled_time = stub_request.metrics.arrival_time
+
+        self.num_running += 1
+        try:
+            while True:
+                if self.tokens_per_sec:
+                    await asyncio.sleep(self.num_running / self.tokens_per_sec)
+                else:
+                    await asyncio.sleep(0)
+                output = stub_request.advance()
+                yield output
+                if output.finished:
+                    break
+        finally:
+            self.num_running -= 1
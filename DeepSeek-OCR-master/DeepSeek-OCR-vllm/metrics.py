@@ -0,0 +1,322 @@
+"""
+In-process metrics: counters, gauges and fixed-bucket histograms in one registry,
+readable as a JSON-able dict or as Prometheus text (run_dpsk_ocr_server.py /metrics).
+
+Recording is a dict lookup and a few additions under a lock, so it stays on in
+production; METRICS = False in config.py turns every update into a no-op. GPU work is
+timed with CUDA events that are resolved when they have completed (see StageTimer), so
+instrumenting the encoder never synchronizes the device.
+
+    PAGES = REGISTRY.counter('ocr_pages_total', 'finished pages by status')
+    PAGES.inc(status='repeat')
+    REGISTRY.dump('metrics.json')
+"""
+import bisect
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from config import METRICS
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096, 6144, 8192)
+TILE_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 12, 16, 25, 36)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, help):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def items(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def to_dict(self):
+        return {_format_labels(key) or 'value': value for key, value in self.items()}
+
+    def prometheus_lines(self):
+        return [f'{self.name}{_format_labels(key)} {value}' for key, value in self.items()]
+
+
+class Gauge:
+    """a value read when metrics are collected, from set() or from function()"""
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help, function=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def to_dict(self):
+        return {'value': self.get()}
+
+    def prometheus_lines(self):
+        return [f'{self.name} {self.get()}']
+
+
+class Histogram:
+    """
+    Fixed buckets, so an observation is a bisect and two additions and memory does not
+    grow with traffic. Quantiles in to_dict() are interpolated within a bucket.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, buckets=SECONDS_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # label key -> [per-bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q, **labels):
+        state = self.values.get(_label_key(labels))
+        if state is None or not state[2]:
+            return None
+        return self._quantile(state, q)
+
+    def items(self):
+        with self.lock:
+            return [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+
+    def _quantile(self, state, q):
+        counts, _, count = state
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    # +Inf bucket: the best bound is the largest finite one
+                    return self.buckets[-1]
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        result = {}
+        for key, state in self.items():
+            counts, total, count = state
+            result[_format_labels(key) or 'value'] = {
+                'count': count,
+                'sum': total,
+                'mean': total / count if count else None,
+                'p50': self._quantile(state, 0.5),
+                'p95': self._quantile(state, 0.95),
+                'p99': self._quantile(state, 0.99),
+            }
+        return result
+
+    def prometheus_lines(self):
+        lines = []
+        for key, (counts, total, count) in self.items():
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", bucket)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(self, name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'metric {name} is already registered as a {metric.kind}')
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help='', function=None):
+        gauge = self._get_or_create(Gauge, name, help, function=function)
+        if function is not None:
+            # the latest owner wins, e.g. a second app created in the same process
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help='', buckets=SECONDS_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets=buckets)
+
+    def add_collector(self, collect):
+        """collect() is called before every read, e.g. to resolve pending CUDA event timings"""
+        self.collectors.append(collect)
+
+    def collect(self):
+        for collect in self.collectors:
+            collect()
+
+    def to_dict(self):
+        self.collect()
+        return {name: metric.to_dict() for name, metric in sorted(self.metrics.items())}
+
+    def to_prometheus(self):
+        self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            if metric.help:
+                lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.prometheus_lines())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        from process.checkpoint import atomic_write
+
+        atomic_write(path, json.dumps(self.to_dict(), indent=2))
+
+
+REGISTRY = MetricsRegistry(enabled=METRICS)
+
+# shared by the runners and the server
+PAGES = REGISTRY.counter('ocr_pages_total', 'pages finished by the engine, status: ok | repeat (no eos before max_tokens)')
+
+
+def page_status(completion):
+    """'repeat' for a page that ran into max_tokens, which is how repetition loops end"""
+    return 'repeat' if getattr(completion, 'finish_reason', None) == 'length' else 'ok'
+
+
+class StageTimer:
+    """
+    Times stages of GPU work into a histogram without synchronizing:
+
+        with timer.time(device, stage='sam', view='global'):
+            features = sam_model(image)
+
+    On CUDA a pair of events is recorded around the stage and turned into an observation
+    once the end event has completed, on a later call or when the registry is read. On
+    other devices the wall time is observed directly.
+    """
+
+    def __init__(self, histogram, registry=REGISTRY, max_pending=4096):
+        self.histogram = histogram
+        self.registry = registry
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        registry.add_collector(self.collect)
+
+    @contextmanager
+    def time(self, device, **labels):
+        if not self.registry.enabled:
+            yield
+            return
+
+        if device.type != 'cuda':
+            with self.histogram.time(**labels):
+                yield
+            return
+
+        import torch
+
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        start.record()
+        yield
+        end.record()
+        self.pending.append((labels, start, end))
+        if len(self.pending) > self.max_pending:
+            self.collect()
+
+    def collect(self):
+        with self.lock:
+            while self.pending and self.pending[0][2].query():
+                labels, start, end = self.pending.popleft()
+                self.histogram.observe(start.elapsed_time(end) / 1000, **labels)
+
+
+if __name__ == "__main__":
+    # cost of one observation
+    import random
+
+    histogram = REGISTRY.histogram('bench_seconds')
+    counter = REGISTRY.counter('bench_total')
+    values = [random.random() for _ in range(100000)]
+
+    start = time.perf_counter()
+    for value in values:
+        histogram.observe(value, stage='sam')
+    observe_time = (time.perf_counter() - start) / len(values)
+
+    start = time.perf_counter()
+    for _ in values:
+        counter.inc(status='ok')
+    inc_time = (time.perf_counter() - start) / len(values)
+
+    print(f'histogram.observe: {observe_time * 1e9:.0f} ns, counter.inc: {inc_time * 1e9:.0f} ns')
+    print(f'p50 {histogram.quantile(0.5, stage="sam"):.3f}, p99 {histogram.quantile(0.99, stage="sam"):.3f} (uniform 0-1)')
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+
+from config import PROMPT, BASE_SIZE, IMAGE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS
+
+
+def run_signature():
+    """results are only reused by a run with the same prompt and resolution mode"""
+    return f'{PROMPT}|{BASE_SIZE}|{IMAGE_SIZE}|{CROP_MODE}|{MIN_CROPS}|{MAX_CROPS}'
+
+
+def fsync_path(path):
+    """fsync a closed file, or a directory (the names in it)"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def durable_replace(tmp_path, path):
+    """
+    os.replace that survives a crash: tmp_path's data is fsynced before the rename and the
+    directory after it, so a journal record written afterwards never points at an empty
+    or missing file
+    """
+    fsync_path(tmp_path)
+    os.replace(tmp_path, path)
+    fsync_path(os.path.dirname(os.path.abspath(path)))
+
+
+def atomic_write(path, data, mode='w'):
+    tmp_path = path + '.tmp'
+    encoding = 'utf-8' if 'b' not in mode else None
+    with open(tmp_path, mode, encoding=encoding) as afile:
+        afile.write(data)
+    durable_replace(tmp_path, path)
+
+
+class PageJournal:
+    """
+    Append-only JSONL journal of finished pages.
+
+    Every finished page is flushed as one line, so a crashed or preempted run loses
+    at most the pages that were still in flight. Page lines are not fsynced, a lost one is
+    only generated again; a finalized line is, together with every line before it, since
+    the outputs it stands for are skipped on resume. On restart the journal is replayed and
+    pages (or whole documents) that are already done are skipped.
+    """
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.signature = run_signature()
+        # replayed page contents, {key: {page: content}}
+        self.pages = {}
+        self.finalized = set()
+        # records of the current signature found by the replay; 0: a fresh run
+        self.replayed = 0
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self._replay()
+        elif os.path.exists(path):
+            os.remove(path)
+
+        self.file = open(path, 'a', encoding='utf-8')
+        if self.file.tell() > 0:
+            with open(path, 'rb') as afile:
+                afile.seek(-1, os.SEEK_END)
+                if afile.read(1) != b'\n':
+                    # terminate a torn last line so the next record starts cleanly
+                    self.file.write('\n')
+
+    def _replay(self):
+        with open(self.path, 'r', encoding='utf-8') as afile:
+            for line in afile:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line from a crash mid-write
+                    continue
+                if record.get('signature') != self.signature:
+                    continue
+                self.replayed += 1
+                if record.get('finalized'):
+                    self.finalized.add(record['key'])
+                    self.pages.pop(record['key'], None)
+                else:
+                    self.pages.setdefault(record['key'], {})[record['page']] = record['content']
+
+    def _append(self, records, sync=False):
+        lines = ''.join(json.dumps(dict(record, signature=self.signature), ensure_ascii=False) + '\n'
+                        for record in records)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def get(self, key, page=0):
+        return self.pages.get(key, {}).get(page)
+
+    def is_finalized(self, key):
+        return key in self.finalized
+
+    def record(self, key, page, content):
+        self._append([{'key': key, 'page': page, 'content': content}])
+
+    def mark_finalized(self, *keys):
+        """one fsync for all keys, e.g. every image finished in one engine step"""
+        with self.lock:
+            for key in keys:
+                self.finalized.add(key)
+                # finalized documents no longer need their pages in memory
+                self.pages.pop(key, None)
+        self._append([{'key': key, 'finalized': True} for key in keys], sync=True)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,200 @@
+"""
+Columnar sink for bulk / eval runs: one row per page instead of two small .md files.
+
+Rows are buffered and written in row groups as results arrive, to
+OUTPUT_PATH/results.<part>.arrows (Arrow IPC stream) or .parquet; every run appends a new
+part. read_columnar() memory-maps all parts, so the raw and cleaned text columns are read
+without copies.
+
+pyarrow is only needed when COLUMNAR_OUTPUT is set: pip install pyarrow
+"""
+import glob
+import os
+
+from process.checkpoint import durable_replace, fsync_path
+
+EXTENSIONS = {'arrow': '.arrows', 'parquet': '.parquet'}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError('COLUMNAR_OUTPUT needs pyarrow: pip install pyarrow') from e
+    return pyarrow
+
+
+def result_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ('image', pa.string()),
+        ('mode', pa.string()),
+        ('prompt_tokens', pa.int32()),
+        ('output_tokens', pa.int32()),
+        ('latency_s', pa.float64()),
+        ('raw', pa.large_string()),
+        ('cleaned', pa.large_string()),
+        # one entry per box, boxes on the model's 0-999 grid
+        ('box_labels', pa.list_(pa.string())),
+        ('boxes', pa.list_(pa.list_(pa.float32(), 4))),
+    ])
+
+
+def part_paths(base_path, fmt):
+    return sorted(glob.glob(f'{glob.escape(base_path)}.*{EXTENSIONS[fmt]}'))
+
+
+def next_part_path(base_path, fmt):
+    """results.00000.arrows, results.00001.arrows, ... one part per run"""
+    return f'{base_path}.{len(part_paths(base_path, fmt)):05d}{EXTENSIONS[fmt]}'
+
+
+def boxes_columns(grounding):
+    labels = []
+    boxes = []
+    for record in grounding.records:
+        if record.boxes is None:
+            continue
+        labels.extend([record.label] * len(record.boxes))
+        boxes.extend(record.boxes.tolist())
+    return labels, boxes
+
+
+def result_row(image, request_output, cleaned, grounding, mode):
+    """one row from a finished vLLM RequestOutput (or the stub's)"""
+    completion = request_output.outputs[0]
+    metrics = getattr(request_output, 'metrics', None)
+    latency = None
+    if metrics is not None and getattr(metrics, 'finished_time', None) is not None:
+        latency = metrics.finished_time - metrics.arrival_time
+    labels, boxes = boxes_columns(grounding)
+    return {
+        'image': image,
+        'mode': mode,
+        'prompt_tokens': len(request_output.prompt_token_ids or []),
+        'output_tokens': len(completion.token_ids),
+        'latency_s': latency,
+        'raw': completion.text,
+        'cleaned': cleaned,
+        'box_labels': labels,
+        'boxes': boxes,
+    }
+
+
+class ColumnarWriter:
+    """
+    append(key, row) buffers a row; every row_group_size rows are written as one row group
+    (an IPC record batch, or a Parquet row group).
+
+    on_durable(keys) is called once rows can be read back after a crash, i.e. once they are
+    fsynced: after every row group for the IPC stream format, and only on close() for
+    Parquet, whose footer is written last. The eval runner finalizes images in its journal
+    from it.
+    """
+
+    def __init__(self, path, fmt='arrow', row_group_size=1024, on_durable=None):
+        pa = _pyarrow()
+        self.path = path
+        self.fmt = fmt
+        self.schema = result_schema()
+        self.row_group_size = row_group_size
+        self.on_durable = on_durable
+        self.rows = []
+        self.keys = []
+        self.undurable_keys = []
+        self.num_rows = 0
+
+        if fmt == 'arrow':
+            self.sink = pa.OSFile(path, 'wb')
+            # the part's name survives a crash too, not only its row groups
+            fsync_path(os.path.dirname(os.path.abspath(path)))
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+        elif fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.sink = None
+            self.writer = pq.ParquetWriter(path + '.tmp', self.schema, compression='zstd')
+        else:
+            raise ValueError(f'unknown columnar format: {fmt}, expected one of {list(EXTENSIONS)}')
+
+    def append(self, key, row):
+        self.rows.append(row)
+        self.keys.append(key)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = _pyarrow()
+        table = pa.Table.from_pylist(self.rows, schema=self.schema)
+        self.writer.write_table(table)
+        self.undurable_keys.extend(self.keys)
+        self.num_rows += len(self.rows)
+        self.rows = []
+        self.keys = []
+
+        if self.fmt == 'arrow':
+            self.sink.flush()
+            os.fsync(self.sink.fileno())
+            self._durable()
+
+    def _durable(self):
+        keys, self.undurable_keys = self.undurable_keys, []
+        if self.on_durable and keys:
+            self.on_durable(keys)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.fmt == 'arrow':
+            self.sink.close()
+        written_path = self.path if self.fmt == 'arrow' else self.path + '.tmp'
+        if not self.num_rows:
+            # nothing left to do in this run, don't leave an empty part behind
+            os.remove(written_path)
+        elif written_path != self.path:
+            durable_replace(written_path, self.path)
+        self._durable()
+
+
+def read_columnar(base_path, fmt='arrow'):
+    """
+    All parts of a run as one pyarrow Table. The files are memory-mapped and the
+    columns reference the mapping, so nothing is copied until a value is used.
+    """
+    pa = _pyarrow()
+    tables = []
+    for path in part_paths(base_path, fmt):
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            tables.append(pq.read_table(path, memory_map=True))
+            continue
+
+        batches = []
+        reader = pa.ipc.open_stream(pa.memory_map(path, 'r'))
+        try:
+            for batch in reader:
+                batches.append(batch)
+        except (pa.ArrowInvalid, OSError):
+            # torn last row group of an interrupted run; the journal has not finalized it
+            pass
+        tables.append(pa.Table.from_batches(batches, schema=reader.schema))
+
+    if not tables:
+        return result_schema().empty_table()
+    return pa.concat_tables(tables)
+
+
+if __name__ == "__main__":
+    # python -m process.columnar OUTPUT_PATH/results [arrow|parquet]
+    import sys
+
+    fmt = sys.argv[2] if len(sys.argv) > 2 else 'arrow'
+    table = read_columnar(sys.argv[1], fmt)
+    print(table.schema)
+    print(f'{table.num_rows} rows in {len(part_paths(sys.argv[1], fmt))} part(s)')
+    if table.num_rows:
+        output_tokens = table.column('output_tokens').to_numpy()
+        latency = table.column('latency_s').to_numpy()
+        print(f'output tokens: mean {output_tokens.mean():.0f}, max {output_tokens.max()}')
+        print(f'latency: mean {latency.mean():.2f}s, max {latency.max():.2f}s')
@@ -0,0 +1,134 @@
+"""
+Figure extraction: the `image` boxes of a page are cropped and hashed, then encoded and
+written on a thread pool, off the drawing and writing path.
+
+Identical crops (same pixels) within a document are written once; later occurrences
+point at the first file once its write has succeeded, and are written themselves if it
+failed. Each page gets a manifest that the markdown links and the structured output are
+built from.
+"""
+import hashlib
+import io
+import os
+import threading
+from typing import List
+
+from PIL import Image
+
+from process.grounding import GroundingRecord
+from process.render import flatten_records, to_pixels
+
+FORMATS = {
+    'jpg': ('JPEG', '.jpg'),
+    'jpeg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+    'webp': ('WEBP', '.webp'),
+}
+
+
+def encode_figure(crop: Image.Image, fmt='jpg', quality=95):
+    """png is always lossless; webp with quality=100 is lossless too"""
+    pil_format, _ = FORMATS[fmt]
+    buffer = io.BytesIO()
+    if pil_format == 'JPEG':
+        crop.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    elif pil_format == 'WEBP':
+        crop.save(buffer, format='WEBP', quality=quality, lossless=quality >= 100)
+    else:
+        crop.save(buffer, format='PNG', compress_level=3)
+    return buffer.getvalue()
+
+
+class FigureWriter:
+    """
+    One per document. submit(image, records, prefix) returns a future of the page's
+    manifest, one entry per `image` box in output order:
+
+        {'index': 0, 'box': [x1, y1, x2, y2], 'path': 'images/3_0.jpg', 'sha1': ..., 'duplicate': False}
+
+    `path` is relative to output_dir, as the markdown links it; a failed crop has path None.
+    A duplicate waits on the write of the page that holds the first crop, so the executor
+    must start tasks in submission order (a ThreadPoolExecutor does).
+    """
+
+    def __init__(self, executor, output_dir, subdir='images', fmt='jpg', quality=95, dedup=True):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown figure format: {fmt}, expected one of {list(FORMATS)}')
+        self.executor = executor
+        self.output_dir = output_dir
+        self.subdir = subdir
+        self.fmt = fmt
+        self.quality = quality
+        self.dedup = dedup
+        # sha1 of the crop pixels -> (manifest entry of its first crop, set once that page's writes are done)
+        self.written = {}
+        os.makedirs(os.path.join(output_dir, subdir), exist_ok=True)
+
+    def submit(self, image: Image.Image, records: List[GroundingRecord], prefix=''):
+        """
+        Crops and hashes on the calling thread, in page order, so the first occurrence of a
+        figure always keeps its own name; encoding and writing run on the executor.
+        """
+        labels, boxes = flatten_records(records)
+        pixels = to_pixels(boxes, *image.size)
+        extension = FORMATS[self.fmt][1]
+
+        manifest = []
+        crops = []
+        duplicates = []
+        done = threading.Event()
+        for idx, box in enumerate(pixels[[label == 'image' for label in labels]].tolist()):
+            name = f'{prefix}_{idx}' if prefix != '' else f'{idx}'
+            entry = {'index': idx, 'box': box, 'path': None, 'sha1': None, 'duplicate': False}
+            manifest.append(entry)
+            try:
+                crop = image.crop(tuple(box))
+                entry['sha1'] = hashlib.sha1(crop.tobytes()).hexdigest()
+            except Exception as e:
+                print(e)
+                continue
+
+            path = f'{self.subdir}/{name}{extension}'
+            first = self.written.get(entry['sha1']) if self.dedup else None
+            if first is not None:
+                duplicates.append((entry, crop, path, first))
+                continue
+            self.written[entry['sha1']] = (entry, done)
+            crops.append((entry, crop, path))
+
+        return self.executor.submit(self._write, manifest, crops, duplicates, done)
+
+    def _write(self, manifest, crops, duplicates, done):
+        try:
+            for entry, crop, path in crops:
+                self._save(entry, crop, path)
+        finally:
+            done.set()
+        for entry, crop, path, (first, first_done) in duplicates:
+            # the first crop's page was submitted earlier, so its write has already started
+            first_done.wait()
+            if first['path'] is not None:
+                entry['path'] = first['path']
+                entry['duplicate'] = True
+            else:
+                self._save(entry, crop, path)
+        return manifest
+
+    def _save(self, entry, crop, path):
+        try:
+            data = encode_figure(crop, self.fmt, self.quality)
+            with open(os.path.join(self.output_dir, path), 'wb') as afile:
+                afile.write(data)
+        except Exception as e:
+            print(e)
+            return
+        entry['path'] = path
+
+
+def figure_link(manifest, fallback):
+    """image_link for GroundingResult.markdown: the manifest path of the idx-th figure"""
+    def link(idx):
+        if idx < len(manifest) and manifest[idx]['path'] is not None:
+            return manifest[idx]['path']
+        return fallback(idx)
+    return link
@@ -1,4 +1,5 @@
 import math
+import time
 from typing import List, Tuple
 
 import torch
@@ -6,52 +7,20 @@ import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
-
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
-    return best_ratio
-
-
-def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
-
-    return target_aspect_ratio
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER, PIXEL_DTYPE, PIN_PIXELS
+from metrics import REGISTRY, TILE_BUCKETS, TOKEN_BUCKETS
+from process.image_tokens import tile_grids, find_closest_aspect_ratio
 
+PREPROCESS_SECONDS = REGISTRY.histogram('ocr_preprocess_seconds', 'tokenize_with_images time per request')
+TILES_PER_IMAGE = REGISTRY.histogram('ocr_tiles_per_image', 'local tiles per image, 0: global view only', buckets=TILE_BUCKETS)
+VISION_TOKENS_PER_REQUEST = REGISTRY.histogram('ocr_vision_tokens_per_request', 'image tokens in the prompt', buckets=TOKEN_BUCKETS)
 
 def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
 
     # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_ratios = tile_grids(min_num, max_num)
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
@@ -91,23 +60,43 @@ class ImageTransform:
     def __init__(self,
                  mean: Tuple[float, float, float] = (0.5, 0.5, 0.5),
                  std: Tuple[float, float, float] = (0.5, 0.5, 0.5),
-                 normalize: bool = True):
+                 normalize: bool = True,
+                 dtype: torch.dtype = torch.float32):
         self.mean = mean
         self.std = std
         self.normalize = normalize
+        self.dtype = dtype
 
-        transform_pipelines = [T.ToTensor()]
+        if dtype == torch.uint8:
+            # raw pixels, normalize_pixels() does ToTensor / Normalize on the device
+            transform_pipelines = [T.PILToTensor()]
+        else:
+            transform_pipelines = [T.ToTensor()]
 
-        if normalize:
-            transform_pipelines.append(T.Normalize(mean, std))
+            if normalize:
+                transform_pipelines.append(T.Normalize(mean, std))
 
         self.transform = T.Compose(transform_pipelines)
 
     def __call__(self, pil_img: Image.Image):
         x = self.transform(pil_img)
+        if x.dtype != self.dtype:
+            x = x.to(self.dtype)
         return x
 
 
+def normalize_pixels(images, dtype=torch.bfloat16, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)):
+    """
+    pixel_values / images_crop from tokenize_with_images -> encoder input in dtype. uint8
+    pixels (PIXEL_DTYPE = 'uint8') are normalized here, on whatever device they are on.
+    """
+    if images.dtype != torch.uint8:
+        return images.to(dtype)
+    mean = torch.tensor(mean, device=images.device).view(-1, 1, 1) * 255
+    std = torch.tensor(std, device=images.device).view(-1, 1, 1) * 255
+    return ((images.float() - mean) / std).to(dtype)
+
+
 class DeepseekOCRProcessor(ProcessorMixin):
     tokenizer_class = ("LlamaTokenizer", "LlamaTokenizerFast")
     attributes = ["tokenizer"]
@@ -127,6 +116,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
         sft_format: str = "deepseek",
         mask_prompt: bool = True,
         ignore_id: int = -100,
+        pixel_dtype: str = None,
         **kwargs,
     ):
 
@@ -141,7 +131,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
         # self.downsample_ratio = downsample_ratio
         self.downsample_ratio = 4
 
-        self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize)
+        # the name, so the processor still serializes (repr, to_json_string); the torch dtype is private
+        self.pixel_dtype = pixel_dtype or PIXEL_DTYPE
+        self._pixel_dtype = getattr(torch, self.pixel_dtype)
+        self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize, dtype=self._pixel_dtype)
 
 
         self.tokenizer = tokenizer
@@ -334,11 +327,17 @@ class DeepseekOCRProcessor(ProcessorMixin):
         bos: bool = True,
         eos: bool = True,
         cropping: bool = True,
+        prompt: str = PROMPT,
     ):
-        """Tokenize text with <image> tags."""
+        """
+        Tokenize text with <image> tags. The output depends only on the arguments and the
+        processor's attributes, so equal pages give equal payloads (process/mm_cache.py);
+        prompt must be the prompt of the vLLM request.
+        """
 
+        start = time.perf_counter()
         # print(conversation)
-        conversation = PROMPT
+        conversation = prompt
         assert conversation.count(self.image_token) == len(images)
         text_splits = conversation.split(self.image_token)
         images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
@@ -368,7 +367,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
                     # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
                     # print('image ', image.size)
                     # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
+                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=self.image_size)
                     # print('crop_ratio: ', crop_ratio)
                 else:
                     # best_width, best_height = self.image_size, self.image_size
@@ -433,6 +432,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
             tokenized_str += tokenized_image
             images_seq_mask += [True] * len(tokenized_image)
             num_image_tokens.append(len(tokenized_image))
+            TILES_PER_IMAGE.observe(num_width_tiles * num_height_tiles if num_width_tiles > 1 or num_height_tiles > 1 else 0)
 
         """process the last text split"""
         tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
@@ -482,21 +482,64 @@ class DeepseekOCRProcessor(ProcessorMixin):
             images_seq_mask = images_seq_mask[:-1]
 
         if len(images_list) == 0:
-            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
+            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size), dtype=self._pixel_dtype)
             images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+            images_crop = torch.zeros((1, 3, self.image_size, self.image_size), dtype=self._pixel_dtype).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
             images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
             if images_crop_list:
                 images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
             else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+                images_crop = torch.zeros((1, 3, self.image_size, self.image_size), dtype=self._pixel_dtype).unsqueeze(0)
+
+        if PIN_PIXELS and torch.cuda.is_available():
+            pixel_values = pixel_values.pin_memory()
+            images_crop = images_crop.pin_memory()
 
         input_ids = input_ids.unsqueeze(0)
 
-        
+        PREPROCESS_SECONDS.observe(time.perf_counter() - start)
+        VISION_TOKENS_PER_REQUEST.observe(sum(num_image_tokens))
         return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
 
 
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
+
+
+if __name__ == "__main__":
+    # host memory of a queue of preprocessed pages for each PIXEL_DTYPE, each measured in a
+    # forked process so memory freed by the previous dtype is not reused (Linux)
+    import argparse
+    import multiprocessing
+    import os
+
+    parser = argparse.ArgumentParser(description='host RSS of queued preprocessed pages per pixel dtype')
+    parser.add_argument('--pages', type=int, default=100, help='queued pages, e.g. MAX_CONCURRENCY')
+    parser.add_argument('--size', default='1190x1684', help='page size, default: A4 at 144 dpi (2x3 tiles)')
+    parser.add_argument('--dtypes', default='float32,bfloat16,uint8')
+    args = parser.parse_args()
+
+    def rss_bytes():
+        with open('/proc/self/statm') as afile:
+            return int(afile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def measure(dtype, page, results):
+        before = rss_bytes()
+        queue = [DeepseekOCRProcessor(pixel_dtype=dtype).tokenize_with_images(images=[page], bos=True, eos=True, cropping=CROP_MODE)
+                 for _ in range(args.pages)]
+        page_bytes = sum(t.numel() * t.element_size() for t in queue[0][0][1:3])
+        results.put((page_bytes, rss_bytes() - before))
+
+    width, height = (int(n) for n in args.size.split('x'))
+    page = Image.new('RGB', (width, height), 'white')
+    context = multiprocessing.get_context('fork')
+    print(f'{args.pages} pages of {width}x{height}, crop_mode={CROP_MODE}')
+    print(f'{"dtype":<9} {"MiB/page":>9} {"queue RSS MiB":>14}')
+    for dtype in args.dtypes.split(','):
+        results = context.Queue()
+        process = context.Process(target=measure, args=(dtype, page, results))
+        process.start()
+        page_bytes, rss = results.get()
+        process.join()
+        print(f'{dtype:<9} {page_bytes / 2 ** 20:>9.1f} {rss / 2 ** 20:>14.0f}')
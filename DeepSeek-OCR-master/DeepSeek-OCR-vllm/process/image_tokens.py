@@ -0,0 +1,119 @@
+"""
+Image token counts, as tokenize_with_images lays the tokens out for one image:
+
+    global view   q_base rows of q_base tokens + image_newline      q = size // 16 / 4
+    local tiles   q * num_height_tiles rows of q * num_width_tiles tokens + image_newline,
+                  only when the image is cut into 2+ tiles
+    separator     1 (view_seperator)
+
+so the count depends only on the tile grid. token_table() has it for every grid of the
+configured mode, and num_image_tokens(width, height) picks the grid as tokenize_with_images
+does (count_tiles) and looks it up, without building a processor. The worst case of the
+mode is the largest count in the table; vLLM's memory profiling and KV cache budget are
+sized from an image with that grid. tests/test_image_tokens.py checks that no grid of any
+mode gets more, and compares the table with tokenize_with_images on random page sizes.
+"""
+import math
+from functools import lru_cache
+
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS
+
+PATCH_SIZE = 16
+DOWNSAMPLE_RATIO = 4
+# images up to this size in both dimensions are never tiled
+MAX_UNTILED_SIZE = 640
+
+
+def num_queries(size):
+    return math.ceil((size // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+
+
+def tile_grids(min_num=MIN_CROPS, max_num=MAX_CROPS):
+    """every (num_width_tiles, num_height_tiles) count_tiles chooses from, fewest tiles first"""
+    grids = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return sorted(grids, key=lambda x: x[0] * x[1])
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
+    return best_ratio
+
+
+def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    aspect_ratio = orig_width / orig_height
+
+    # calculate the existing image aspect ratio
+    target_ratios = tile_grids(min_num, max_num)
+
+    # find the closest aspect ratio to the target
+    target_aspect_ratio = find_closest_aspect_ratio(
+        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+
+    return target_aspect_ratio
+
+
+def grid_tokens(grid, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """image tokens of an image cut into grid = (num_width_tiles, num_height_tiles); (1, 1): global view only"""
+    num_width_tiles, num_height_tiles = grid
+    h = w = num_queries(base_size)
+    h2 = w2 = num_queries(image_size)
+
+    global_views_tokens = h * (w + 1)
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
+    else:
+        local_views_tokens = 0
+    return global_views_tokens + local_views_tokens + 1
+
+
+@lru_cache(maxsize=None)
+def token_table(crop_mode=CROP_MODE, min_num=MIN_CROPS, max_num=MAX_CROPS, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """{tile grid: image tokens} for every grid an image can get in this mode, (1, 1) included"""
+    grids = [(1, 1)] + (tile_grids(min_num, max_num) if crop_mode else [])
+    return {grid: grid_tokens(grid, base_size, image_size) for grid in grids}
+
+
+@lru_cache(maxsize=65536)
+def image_grid(width, height, cropping=CROP_MODE, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=IMAGE_SIZE):
+    """the tile grid tokenize_with_images cuts a width x height image into"""
+    if not cropping or (width <= MAX_UNTILED_SIZE and height <= MAX_UNTILED_SIZE):
+        return (1, 1)
+    return count_tiles(width, height, min_num, max_num, image_size=image_size)
+
+
+def num_image_tokens(width, height, cropping=CROP_MODE, min_num=MIN_CROPS, max_num=MAX_CROPS, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """len(tokenized_image) of tokenize_with_images for a width x height image"""
+    table = token_table(cropping, min_num, max_num, base_size, image_size)
+    return table[image_grid(width, height, cropping, min_num, max_num, image_size)]
+
+
+def worst_case_grid(crop_mode=CROP_MODE, min_num=MIN_CROPS, max_num=MAX_CROPS, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """the tile grid with the most image tokens; tall grids win, their rows are short"""
+    if not crop_mode:
+        return (1, 1)
+    table = token_table(crop_mode, min_num, max_num, base_size, image_size)
+    return max(tile_grids(min_num, max_num), key=lambda grid: (table[grid], grid[1]))
+
+
+def worst_case_image_size(crop_mode=CROP_MODE, min_num=MIN_CROPS, max_num=MAX_CROPS, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """(width, height) of an image that count_tiles cuts into worst_case_grid()"""
+    if not crop_mode:
+        return (base_size, base_size)
+    num_width_tiles, num_height_tiles = worst_case_grid(crop_mode, min_num, max_num, base_size, image_size)
+    # the exact aspect ratio of the grid, at full tile resolution (it wins area ties too)
+    return (num_width_tiles * image_size, num_height_tiles * image_size)
+
@@ -0,0 +1,166 @@
+"""
+Streaming writer for the <name>_layouts.pdf output.
+
+Every page is stored as a JPEG image XObject and written to disk as soon as it is
+encoded; only the object offsets stay in memory until the xref table is written at the
+end. Peak memory is a handful of pages regardless of the document length.
+"""
+import io
+import os
+
+from PIL import Image
+
+from process.checkpoint import durable_replace
+from process.render import draw_layout, render_pages
+
+# img2pdf's default for JPEGs without a resolution, so pages keep the same size as before
+DEFAULT_DPI = 96
+
+
+def encode_jpeg(image: Image.Image, quality=95):
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue(), image.size
+
+
+def render_jpeg(image, records, quality=95):
+    """draw one annotated page and encode it; runs on the render workers"""
+    return encode_jpeg(draw_layout(image, records), quality)
+
+
+class StreamingPdfWriter:
+    """
+    Writes a PDF of full-page JPEGs one page at a time:
+
+        with StreamingPdfWriter(path) as writer:
+            for jpeg_bytes, (width, height) in pages:
+                writer.add_jpeg(jpeg_bytes, width, height)
+
+    The file is written to path + '.tmp' and only moved into place by close(), so an
+    interrupted run never leaves a truncated PDF behind. Nothing is written for zero pages.
+    """
+
+    # object 1 is the catalog and object 2 the page tree; both are written last
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, path, dpi=DEFAULT_DPI):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.scale = 72.0 / dpi
+        self.file = open(self.tmp_path, 'wb')
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write_object(self, object_id, body, stream=None):
+        self.offsets[object_id] = self.file.tell()
+        self.file.write(f'{object_id} 0 obj\n'.encode('ascii'))
+        self.file.write(body.encode('ascii'))
+        if stream is not None:
+            self.file.write(b'\nstream\n')
+            self.file.write(stream)
+            self.file.write(b'\nendstream')
+        self.file.write(b'\nendobj\n')
+
+    def add_jpeg(self, jpeg_bytes, width, height):
+        image_id, content_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+        self.next_id += 3
+
+        page_width = width * self.scale
+        page_height = height * self.scale
+        content = f'q\n{page_width:.4f} 0 0 {page_height:.4f} 0 0 cm\n/Im0 Do\nQ'.encode('ascii')
+
+        self._write_object(image_id, (
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg_bytes)} >>'),
+            jpeg_bytes)
+        self._write_object(content_id, f'<< /Length {len(content)} >>', content)
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}] '
+            f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>'))
+        self.page_ids.append(page_id)
+
+    def close(self):
+        if self.file.closed:
+            return
+        if not self.page_ids:
+            self.file.close()
+            os.remove(self.tmp_path)
+            return
+
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self.page_ids)
+        self._write_object(self.PAGES, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>')
+        self._write_object(self.CATALOG, f'<< /Type /Catalog /Pages {self.PAGES} 0 R >>')
+
+        xref_offset = self.file.tell()
+        xref = [f'xref\n0 {self.next_id}\n', '0000000000 65535 f \n']
+        xref.extend(f'{self.offsets[object_id]:010d} 00000 n \n' for object_id in range(1, self.next_id))
+        xref.append(f'trailer\n<< /Size {self.next_id} /Root {self.CATALOG} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self.file.write(''.join(xref).encode('ascii'))
+        self.file.close()
+        durable_replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_layout_pdf(path, executor, pages, quality=95):
+    """
+    pages: iterable of (image, records). Pages are drawn and JPEG-encoded in
+    parallel on the executor and appended to the PDF in order as they finish.
+    """
+    render = lambda image, records: render_jpeg(image, records, quality)
+    with StreamingPdfWriter(path) as writer:
+        for jpeg_bytes, (width, height) in render_pages(executor, pages, render=render):
+            writer.add_jpeg(jpeg_bytes, width, height)
+
+
+if __name__ == "__main__":
+    # render a layouts pdf after the fact from a finished run:
+    #   python -m process.layout_pdf input.pdf output/input_det.mmd [output/input_layouts.pdf]
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    import fitz
+
+    from config import NUM_WORKERS
+    from process.grounding import parse_grounding
+
+    def pdf_to_images(pdf_path, dpi=144):
+        """same rasterization as run_dpsk_ocr_pdf.py, one page at a time"""
+        Image.MAX_IMAGE_PIXELS = None
+        matrix = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+        with fitz.open(pdf_path) as pdf_document:
+            for page in pdf_document:
+                yield Image.open(io.BytesIO(page.get_pixmap(matrix=matrix, alpha=False).tobytes("png")))
+
+    pdf_path, det_path = sys.argv[1], sys.argv[2]
+    out_path = sys.argv[3] if len(sys.argv) > 3 else det_path.replace('_det.mmd', '_layouts.pdf')
+
+    with open(det_path, 'r', encoding='utf-8') as afile:
+        contents = afile.read().split('\n<--- Page Split --->\n')[:-1]
+    with fitz.open(pdf_path) as pdf_document:
+        num_pages = pdf_document.page_count
+    if len(contents) != num_pages:
+        # SKIP_REPEAT drops pages without eos from _det.mmd, so pages can no longer be matched up
+        print(f'warning: {num_pages} pages in {pdf_path} but {len(contents)} in {det_path}; pairing them in order')
+    images = pdf_to_images(pdf_path)
+
+    pages = ((image, parse_grounding(content).records) for image, content in zip(images, contents))
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        write_layout_pdf(out_path, executor, pages)
+    print(out_path)
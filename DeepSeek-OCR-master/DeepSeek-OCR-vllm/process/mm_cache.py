@@ -0,0 +1,80 @@
+"""
+Keys for vLLM's multimodal preprocessor cache on the pretokenized pages the runners send.
+
+The runners pass {"image": tokenize_with_images(...)} as multi_modal_data. vLLM treats each
+payload entry (input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop,
+num_image_tokens, image_shapes) as one item. It caches the processed MultiModalKwargs
+under a hash of the item, and on a hit it only tokenizes the request prompt.
+vLLM's own hash goes through numpy, which has no bfloat16 (PIXEL_DTYPE = 'bfloat16'). It
+also copies every tensor and skips dtype and shape. features_digest() hashes the tensors'
+memory in place, dtype and shape included. PayloadKeyedCache hands that digest to vLLM's
+cache in place of the item.
+
+A hit is only correct if both paths produce the same tokens: the tokenizer on the request
+prompt plus the payload's own num_image_tokens (cached), and the payload's input_ids
+(uncached). So the payload must be tokenized with the request prompt; tests/test_mm_cache.py
+compares the two paths.
+"""
+import hashlib
+
+import torch
+
+from metrics import REGISTRY
+
+MM_CACHE_LOOKUPS = REGISTRY.counter('ocr_mm_cache_lookups_total', 'vLLM preprocessor cache lookups of pretokenized pages by status')
+
+
+def features_digest(features):
+    """sha256 of one tokenize_with_images entry: every tensor's dtype, shape and bytes, and the other fields"""
+    digest = hashlib.sha256()
+    for value in features:
+        if isinstance(value, torch.Tensor):
+            digest.update(f'{value.dtype}{tuple(value.shape)}'.encode())
+            # a uint8 view of the memory: no numpy dtype needed, no copy if contiguous
+            digest.update(value.contiguous().view(torch.uint8).numpy())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+class PayloadKeyedCache:
+    """
+    Wraps vLLM's ProcessingCache and keys tokenize_with_images entries by features_digest.
+    Other items (PIL images, embeddings) keep vLLM's own hash.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        # (item, key) of lookups that missed, until their put(): a miss is looked up and
+        # then stored within one request, so each payload is hashed once and held no longer
+        self._missed = []
+
+    def key(self, input_item):
+        if not isinstance(input_item, (list, tuple)):
+            return input_item
+        for item, key in self._missed:
+            if item is input_item:
+                return key
+        return features_digest(input_item)
+
+    def get(self, model_id, modality, input_item, input_kwargs):
+        key = self.key(input_item)
+        output = self.cache.get(model_id, modality, key, input_kwargs)
+        MM_CACHE_LOOKUPS.inc(status='hit' if output is not None else 'miss')
+        if output is None and key is not input_item:
+            self._missed.append((input_item, key))
+        return output
+
+    def put(self, model_id, modality, input_item, input_kwargs, output_kwargs):
+        key = self.key(input_item)
+        self._missed = [(item, k) for item, k in self._missed if item is not input_item]
+        self.cache.put(model_id, modality, key, input_kwargs, output_kwargs)
+
+
+def same_nested(a, b):
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return (isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor) and a.dtype == b.dtype
+                and a.shape == b.shape and torch.equal(a, b))
+    if isinstance(a, (list, tuple)):
+        return isinstance(b, (list, tuple)) and len(a) == len(b) and all(same_nested(x, y) for x, y in zip(a, b))
+    return a == b
@@ -0,0 +1,108 @@
+import re
+from functools import lru_cache
+
+MACROS = {'\\coloneqq': ':=', '\\eqqcolon': '=:'}
+QUAD_PATTERN = re.compile(r'\\quad\s*\([^)]*\)')
+
+
+@lru_cache(maxsize=None)
+def _normalizer(formulas, macros, newlines, center):
+    alternatives = []
+    if formulas:
+        # single-line display formulas, as clean_formula matched them
+        alternatives.append(r'(?P<formula>\\\[(?P<body>.*?)\\\])')
+    if macros:
+        alternatives.append('(?P<macro>' + '|'.join(re.escape(macro) for macro in MACROS) + ')')
+    if newlines:
+        alternatives.append(r'(?P<newlines>\n{3,})')
+    if center:
+        alternatives.append(r'(?P<center></?center>)')
+    if not alternatives:
+        return None
+
+    pattern = re.compile('|'.join(alternatives))
+
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'formula':
+            # drop equation numbers: \[ x \quad (1) \] -> \[x\]
+            body = QUAD_PATTERN.sub('', match.group('body')).strip()
+            if macros:
+                for macro, replacement in MACROS.items():
+                    body = body.replace(macro, replacement)
+            return '\\[' + body + '\\]'
+        if kind == 'macro':
+            return MACROS[match.group()]
+        if kind == 'newlines':
+            return '\n\n'
+        return ''
+
+    return pattern, replace
+
+
+def normalize_markdown(text, formulas=False, macros=False, newlines=False, center=False):
+    """
+    All of the markdown post-processing in one scan of the text:
+
+    formulas: strip `\\quad (n)` equation numbers inside \\[...\\]
+    macros:   \\coloneqq -> :=, \\eqqcolon -> =:
+    newlines: collapse runs of 3 or more newlines to a blank line
+    center:   drop <center> / </center> tags
+    """
+    normalizer = _normalizer(formulas, macros, newlines, center)
+    if normalizer is None:
+        return text
+    pattern, replace = normalizer
+    return pattern.sub(replace, text)
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    def clean_formula(text):
+        # the eval runner's implementation this module replaces
+        def process_formula(match):
+            formula = match.group(1)
+            formula = re.sub(r'\\quad\s*\([^)]*\)', '', formula)
+            return r'\[' + formula.strip() + r'\]'
+        return re.sub(r'\\\[(.*?)\\\]', process_formula, text)
+
+    def legacy_normalize(text, num_matches):
+        text = clean_formula(text)
+        # the post-cleanup used to run once per grounding match
+        for _ in range(num_matches):
+            text = text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
+        return text
+
+    def synthetic_markdown(num_tokens, seed=0):
+        rng = random.Random(seed)
+        parts = []
+        tokens = 0
+        while tokens < num_tokens:
+            kind = rng.random()
+            if kind < 0.2:
+                parts.append(f'\\[ x_{{{rng.randint(0, 99)}}} \\coloneqq y \\quad ({rng.randint(1, 99)}) \\]\n\n\n')
+            elif kind < 0.3:
+                parts.append('<center>Figure caption</center>\n\n\n\n')
+            else:
+                parts.append(' '.join(f'w{rng.randint(0, 9999)}' for _ in range(rng.randint(8, 24))) + '\n\n')
+            tokens += 20
+        return ''.join(parts)
+
+    print(f'{"tokens":>8} {"chars":>9} {"legacy ms":>10} {"single pass ms":>15} {"ns/char":>8}')
+    for num_tokens in [1024, 2048, 4096, 8192, 16384, 32768]:
+        text = synthetic_markdown(num_tokens)
+        # about one grounding span per 20 tokens
+        num_matches = num_tokens // 20
+
+        start = time.perf_counter()
+        legacy = legacy_normalize(text, num_matches)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(5):
+            normalize_markdown(text, formulas=True, macros=True, newlines=True, center=True)
+        new_time = (time.perf_counter() - start) / 5
+
+        print(f'{num_tokens:>8} {len(text):>9} {legacy_time * 1000:>10.2f} {new_time * 1000:>15.2f} {new_time / len(text) * 1e9:>8.1f}')
@@ -0,0 +1,144 @@
+"""
+Structured per-page output: one JSON object per line, next to the .mmd files.
+
+    {"page": 0, "width": 1190, "height": 1684, "source": "...pdf",
+     "blocks": [{"label": "table", "boxes": [[x1, y1, x2, y2]], "boxes_norm": [[...]], "text": "<table>..."}]}
+
+`boxes` are pixels of the page image the model saw, `boxes_norm` the model's 0-999 grid.
+`text` is the markdown the model wrote after the block's grounding span, so tables,
+figures and captions can be found without parsing the markdown again.
+"""
+import gzip
+import json
+import os
+import zlib
+
+from process.checkpoint import durable_replace
+from process.grounding import GroundingResult
+from process.render import to_pixels
+
+EOS = '<｜end▁of▁sentence｜>'
+
+
+def structured_path(base_path, fmt):
+    """fmt: 'jsonl' or 'jsonl.gz' (STRUCTURED_OUTPUT)"""
+    return f'{base_path}.{fmt}'
+
+
+def page_record(page_idx, grounding: GroundingResult, width, height, **extra):
+    blocks = []
+    for record in grounding.records:
+        block = {'label': record.label, 'text': grounding.block_text(record).replace(EOS, '').strip()}
+        if record.boxes is None:
+            block['boxes'] = block['boxes_norm'] = None
+            block['det'] = record.det
+        else:
+            block['boxes'] = to_pixels(record.boxes, width, height).tolist()
+            integral = (record.boxes == record.boxes.round()).all()
+            block['boxes_norm'] = (record.boxes.astype(int) if integral else record.boxes).tolist()
+        blocks.append(block)
+
+    record = {'page': page_idx, 'width': width, 'height': height}
+    record.update(extra)
+    record['blocks'] = blocks
+    return record
+
+
+class StructuredWriter:
+    """
+    Writes page records as JSON lines as they are produced, gzip-compressed if the path
+    ends with .gz. The file is written under path + '.tmp' and renamed on close().
+
+    in_place=True writes path itself, so records made durable with sync() survive a crash
+    (journaled runs): it is truncated, or with append=True added to (resumed runs; readers
+    should keep the last record of a key). An appended .gz gets a new gzip member, after
+    the complete records of a member an interrupted run left truncated.
+    """
+
+    def __init__(self, path, append=False, in_place=False):
+        self.path = path
+        self.write_path = path if append or in_place else path + '.tmp'
+        mode = 'at' if append else 'wt'
+        if append and os.path.exists(path):
+            _repair(path)
+        if path.endswith('.gz'):
+            self.file = gzip.open(self.write_path, mode, encoding='utf-8')
+        else:
+            self.file = open(self.write_path, mode, encoding='utf-8')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        """flush (a gzip sync point) and fsync: the records written so far survive a crash"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.write_path != self.path:
+            durable_replace(self.write_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _repair(path):
+    """cut an interrupted run's torn last line / truncated gzip member before appending"""
+    if path.endswith('.gz'):
+        errors = []
+        records = list(_read_records(path, errors))
+        if errors:
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as afile:
+                for record in records:
+                    afile.write(json.dumps(record, ensure_ascii=False) + '\n')
+            durable_replace(path + '.tmp', path)
+        return
+
+    with open(path, 'rb+') as afile:
+        end = pos = afile.seek(0, os.SEEK_END)
+        while pos > 0:
+            start = max(0, pos - 65536)
+            afile.seek(start)
+            chunk = afile.read(pos - start)
+            if pos == end and chunk.endswith(b'\n'):
+                return
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                afile.truncate(start + newline + 1)
+                return
+            pos = start
+        afile.truncate(0)
+
+
+def _read_records(path, errors):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as afile:
+        try:
+            for line in afile:
+                if not line.endswith('\n'):
+                    # torn last line of an interrupted run
+                    errors.append(line)
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    errors.append(line)
+                    continue
+                yield record
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            # truncated gzip member of an interrupted run: the records before it are complete
+            errors.append(e)
+
+
+def read_structured(path):
+    """yields the page records of a .jsonl / .jsonl.gz file, up to the last complete one"""
+    yield from _read_records(path, [])
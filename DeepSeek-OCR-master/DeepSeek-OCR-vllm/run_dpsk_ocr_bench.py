@@ -0,0 +1,367 @@
+"""
+Corpus benchmark: runs every stage of the pdf pipeline over a corpus and reports
+per-stage latency percentiles and end-to-end throughput as JSON.
+
+    python run_dpsk_ocr_bench.py --corpus /data/pdfs --max-pages 500
+    python run_dpsk_ocr_bench.py --engine stub --compare OUTPUT_PATH/bench/bench-20250101-120000.json
+
+Stages, per page:
+    rasterize    pdf page -> image at 144 dpi (image files: decode)
+    preprocess   DeepseekOCRProcessor.tokenize_with_images (resize / pad / tiling)
+    queue        added to the engine -> first scheduled
+    encode       first scheduled -> first token: vision encoder + prompt prefill, which vLLM
+                 runs as one forward pass
+    generate     first token -> finished (decode)
+    postprocess  grounding parse, markdown normalization, structured record
+    write        .mmd files, figure crops, structured line and the layout page jpeg
+
+The corpus is INPUT_PATH unless --corpus is given: a .pdf, an image, a directory of them
+or a .txt manifest with one path per line. ENGINE = 'stub' benchmarks everything but
+the model on CPU.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+STAGES = ['rasterize', 'preprocess', 'queue', 'encode', 'generate', 'postprocess', 'write']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DeepSeek-OCR corpus throughput benchmark')
+    parser.add_argument('--corpus', default=config.INPUT_PATH, help='.pdf / image, a directory of them or a .txt manifest')
+    parser.add_argument('--max-pages', type=int, default=0, help='stop after this many pages, 0: whole corpus')
+    parser.add_argument('--engine', choices=['vllm', 'stub'], default=config.ENGINE)
+    parser.add_argument('--output-dir', default=os.path.join(config.OUTPUT_PATH, 'bench'), help='written pages and the results json')
+    parser.add_argument('--results', default='', help='results json path, default: <output-dir>/bench-<time>.json')
+    parser.add_argument('--label', default='', help='free-form run name stored in the results')
+    parser.add_argument('--no-write', action='store_true', help='skip the write stage')
+    parser.add_argument('--compare', default='', help='results json of a previous run to print deltas against')
+    return parser.parse_args()
+
+
+args = parse_args()
+# engine.py reads the engine choice at import time
+config.ENGINE = args.engine
+
+import fitz
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+if torch.version.cuda == '11.8':
+    os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+os.environ['VLLM_USE_V1'] = '0'
+os.environ["CUDA_VISIBLE_DEVICES"] = '0'
+
+from config import PROMPT, MAX_CONCURRENCY, NUM_WORKERS, FIGURE_WORKERS, CROP_MODE, BASE_SIZE, IMAGE_SIZE, MIN_CROPS, MAX_CROPS, STUB_TOKENS_PER_SEC
+
+from engine import build_engine, build_sampling_params
+from metrics import REGISTRY
+from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.image_process import DeepseekOCRProcessor
+from process.checkpoint import atomic_write
+from process.grounding import parse_grounding
+from process.normalize import normalize_markdown
+from process.figures import FigureWriter
+from process.layout_pdf import render_jpeg
+from process.structured import StructuredWriter, page_record
+
+
+def resolve_corpus(input_path):
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, name) for name in os.listdir(input_path)
+                      if name.lower().endswith(('.pdf',) + IMAGE_EXTENSIONS))
+
+    if input_path.endswith('.txt'):
+        with open(input_path, 'r', encoding='utf-8') as afile:
+            return [line.strip() for line in afile if line.strip() and not line.startswith('#')]
+
+    return [input_path]
+
+
+def rasterize(path, dpi=144):
+    """[(image, seconds)] for every page of a pdf, or the one image of an image file"""
+    if path.lower().endswith(IMAGE_EXTENSIONS):
+        start = time.perf_counter()
+        image = Image.open(path).convert('RGB')
+        return [(image, time.perf_counter() - start)]
+
+    Image.MAX_IMAGE_PIXELS = None
+    matrix = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+    pages = []
+    with fitz.open(path) as pdf_document:
+        for page in pdf_document:
+            start = time.perf_counter()
+            image = Image.open(io.BytesIO(page.get_pixmap(matrix=matrix, alpha=False).tobytes("png")))
+            image.load()
+            pages.append((image, time.perf_counter() - start))
+    return pages
+
+
+def preprocess(image):
+    start = time.perf_counter()
+    features = DeepseekOCRProcessor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE)
+    elapsed = time.perf_counter() - start
+    # [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
+    vision_tokens = sum(features[0][5])
+    return {"prompt": PROMPT, "multi_modal_data": {"image": features}}, elapsed, vision_tokens
+
+
+def iter_pages(paths, executor, max_pages):
+    """yields (path, page_idx, image, rasterize seconds, preprocess future); rasterizes one document ahead"""
+    num_pages = 0
+    pending = None
+    for path in paths + [None]:
+        future = executor.submit(rasterize, path) if path is not None else None
+        if pending is not None:
+            pending_path, pending_future = pending
+            for page_idx, (image, seconds) in enumerate(pending_future.result()):
+                if max_pages and num_pages >= max_pages:
+                    return
+                num_pages += 1
+                yield pending_path, page_idx, image, seconds, executor.submit(preprocess, image)
+        pending = (path, future)
+
+
+def request_stage_times(output):
+    """queue / encode / generate from the engine's request metrics"""
+    metrics = output.metrics
+    scheduled = metrics.first_scheduled_time
+    return {
+        'queue': scheduled - metrics.arrival_time,
+        'encode': metrics.first_token_time - scheduled,
+        'generate': metrics.finished_time - metrics.first_token_time,
+    }
+
+
+class PageSink:
+    """post-processes and writes finished pages the way run_dpsk_ocr_pdf.py does; runs on one thread"""
+
+    def __init__(self, output_dir, figure_pool, write=True):
+        self.output_dir = output_dir
+        self.figure_pool = figure_pool
+        self.write = write
+        self.figures = {}
+        self.structured = StructuredWriter(os.path.join(output_dir, 'pages.jsonl')) if write else None
+
+    def finish(self, path, page_idx, image, content):
+        start = time.perf_counter()
+        grounding = parse_grounding(content.replace('<｜end▁of▁sentence｜>', ''))
+        record = page_record(page_idx, grounding, *image.size, source=path)
+        # figures are written without dedup below, so these are the links they get
+        markdown = grounding.markdown(lambda idx: f'images/{page_idx}_{idx}.jpg')
+        if grounding.other_records:
+            markdown = normalize_markdown(markdown, macros=True, newlines=True)
+        postprocess = time.perf_counter() - start
+
+        if not self.write:
+            return {'postprocess': postprocess}
+
+        start = time.perf_counter()
+        stem = os.path.splitext(os.path.basename(path))[0]
+        output_dir = os.path.join(self.output_dir, stem)
+        figures = self.figures.get(path)
+        if figures is None:
+            figures = self.figures[path] = FigureWriter(self.figure_pool, output_dir, dedup=False)
+        manifest = figures.submit(image, grounding.records, page_idx).result()
+        atomic_write(os.path.join(output_dir, f'{page_idx}_det.mmd'), content)
+        atomic_write(os.path.join(output_dir, f'{page_idx}.mmd'), markdown)
+        record['figures'] = manifest
+        self.structured.write(record)
+        jpeg_bytes, _ = render_jpeg(image, grounding.records)
+        with open(os.path.join(output_dir, f'{page_idx}_layout.jpg'), 'wb') as afile:
+            afile.write(jpeg_bytes)
+        return {'postprocess': postprocess, 'write': time.perf_counter() - start}
+
+    def close(self):
+        if self.structured:
+            self.structured.close()
+
+
+def summarize(seconds):
+    if not seconds:
+        return None
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'count': int(values.size),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(values.max()), 3),
+        'total_s': round(float(values.sum()) / 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(paths):
+    llm = build_engine(
+        swap_space=0,
+        max_num_seqs=MAX_CONCURRENCY,
+        gpu_memory_utilization=0.9,
+    )
+    sampling_params = build_sampling_params(
+        temperature=0.0,
+        max_tokens=8192,
+        logits_processors=[NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids={128821, 128822})],
+        skip_special_tokens=False,
+        include_stop_str_in_output=True,
+    )
+
+    stages = {stage: [] for stage in STAGES}
+    vision_tokens = []
+    prompt_tokens = []
+    output_tokens = []
+    num_no_eos = 0
+
+    window = MAX_CONCURRENCY * 2
+    in_flight = {}
+    prepared = deque()
+    finishing = []
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor, \
+            ThreadPoolExecutor(max_workers=1) as writer, \
+            ThreadPoolExecutor(max_workers=FIGURE_WORKERS) as figure_pool, \
+            tqdm(total=args.max_pages or None, desc='Pages') as progress:
+
+        sink = PageSink(args.output_dir, figure_pool, write=not args.no_write)
+        pages = iter_pages(paths, executor, args.max_pages)
+        exhausted = False
+        num_requests = 0
+
+        while True:
+            while not exhausted and len(prepared) < window:
+                item = next(pages, None)
+                if item is None:
+                    exhausted = True
+                else:
+                    prepared.append(item)
+
+            while prepared and len(in_flight) < window:
+                path, page_idx, image, rasterize_s, future = prepared.popleft()
+                request, preprocess_s, num_vision_tokens = future.result()
+                stages['rasterize'].append(rasterize_s)
+                stages['preprocess'].append(preprocess_s)
+                vision_tokens.append(num_vision_tokens)
+
+                request_id = str(num_requests)
+                num_requests += 1
+                llm.add_request(request_id, request, sampling_params)
+                in_flight[request_id] = (path, page_idx, image)
+
+            if not in_flight:
+                break
+
+            for output in llm.step():
+                if not output.finished:
+                    continue
+                path, page_idx, image = in_flight.pop(output.request_id)
+                for stage, seconds in request_stage_times(output).items():
+                    stages[stage].append(seconds)
+                content = output.outputs[0].text
+                prompt_tokens.append(len(output.prompt_token_ids or []))
+                output_tokens.append(len(output.outputs[0].token_ids))
+                if '<｜end▁of▁sentence｜>' not in content:
+                    num_no_eos += 1
+                finishing.append(writer.submit(sink.finish, path, page_idx, image, content))
+                progress.update(1)
+
+        for future in finishing:
+            for stage, seconds in future.result().items():
+                stages[stage].append(seconds)
+        sink.close()
+
+    wall = time.perf_counter() - start
+    num_pages = len(output_tokens)
+
+    return {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                 'gpu': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None},
+        'config': {
+            'engine': config.ENGINE,
+            'base_size': BASE_SIZE,
+            'image_size': IMAGE_SIZE,
+            'crop_mode': CROP_MODE,
+            'min_crops': MIN_CROPS,
+            'max_crops': MAX_CROPS,
+            'max_concurrency': MAX_CONCURRENCY,
+            'num_workers': NUM_WORKERS,
+            'stub_tokens_per_sec': STUB_TOKENS_PER_SEC if config.ENGINE == 'stub' else None,
+            'prompt': PROMPT,
+            'write': not args.no_write,
+        },
+        'corpus': {'path': args.corpus, 'files': len(paths), 'pages': num_pages, 'pages_without_eos': num_no_eos},
+        'wall_s': round(wall, 3),
+        'pages_per_s': round(num_pages / wall, 3) if wall else None,
+        'output_tokens_per_s': round(sum(output_tokens) / wall, 1) if wall else None,
+        'vision_tokens_per_page': round(float(np.mean(vision_tokens)), 1) if vision_tokens else None,
+        'prompt_tokens_per_page': round(float(np.mean(prompt_tokens)), 1) if prompt_tokens else None,
+        'output_tokens_per_page': round(float(np.mean(output_tokens)), 1) if output_tokens else None,
+        'stages': {stage: summarize(seconds) for stage, seconds in stages.items()},
+        # vision tokens / tiles / encoder stage histograms recorded by the model and processor
+        'metrics': REGISTRY.to_dict(),
+    }
+
+
+def print_results(results, previous=None):
+    def delta(key_path, current):
+        if previous is None or current is None:
+            return ''
+        value = previous
+        for key in key_path:
+            value = (value or {}).get(key)
+        if not value:
+            return ''
+        return f' ({(current - value) / value:+.1%})'
+
+    print(f"{results['corpus']['pages']} pages in {results['wall_s']:.1f}s: "
+          f"{results['pages_per_s']} pages/s{delta(['pages_per_s'], results['pages_per_s'])}, "
+          f"{results['output_tokens_per_s']} output tokens/s{delta(['output_tokens_per_s'], results['output_tokens_per_s'])}, "
+          f"{results['vision_tokens_per_page']} vision tokens/page")
+    print(f'{"stage":<12} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"total s":>9}')
+    for stage, summary in results['stages'].items():
+        if summary is None:
+            continue
+        print(f'{stage:<12} {summary["p50_ms"]:>10.2f} {summary["p95_ms"]:>10.2f} {summary["p99_ms"]:>10.2f} {summary["total_s"]:>9.2f}'
+              f'{delta(["stages", stage, "p50_ms"], summary["p50_ms"])}')
+
+
+if __name__ == "__main__":
+
+    paths = [os.path.abspath(path) for path in resolve_corpus(args.corpus)]
+
+    results = run_benchmark(paths)
+
+    results_path = args.results or os.path.join(args.output_dir, f'bench-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    atomic_write(results_path, json.dumps(results, indent=2, ensure_ascii=False))
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as afile:
+            previous = json.load(afile)
+    print_results(results, previous)
+    print(results_path)
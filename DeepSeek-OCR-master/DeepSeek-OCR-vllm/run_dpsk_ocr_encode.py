@@ -0,0 +1,219 @@
+"""
+Encode-only runner: the vision encoder (SAM-B + CLIP-L + projector) without vLLM or the
+language model, so pages can be encoded on their own GPU / CPU workers and decoded
+elsewhere from the saved embeddings.
+
+    python run_dpsk_ocr_encode.py --corpus /data/pdfs --output-dir /data/embeds
+    python run_dpsk_ocr_encode.py --corpus /data/pdfs --device cpu --quantize dynamic
+    python run_dpsk_ocr_encode.py --decode /data/embeds
+
+Every page is saved as <output-dir>/<name>_<path hash>_<page>.npy, its
+[num_image_tokens, 1280] global_local_features in float16 (numpy has no bfloat16), and
+listed in <output-dir>/index.jsonl; pages already listed there are skipped when the
+encoder is run again. --decode memory-maps them and passes each page to vLLM as
+{"image": embeds} multi_modal_data: the model merges them at the image tokens and skips
+SAM / CLIP-L. Embeddings depend on BASE_SIZE / IMAGE_SIZE / CROP_MODE, which are stored
+in the index and checked before decoding.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from collections import deque
+
+import config
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DeepSeek-OCR encode-only runner')
+    parser.add_argument('--corpus', default=config.INPUT_PATH, help='.pdf / image or a directory of them')
+    parser.add_argument('--output-dir', default=os.path.join(config.OUTPUT_PATH, 'embeds'))
+    parser.add_argument('--model', default=config.MODEL_PATH, help='checkpoint directory or repo id')
+    parser.add_argument('--device', default=None, help='default: cuda if available')
+    parser.add_argument('--quantize', choices=['', 'dynamic', 'weight'], default='',
+                        help="int8 linears (deepencoder/quantize.py); 'dynamic' needs --device cpu")
+    parser.add_argument('--max-pages', type=int, default=0, help='stop after this many pages, 0: whole corpus')
+    parser.add_argument('--decode', default='', help='decode the embeddings in this directory instead of encoding')
+    return parser.parse_args()
+
+
+args = parse_args()
+
+import fitz
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+if torch.version.cuda == '11.8':
+    os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+os.environ['VLLM_USE_V1'] = '0'
+os.environ["CUDA_VISIBLE_DEVICES"] = '0'
+
+from config import PROMPT, CROP_MODE, BASE_SIZE, IMAGE_SIZE, MAX_CONCURRENCY
+
+from process.image_process import DeepseekOCRProcessor, normalize_pixels
+from process.checkpoint import atomic_write
+from process.grounding import parse_grounding
+from process.normalize import normalize_markdown
+
+
+def resolve_inputs(input_path):
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, name) for name in os.listdir(input_path)
+                      if name.lower().endswith(('.pdf',) + IMAGE_EXTENSIONS))
+    return [input_path]
+
+
+def iter_images(path, dpi=144):
+    """pages of a pdf, same rasterization as run_dpsk_ocr_pdf.py, or the one image of an image file"""
+    if path.lower().endswith(IMAGE_EXTENSIONS):
+        yield Image.open(path).convert('RGB')
+        return
+
+    Image.MAX_IMAGE_PIXELS = None
+    matrix = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+    with fitz.open(path) as pdf_document:
+        for page in pdf_document:
+            yield Image.open(io.BytesIO(page.get_pixmap(matrix=matrix, alpha=False).tobytes("png"))).convert('RGB')
+
+
+def save_embeds(path, embeds):
+    """writes a float16 .npy that np.load(path, mmap_mode='r') maps without reading it"""
+    tmp_path = path + '.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=tuple(embeds.shape))
+    array[:] = embeds.float().cpu().numpy()
+    array.flush()
+    del array
+    os.replace(tmp_path, path)
+
+
+def embeds_name(path):
+    """file name stem of a document's pages: a.pdf and b/a.pdf, a.pdf and a.png don't collide"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return f'{name}_{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:10]}'
+
+
+def encode_corpus(paths, output_dir):
+    from deepencoder.stages import DeepEncoder
+
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+    encoder = DeepEncoder.from_pretrained(args.model).to(device, dtype).eval()
+    if args.quantize:
+        from deepencoder.quantize import quantize_encoder
+
+        encoder = quantize_encoder(encoder, args.quantize)
+
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, 'index.jsonl')
+    # pages encoded by an earlier run
+    done = {entry['file'] for entry in load_index(output_dir)} if os.path.exists(index_path) else set()
+    mode = {'base_size': BASE_SIZE, 'image_size': IMAGE_SIZE, 'crop_mode': CROP_MODE}
+    num_pages = 0
+    start = time.perf_counter()
+    with open(index_path, 'a', encoding='utf-8') as index, torch.no_grad():
+        for path in tqdm(paths, desc='Documents'):
+            if args.max_pages and num_pages >= args.max_pages:
+                break
+            name = embeds_name(path)
+            for page_idx, image in enumerate(iter_images(path)):
+                file_name = f'{name}_{page_idx}.npy'
+                if file_name in done:
+                    continue
+                features = DeepseekOCRProcessor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE)
+                _, pixel_values, images_crop, _, images_spatial_crop, num_image_tokens, _ = features[0]
+                num_width_tiles, num_height_tiles = images_spatial_crop[0].tolist()
+                crops = None
+                if num_width_tiles > 1 or num_height_tiles > 1:
+                    crops = normalize_pixels(images_crop[0].to(device), dtype)
+
+                embeds = encoder.encode_image(normalize_pixels(pixel_values.to(device), dtype), crops,
+                                              (num_width_tiles, num_height_tiles))
+                assert embeds.shape[0] == num_image_tokens[0], (embeds.shape, num_image_tokens)
+
+                save_embeds(os.path.join(output_dir, file_name), embeds)
+                index.write(json.dumps(dict(mode, source=path, page=page_idx, file=file_name,
+                                            num_image_tokens=int(embeds.shape[0]), page_size=list(image.size))) + '\n')
+                index.flush()
+                done.add(file_name)
+                num_pages += 1
+                if args.max_pages and num_pages >= args.max_pages:
+                    break
+
+    elapsed = time.perf_counter() - start
+    print(f'encoded {num_pages} pages in {elapsed:.1f}s ({num_pages / max(elapsed, 1e-9):.2f} pages/s) -> {output_dir}')
+
+
+def load_index(embeds_dir):
+    with open(os.path.join(embeds_dir, 'index.jsonl'), 'r', encoding='utf-8') as afile:
+        entries = {}
+        for line in afile:
+            if line.strip():
+                entry = json.loads(line)
+                # the last entry of a file wins (an index from before pages were skipped)
+                entries[entry['file']] = entry
+        entries = list(entries.values())
+    for entry in entries:
+        if (entry['base_size'], entry['image_size'], entry['crop_mode']) != (BASE_SIZE, IMAGE_SIZE, CROP_MODE):
+            raise ValueError(f"{entry['file']} was encoded with base_size={entry['base_size']} image_size={entry['image_size']} "
+                             f"crop_mode={entry['crop_mode']}, config.py has {BASE_SIZE} / {IMAGE_SIZE} / {CROP_MODE}")
+    return entries
+
+
+def embeds_request(embeds_dir, entry):
+    """vLLM request for one encoded page; the file is only read here, one window at a time"""
+    embeds = np.load(os.path.join(embeds_dir, entry['file']), mmap_mode='r')
+    # [num_images=1, num_image_tokens, n_embed]: parsed by vLLM as ImageEmbeddingItems
+    return {"prompt": PROMPT, "multi_modal_data": {"image": torch.from_numpy(np.array(embeds))[None]}}
+
+
+def decode_corpus(embeds_dir):
+    from engine import build_engine, build_sampling_params
+    from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+
+    if '<image>' not in PROMPT:
+        raise ValueError('PROMPT has no <image> token to place the embeddings at')
+    entries = load_index(embeds_dir)
+    llm = build_engine(max_num_seqs=MAX_CONCURRENCY, gpu_memory_utilization=0.9)
+    sampling_params = build_sampling_params(
+        temperature=0.0,
+        max_tokens=8192,
+        logits_processors=[NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids={128821, 128822})],
+        skip_special_tokens=False,
+    )
+
+    pending = deque(entries)
+    in_flight = {}
+    num_requests = 0
+    with tqdm(total=len(entries), desc='Pages') as progress:
+        while pending or in_flight:
+            while pending and len(in_flight) < MAX_CONCURRENCY * 2:
+                entry = pending.popleft()
+                request_id = str(num_requests)
+                num_requests += 1
+                llm.add_request(request_id, embeds_request(embeds_dir, entry), sampling_params)
+                in_flight[request_id] = entry
+
+            for output in llm.step():
+                if not output.finished:
+                    continue
+                name = os.path.splitext(in_flight.pop(output.request_id)['file'])[0]
+                content = output.outputs[0].text
+                grounding = parse_grounding(content)
+                has_records = bool(grounding.records)
+                cleaned = normalize_markdown(grounding.markdown(), formulas=True, newlines=has_records, center=has_records)
+                atomic_write(os.path.join(embeds_dir, name + '_det.mmd'), content)
+                atomic_write(os.path.join(embeds_dir, name + '.mmd'), cleaned)
+                progress.update(1)
+
+
+if __name__ == "__main__":
+    if args.decode:
+        decode_corpus(args.decode)
+    else:
+        encode_corpus(resolve_inputs(args.corpus), args.output_dir)
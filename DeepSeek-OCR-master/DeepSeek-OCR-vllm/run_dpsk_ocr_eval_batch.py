@@ -1,5 +1,4 @@
 import os
-import re
 from tqdm import tqdm
 import torch
 if torch.version.cuda == '11.8':
@@ -7,36 +6,32 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS, CHECKPOINT, RESUME, STRUCTURED_OUTPUT, COLUMNAR_OUTPUT, BASE_SIZE, IMAGE_SIZE, METRICS
 from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import glob
 from PIL import Image
-from deepseek_ocr import DeepseekOCRForCausalLM
 
-from vllm.model_executor.models.registry import ModelRegistry
-
-from vllm import LLM, SamplingParams
+from engine import build_engine, build_sampling_params
+from metrics import REGISTRY, PAGES, page_status
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
-ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+from process.checkpoint import PageJournal, atomic_write
+from process.grounding import parse_grounding
+from process.normalize import normalize_markdown
+from process.structured import StructuredWriter, page_record, structured_path
+from process.columnar import ColumnarWriter, next_part_path, result_row
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
+llm = build_engine(
     swap_space=0,
     max_num_seqs = MAX_CONCURRENCY,
-    tensor_parallel_size=1,
     gpu_memory_utilization=0.9,
 )
 
 logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
 
-sampling_params = SamplingParams(
+sampling_params = build_sampling_params(
     temperature=0.0,
     max_tokens=8192,
     logits_processors=logits_processors,
@@ -50,34 +45,6 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
-def clean_formula(text):
-
-    formula_pattern = r'\\\[(.*?)\\\]'
-    
-    def process_formula(match):
-        formula = match.group(1)
-
-        formula = re.sub(r'\\quad\s*\([^)]*\)', '', formula)
-        
-        formula = formula.strip()
-        
-        return r'\[' + formula + r'\]'
-
-    cleaned_text = re.sub(formula_pattern, process_formula, text)
-    
-    return cleaned_text
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    # mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        mathes_other.append(a_match[0])
-    return matches, mathes_other
-
 def process_single_image(image):
     """single image"""
     prompt_in = prompt
@@ -88,74 +55,141 @@ def process_single_image(image):
     return cache_item
 
 
-if __name__ == "__main__":
-
-    # INPUT_PATH = OmniDocBench images path
-
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-
-    # print('image processing until processing prompts.....')
-
-    print(f'{Colors.RED}glob images.....{Colors.RESET}')
+def load_and_process_image(image_path):
+    image = Image.open(image_path).convert('RGB')
+    return process_single_image(image), image.size
 
-    images_path = glob.glob(f'{INPUT_PATH}/*')
 
-    images = []
+def clean_result(content):
+    grounding = parse_grounding(content)
+    has_records = bool(grounding.records)
+    content = normalize_markdown(grounding.markdown(), formulas=True, newlines=has_records, center=has_records)
+    return grounding, content
 
-    for image_path in images_path:
-        image = Image.open(image_path).convert('RGB')
-        images.append(image)
 
-    prompt = PROMPT
+def write_result(image, content, cleaned):
 
-    # batch_inputs = []
-
-
-    # for image in tqdm(images):
+    output_path = OUTPUT_PATH
 
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": Image.open(image).convert('RGB')},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
+    mmd_det_path = output_path + image.split('/')[-1].replace('.jpg', '_det.md')
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+    atomic_write(mmd_det_path, content)
 
+    mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
 
-    
+    atomic_write(mmd_path, cleaned)
 
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
 
+if __name__ == "__main__":
 
-    output_path = OUTPUT_PATH
+    # INPUT_PATH = OmniDocBench images path
 
-    os.makedirs(output_path, exist_ok=True)
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
 
-    for output, image in zip(outputs_list, images_path):
+    # print('image processing until processing prompts.....')
 
-        content = output.outputs[0].text
-        mmd_det_path = output_path + image.split('/')[-1].replace('.jpg', '_det.md')
+    print(f'{Colors.RED}glob images.....{Colors.RESET}')
 
-        with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-            afile.write(content)
+    images_path = sorted(glob.glob(f'{INPUT_PATH}/*'))
+
+    journal = None
+    if CHECKPOINT:
+        # an image is finished once both of its .md files are written
+        journal = PageJournal(f'{OUTPUT_PATH}/journal.jsonl', resume=RESUME)
+        num_images = len(images_path)
+        images_path = [image_path for image_path in images_path if not journal.is_finalized(image_path)]
+        if journal.replayed:
+            print(f'{Colors.YELLOW}resuming from {journal.path}: {num_images - len(images_path)} images already done '
+                  f'(RESUME = False starts over){Colors.RESET}')
+
+    structured = None
+    if STRUCTURED_OUTPUT:
+        # one file for the whole run instead of one more small file per image. With the
+        # journal it is written in place and synced before an image is finalized; only a run
+        # that resumes results of the same signature appends to it, any other starts it over
+        structured = StructuredWriter(structured_path(f'{OUTPUT_PATH}/results', STRUCTURED_OUTPUT),
+                                      append=bool(journal and journal.replayed), in_place=bool(journal))
+
+    columnar = None
+    # structured records of images whose row group is not on disk yet, {image_path: record}
+    undurable_records = {}
+    if COLUMNAR_OUTPUT:
+        # with the columnar sink an image is finished once its row group is on disk; its
+        # structured record is written then too, so a crash loses neither or both
+        def finalize(keys):
+            if structured:
+                for key in keys:
+                    structured.write(undurable_records.pop(key))
+                if journal:
+                    structured.sync()
+            if journal:
+                journal.mark_finalized(*keys)
+
+        columnar = ColumnarWriter(next_part_path(f'{OUTPUT_PATH}/results', COLUMNAR_OUTPUT), COLUMNAR_OUTPUT,
+                                  on_durable=finalize if journal or structured else None)
+    mode = f'{BASE_SIZE}/{IMAGE_SIZE}/{"crop" if CROP_MODE else "nocrop"}'
 
-        content = clean_formula(content)
-        matches_ref, mathes_other = re_match(content)
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
-        
-        mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
+    prompt = PROMPT
 
-        with open(mmd_path, 'w', encoding='utf-8') as afile:
-            afile.write(content)
+    # images are loaded lazily on the pre-process workers and results are written as they
+    # finish, so a crash only loses the requests that were in flight
+    window = MAX_CONCURRENCY * 2
+
+    in_flight = {}
+    prepared = deque()
+    pending_paths = iter(images_path)
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor, \
+            tqdm(total=len(images_path), desc="Images") as progress:
+
+        while True:
+            while len(prepared) < window:
+                image_path = next(pending_paths, None)
+                if image_path is None:
+                    break
+                prepared.append((image_path, executor.submit(load_and_process_image, image_path)))
+
+            while prepared and len(in_flight) < window:
+                image_path, future = prepared.popleft()
+                request, image_size = future.result()
+                llm.add_request(image_path, request, sampling_params)
+                in_flight[image_path] = image_size
+
+            if not in_flight:
+                break
+
+            # finished this step; the structured file and the journal are synced once per step
+            finished = []
+            for output in llm.step():
+                if not output.finished:
+                    continue
+                image_path = output.request_id
+                image_size = in_flight.pop(image_path)
+                PAGES.inc(status=page_status(output.outputs[0]))
+                content = output.outputs[0].text
+                grounding, cleaned = clean_result(content)
+                record = page_record(0, grounding, *image_size, source=image_path) if structured else None
+                if columnar:
+                    if structured:
+                        undurable_records[image_path] = record
+                    columnar.append(image_path, result_row(image_path, output, cleaned, grounding, mode))
+                else:
+                    if structured:
+                        structured.write(record)
+                    write_result(image_path, content, cleaned)
+                    finished.append(image_path)
+                progress.update(1)
+
+            if journal and finished:
+                if structured:
+                    structured.sync()
+                journal.mark_finalized(*finished)
+
+    if columnar:
+        columnar.close()
+    if structured:
+        structured.close()
+    if journal:
+        journal.close()
+    if METRICS:
+        REGISTRY.dump(f'{OUTPUT_PATH}/metrics.json')
@@ -1,5 +1,5 @@
+import ast
 import asyncio
-import re
 import os
 
 import torch
@@ -9,22 +9,21 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from vllm import AsyncLLMEngine, SamplingParams
-from vllm.engine.arg_utils import AsyncEngineArgs
-from vllm.model_executor.models.registry import ModelRegistry
 import time
-from deepseek_ocr import DeepseekOCRForCausalLM
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-import numpy as np
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from engine import build_async_engine, build_sampling_params
+from PIL import Image, ImageOps
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
+from process.grounding import IncrementalGroundingParser
+from process.normalize import normalize_markdown
+from process.render import draw_layout
+from process.figures import FORMATS, FigureWriter, figure_link
+from process.structured import StructuredWriter, page_record, structured_path
+from config import INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, STRUCTURED_OUTPUT, FIGURE_FORMAT, FIGURE_QUALITY, FIGURE_DEDUP, FIGURE_WORKERS
 
 
 
-ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
-
 def load_image(image_path):
 
     try:
@@ -42,126 +41,27 @@ def load_image(image_path):
             return None
 
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
+def parse_geometry(outputs):
+    """the geometry prompt answers with a python literal; parse it once, never eval it"""
     try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
+        geometry = ast.literal_eval(outputs)
+        missing = {'line', 'line_type', 'line_endpoint'} - set(geometry['Line'])
+        if missing:
+            raise KeyError(f'Line is missing {sorted(missing)}')
+    except (ValueError, SyntaxError, TypeError, KeyError, MemoryError, RecursionError) as e:
+        print(f'malformed geometry output: {e!r}')
         return None
-
-    return (label_type, cor_list)
-
-
-def draw_bounding_boxes(image, refs):
-
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
-
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-    
-    #     except IOError:
-    font = ImageFont.load_default()
-
-    img_idx = 0
-    
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
-                
-                color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-
-                color_a = color + (20, )
-                for points in points_list:
-                    x1, y1, x2, y2 = points
-
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
-                    try:
-                        if label_type == 'title':
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                        else:
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-
-                        text_x = x1
-                        text_y = max(0, y1 - 15)
-                            
-                        text_bbox = draw.textbbox((0, 0), label_type, font=font)
-                        text_width = text_bbox[2] - text_bbox[0]
-                        text_height = text_bbox[3] - text_bbox[1]
-                        draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height], 
-                                    fill=(255, 255, 255, 30))
-                        
-                        draw.text((text_x, text_y), label_type, font=font, fill=color)
-                    except:
-                        pass
-        except:
-            continue
-    img_draw.paste(overlay, (0, 0), overlay)
-    return img_draw
-
-
-def process_image_with_refs(image, ref_texts):
-    result_image = draw_bounding_boxes(image, ref_texts)
-    return result_image
-
-
+    return geometry
 
 
 async def stream_generate(image=None, prompt=''):
 
 
-    engine_args = AsyncEngineArgs(
-        model=MODEL_PATH,
-        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-        block_size=256,
-        max_model_len=8192,
-        enforce_eager=False,
-        trust_remote_code=True,  
-        tensor_parallel_size=1,
-        gpu_memory_utilization=0.75,
-    )
-    engine = AsyncLLMEngine.from_engine_args(engine_args)
+    engine = build_async_engine(gpu_memory_utilization=0.75)
     
     logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
 
-    sampling_params = SamplingParams(
+    sampling_params = build_sampling_params(
         temperature=0.0,
         max_tokens=8192,
         logits_processors=logits_processors,
@@ -185,18 +85,43 @@ async def stream_generate(image=None, prompt=''):
         }
     else:
         assert False, f'prompt is none!!!'
+    # post-process while the model is still generating: markdown is printed as it is
+    # known to be outside a grounding span, boxes as soon as their <|/det|> arrives
+    parser = IncrementalGroundingParser()
+    start = time.perf_counter()
+    first_token_latency = first_box_latency = None
     async for request_output in engine.generate(
         request, sampling_params, request_id
     ):
         if request_output.outputs:
             full_text = request_output.outputs[0].text
             new_text = full_text[printed_length:]
-            print(new_text, end='', flush=True)
             printed_length = len(full_text)
             final_output = full_text
-    print('\n') 
+            if new_text and first_token_latency is None:
+                first_token_latency = time.perf_counter() - start
+            events = parser.feed(new_text)
+            if first_box_latency is None and any(event[0] == 'record' for event in events):
+                first_box_latency = time.perf_counter() - start
+            print_events(events)
+    print_events(parser.close())
+    print('\n')
+    if first_token_latency is not None:
+        print(f'first token: {first_token_latency:.2f}s, first box: '
+              + (f'{first_box_latency:.2f}s' if first_box_latency is not None else '-')
+              + f', total: {time.perf_counter() - start:.2f}s')
+
+    return final_output, parser.result()
+
 
-    return final_output
+def print_events(events):
+    for event in events:
+        if event[0] == 'text':
+            print(event[1], end='', flush=True)
+        elif event[0] == 'record':
+            record = event[1]
+            boxes = record.det if record.boxes is None else record.boxes.astype(int).tolist()
+            print(f'[{record.label}: {boxes}]', end='', flush=True)
 
 
 
@@ -217,7 +142,7 @@ if __name__ == "__main__":
 
     prompt = PROMPT
 
-    result_out = asyncio.run(stream_generate(image_features, prompt))
+    result_out, grounding = asyncio.run(stream_generate(image_features, prompt))
 
 
     save_results = 1
@@ -232,31 +157,39 @@ if __name__ == "__main__":
         with open(f'{OUTPUT_PATH}/result_ori.mmd', 'w', encoding = 'utf-8') as afile:
             afile.write(outputs)
 
-        matches_ref, matches_images, mathes_other = re_match(outputs)
-        # print(matches_ref)
-        result = process_image_with_refs(image_draw, matches_ref)
+        for error in grounding.errors:
+            print(f'malformed boxes, {error}')
+        with ThreadPoolExecutor(max_workers=FIGURE_WORKERS) as figure_pool:
+            figures = FigureWriter(figure_pool, OUTPUT_PATH, fmt=FIGURE_FORMAT, quality=FIGURE_QUALITY, dedup=FIGURE_DEDUP)
+            manifest = figures.submit(image, grounding.records)
+            result = draw_layout(image_draw, grounding.records)
+            manifest = manifest.result()
 
+        if STRUCTURED_OUTPUT:
+            with StructuredWriter(structured_path(f'{OUTPUT_PATH}/result', STRUCTURED_OUTPUT)) as structured:
+                structured.write(page_record(0, grounding, *image.size, source=INPUT_PATH, figures=manifest))
 
-        for idx, a_match_image in enumerate(tqdm(matches_images, desc="image")):
-            outputs = outputs.replace(a_match_image, f'![](images/' + str(idx) + '.jpg)\n')
 
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            outputs = outputs.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+        outputs = grounding.markdown(figure_link(manifest, lambda idx: f'images/{idx}{FORMATS[FIGURE_FORMAT][1]}'))
+
+        if grounding.other_records:
+            outputs = normalize_markdown(outputs, macros=True)
 
         # if 'structural formula' in conversation[0]['content']:
         #     outputs = '<smiles>' + outputs + '</smiles>'
         with open(f'{OUTPUT_PATH}/result.mmd', 'w', encoding = 'utf-8') as afile:
             afile.write(outputs)
 
-        if 'line_type' in outputs:
+        geometry = parse_geometry(outputs) if 'line_type' in outputs else None
+
+        if geometry is not None:
             import matplotlib.pyplot as plt
             from matplotlib.patches import Circle
-            lines = eval(outputs)['Line']['line']
+            lines = geometry['Line']['line']
 
-            line_type = eval(outputs)['Line']['line_type']
-            # print(lines)
+            line_type = geometry['Line']['line_type']
 
-            endpoints = eval(outputs)['Line']['line_endpoint']
+            endpoints = geometry['Line']['line_endpoint']
 
             fig, ax = plt.subplots(figsize=(3,3), dpi=200)
             ax.set_xlim(-15, 15)
@@ -264,8 +197,8 @@ if __name__ == "__main__":
 
             for idx, line in enumerate(lines):
                 try:
-                    p0 = eval(line.split(' -- ')[0])
-                    p1 = eval(line.split(' -- ')[-1])
+                    p0 = ast.literal_eval(line.split(' -- ')[0])
+                    p1 = ast.literal_eval(line.split(' -- ')[-1])
 
                     if line_type[idx] == '--':
                         ax.plot([p0[0], p1[0]], [p0[1], p1[1]], linewidth=0.8, color='k')
@@ -274,27 +207,31 @@ if __name__ == "__main__":
 
                     ax.scatter(p0[0], p0[1], s=5, color = 'k')
                     ax.scatter(p1[0], p1[1], s=5, color = 'k')
-                except:
-                    pass
+                except (ValueError, SyntaxError, TypeError, IndexError) as e:
+                    print(f'malformed line {line!r}: {e}')
 
             for endpoint in endpoints:
 
                 label = endpoint.split(': ')[0]
-                (x, y) = eval(endpoint.split(': ')[1])
+                try:
+                    (x, y) = ast.literal_eval(endpoint.split(': ')[1])
+                except (ValueError, SyntaxError, TypeError, IndexError) as e:
+                    print(f'malformed endpoint {endpoint!r}: {e}')
+                    continue
                 ax.annotate(label, (x, y), xytext=(1, 1), textcoords='offset points', 
                             fontsize=5, fontweight='light')
             
             try:
-                if 'Circle' in eval(outputs).keys():
-                    circle_centers = eval(outputs)['Circle']['circle_center']
-                    radius = eval(outputs)['Circle']['radius']
+                if 'Circle' in geometry.keys():
+                    circle_centers = geometry['Circle']['circle_center']
+                    radius = geometry['Circle']['radius']
 
                     for center, r in zip(circle_centers, radius):
-                        center = eval(center.split(': ')[1])
+                        center = ast.literal_eval(center.split(': ')[1])
                         circle = Circle(center, radius=r, fill=False, edgecolor='black', linewidth=0.8)
                         ax.add_patch(circle)
-            except:
-                pass
+            except (ValueError, SyntaxError, TypeError, KeyError, IndexError) as e:
+                print(f'malformed circle: {e}')
 
 
             plt.savefig(f'{OUTPUT_PATH}/geo.jpg')
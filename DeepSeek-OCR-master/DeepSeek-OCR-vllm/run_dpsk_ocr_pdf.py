@@ -1,8 +1,8 @@
 import os
 import fitz
-import img2pdf
 import io
-import re
+import glob
+from collections import Counter, deque
 from tqdm import tqdm
 import torch
 from concurrent.futures import ThreadPoolExecutor
@@ -14,38 +14,31 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, SAVE_LAYOUT_PDF, STRUCTURED_OUTPUT, FIGURE_FORMAT, FIGURE_QUALITY, FIGURE_DEDUP, FIGURE_WORKERS, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, CHECKPOINT, RESUME, METRICS
 
-from PIL import Image, ImageDraw, ImageFont
-import numpy as np
-from deepseek_ocr import DeepseekOCRForCausalLM
+from PIL import Image
 
-from vllm.model_executor.models.registry import ModelRegistry
-
-from vllm import LLM, SamplingParams
+from engine import build_engine, build_sampling_params
+from metrics import REGISTRY, PAGES, page_status
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
-
-ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+from process.checkpoint import PageJournal, atomic_write
+from process.grounding import parse_grounding
+from process.normalize import normalize_markdown
+from process.figures import FORMATS, FigureWriter, figure_link
+from process.layout_pdf import write_layout_pdf
+from process.structured import StructuredWriter, page_record, structured_path
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
+llm = build_engine(
     swap_space=0,
     max_num_seqs=MAX_CONCURRENCY,
-    tensor_parallel_size=1,
     gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
 )
 
 logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
 
-sampling_params = SamplingParams(
+sampling_params = build_sampling_params(
     temperature=0.0,
     max_tokens=8192,
     logits_processors=logits_processors,
@@ -54,6 +47,9 @@ sampling_params = SamplingParams(
 )
 
 
+PAGES_DROPPED = REGISTRY.counter('ocr_pages_dropped_total', 'pages left out of the .mmd by SKIP_REPEAT (no eos)')
+
+
 class Colors:
     RED = '\033[31m'
     GREEN = '\033[32m'
@@ -94,132 +90,6 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
     pdf_document.close()
     return images
 
-def pil_to_pdf_img2pdf(pil_images, output_path):
-
-    if not pil_images:
-        return
-    
-    image_bytes_list = []
-    
-    for img in pil_images:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
-    
-    try:
-        pdf_bytes = img2pdf.convert(image_bytes_list)
-        with open(output_path, "wb") as f:
-            f.write(pdf_bytes)
-
-    except Exception as e:
-        print(f"error: {e}")
-
-
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
-
-
-def draw_bounding_boxes(image, refs, jdx):
-
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
-
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-    
-    #     except IOError:
-    font = ImageFont.load_default()
-
-    img_idx = 0
-    
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
-                
-                color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-
-                color_a = color + (20, )
-                for points in points_list:
-                    x1, y1, x2, y2 = points
-
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
-                    try:
-                        if label_type == 'title':
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                        else:
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-
-                        text_x = x1
-                        text_y = max(0, y1 - 15)
-                            
-                        text_bbox = draw.textbbox((0, 0), label_type, font=font)
-                        text_width = text_bbox[2] - text_bbox[0]
-                        text_height = text_bbox[3] - text_bbox[1]
-                        draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height], 
-                                    fill=(255, 255, 255, 30))
-                        
-                        draw.text((text_x, text_y), label_type, font=font, fill=color)
-                    except:
-                        pass
-        except:
-            continue
-    img_draw.paste(overlay, (0, 0), overlay)
-    return img_draw
-
-
-def process_image_with_refs(image, ref_texts, jdx):
-    result_image = draw_bounding_boxes(image, ref_texts, jdx)
-    return result_image
-
-
 def process_single_image(image):
     """single image"""
     prompt_in = prompt
@@ -230,101 +100,262 @@ def process_single_image(image):
     return cache_item
 
 
-if __name__ == "__main__":
-
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
-    
-    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
-
-
-    images = pdf_to_images_high_quality(INPUT_PATH)
-
+def resolve_pdf_paths(input_path):
+    """a single .pdf, a directory of .pdf files, or a manifest (.txt, one path per line)"""
+    if os.path.isdir(input_path):
+        return sorted(glob.glob(os.path.join(input_path, '*.pdf')))
 
-    prompt = PROMPT
+    if input_path.endswith('.txt'):
+        with open(input_path, 'r', encoding='utf-8') as afile:
+            return [line.strip() for line in afile if line.strip() and not line.startswith('#')]
 
-    # batch_inputs = []
+    return [input_path]
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
 
+def pdf_stem(pdf_path):
+    return os.path.splitext(os.path.basename(pdf_path))[0]
 
-    # for image in tqdm(images):
 
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
+def output_dirs(pdf_paths):
+    """
+    {pdf_path: output directory} of a multi-document run, OUTPUT_PATH/<stem>. PDFs that share
+    a stem (a/report.pdf, b/report.pdf) get <stem>_<n> in input order, so a resumed run with
+    the same input maps every document to the same directory.
+    """
+    stems = [pdf_stem(pdf_path) for pdf_path in pdf_paths]
+    counts = Counter(stems)
+    used = set(stems)
+    numbers = Counter()
+    dirs = {}
+    for pdf_path, stem in zip(pdf_paths, stems):
+        name = stem
+        if counts[stem] > 1:
+            name = None
+            while name is None or name in used:
+                numbers[stem] += 1
+                name = f'{stem}_{numbers[stem]}'
+            used.add(name)
+        dirs[pdf_path] = os.path.join(OUTPUT_PATH, name)
+    return dirs
+
+
+class Document:
+
+    def __init__(self, pdf_path, output_dir, images):
+        self.pdf_path = pdf_path
+        self.output_dir = output_dir
+        self.images = images
+        self.contents = [None] * len(images)
+        self.remaining = len(images)
+
+    def add_result(self, page_idx, content):
+        """returns True once the last page of the document is finished"""
+        self.contents[page_idx] = content
+        self.remaining -= 1
+        return self.remaining == 0
+
+
+def iter_documents(pdf_paths, executor):
+    """rasterize one document ahead of the one being scheduled"""
+    pending = None
+    for pdf_path in pdf_paths:
+        future = executor.submit(pdf_to_images_high_quality, pdf_path)
+        if pending is not None:
+            yield pending[0], pending[1].result()
+        pending = (pdf_path, future)
+    if pending is not None:
+        yield pending[0], pending[1].result()
+
+
+def iter_pages(pdf_paths, executor, document_dirs=None, journal=None):
+    """
+    yields (doc, page_idx, preprocess future); page_idx is None when every page came from the journal.
+    document_dirs: output_dirs() of a multi-document run, None: everything goes to OUTPUT_PATH
+    """
+    for pdf_path, images in iter_documents(pdf_paths, executor):
+        output_dir = document_dirs[pdf_path] if document_dirs else OUTPUT_PATH
+
+        doc = Document(pdf_path, output_dir, images)
+        if not images:
+            print(f'{Colors.YELLOW}no pages: {pdf_path}{Colors.RESET}')
+            if journal:
+                # nothing to write, but done: a resumed run does not rasterize it again
+                journal.mark_finalized(pdf_path)
+            continue
 
+        for page_idx, image in enumerate(images):
+            content = journal.get(pdf_path, page_idx) if journal else None
+            if content is not None:
+                if doc.add_result(page_idx, content):
+                    yield doc, None, None
+                continue
+            yield doc, page_idx, executor.submit(process_single_image, image)
 
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
 
+def write_document(doc, renderer, figure_pool, journal=None):
 
-    output_path = OUTPUT_PATH
+    output_path = doc.output_dir
 
     os.makedirs(output_path, exist_ok=True)
 
+    pdf_name = pdf_stem(doc.pdf_path)
 
-    mmd_det_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_det.mmd')
-    mmd_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('pdf', 'mmd')
-    pdf_out_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layouts.pdf')
+    mmd_det_path = output_path + '/' + pdf_name + '_det.mmd'
+    mmd_path = output_path + '/' + pdf_name + '.mmd'
+    pdf_out_path = output_path + '/' + pdf_name + '_layouts.pdf'
     contents_det = ''
     contents = ''
-    draw_images = []
+    pages = []
+    figures = FigureWriter(figure_pool, output_path, fmt=FIGURE_FORMAT, quality=FIGURE_QUALITY, dedup=FIGURE_DEDUP)
+    page_num = f'\n<--- Page Split --->'
     jdx = 0
-    for output, img in zip(outputs_list, images):
-        content = output.outputs[0].text
+    for page_idx, (content, img) in enumerate(zip(doc.contents, doc.images)):
 
         if '<｜end▁of▁sentence｜>' in content: # repeat no eos
             content = content.replace('<｜end▁of▁sentence｜>', '')
         else:
             if SKIP_REPEAT:
+                PAGES_DROPPED.inc()
                 continue
 
-        
-        page_num = f'\n<--- Page Split --->'
 
         contents_det += content + f'\n{page_num}\n'
 
-        image_draw = img.copy()
+        grounding = parse_grounding(content)
+        for error in grounding.errors:
+            print(f'{doc.pdf_path} page {jdx}: malformed boxes, {error}')
 
-        matches_ref, matches_images, mathes_other = re_match(content)
-        # print(matches_ref)
-        result_image = process_image_with_refs(image_draw, matches_ref, jdx)
+        # figures are cropped and written on the figure pool while the other pages are parsed
+        pages.append((page_idx, jdx, img, grounding, figures.submit(img, grounding.records, jdx)))
 
+        jdx += 1
 
-        draw_images.append(result_image)
+    structured = None
+    if STRUCTURED_OUTPUT:
+        structured = StructuredWriter(structured_path(output_path + '/' + pdf_name, STRUCTURED_OUTPUT))
 
+    for page_idx, jdx, img, grounding, manifest in pages:
+        manifest = manifest.result()
+        if structured:
+            structured.write(page_record(page_idx, grounding, *img.size, source=doc.pdf_path, figures=manifest))
 
-        for idx, a_match_image in enumerate(matches_images):
-            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+        content = grounding.markdown(figure_link(manifest, lambda idx: f'images/{jdx}_{idx}{FORMATS[FIGURE_FORMAT][1]}'))
 
-        for idx, a_match_other in enumerate(mathes_other):
-            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+        if grounding.other_records:
+            content = normalize_markdown(content, macros=True, newlines=True)
 
 
         contents += content + f'\n{page_num}\n'
 
+    if structured:
+        structured.close()
 
-        jdx += 1
+    atomic_write(mmd_det_path, contents_det)
+
+    atomic_write(mmd_path, contents)
+
+
+    # pages are drawn and encoded on the render workers and streamed to disk, so memory
+    # does not grow with the page count
+    if SAVE_LAYOUT_PDF:
+        try:
+            write_layout_pdf(pdf_out_path, renderer, ((img, grounding.records) for _, _, img, grounding, _ in pages))
+        except Exception as e:
+            print(f"error: {e}")
 
-    with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents_det)
+    if journal:
+        journal.mark_finalized(doc.pdf_path)
 
-    with open(mmd_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents)
 
+def run_documents(pdf_paths):
+    """
+    Keep one engine resident and interleave the pages of many documents in the
+    same max_num_seqs pool; each document is written as soon as its last page finishes.
+    """
+    # enough queued requests to keep the running batch full between steps
+    window = MAX_CONCURRENCY * 2
+    # assigned over the whole input before the journal drops finished documents
+    document_dirs = output_dirs(pdf_paths) if len(pdf_paths) > 1 else None
+
+    journal = None
+    if CHECKPOINT:
+        journal = PageJournal(f'{OUTPUT_PATH}/journal.jsonl', resume=RESUME)
+        num_documents = len(pdf_paths)
+        pdf_paths = [pdf_path for pdf_path in pdf_paths if not journal.is_finalized(pdf_path)]
+        if journal.replayed:
+            num_pages = sum(len(journal.pages.get(pdf_path, {})) for pdf_path in pdf_paths)
+            print(f'{Colors.YELLOW}resuming from {journal.path}: {num_documents - len(pdf_paths)} documents already done, '
+                  f'{num_pages} pages of the others reused (RESUME = False starts over){Colors.RESET}')
+
+    in_flight = {}
+    prepared = deque()
+    writes = []
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor, \
+            ThreadPoolExecutor(max_workers=1) as writer, \
+            ThreadPoolExecutor(max_workers=NUM_WORKERS) as renderer, \
+            ThreadPoolExecutor(max_workers=FIGURE_WORKERS) as figure_pool, \
+            tqdm(desc='Pages') as progress:
+
+        pages = iter_pages(pdf_paths, executor, document_dirs, journal)
+        exhausted = False
+        num_requests = 0
+
+        while True:
+            while not exhausted and len(prepared) < window:
+                item = next(pages, None)
+                if item is None:
+                    exhausted = True
+                else:
+                    prepared.append(item)
+
+            while prepared and len(in_flight) < window:
+                doc, page_idx, future = prepared.popleft()
+                if page_idx is None:
+                    writes.append(writer.submit(write_document, doc, renderer, figure_pool, journal))
+                    continue
+                request_id = str(num_requests)
+                num_requests += 1
+                llm.add_request(request_id, future.result(), sampling_params)
+                in_flight[request_id] = (doc, page_idx)
+
+            if not in_flight:
+                if exhausted and not prepared:
+                    break
+                # every prepared document was already complete in the journal
+                continue
+
+            for output in llm.step():
+                if not output.finished:
+                    continue
+                doc, page_idx = in_flight.pop(output.request_id)
+                PAGES.inc(status=page_status(output.outputs[0]))
+                progress.update(1)
+                if journal:
+                    journal.record(doc.pdf_path, page_idx, output.outputs[0].text)
+                if doc.add_result(page_idx, output.outputs[0].text):
+                    writes.append(writer.submit(write_document, doc, renderer, figure_pool, journal))
+
+        for future in writes:
+            future.result()
+
+    if journal:
+        journal.close()
+
+
+if __name__ == "__main__":
+
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    
+    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
+
+
+    pdf_paths = [os.path.abspath(pdf_path) for pdf_path in resolve_pdf_paths(INPUT_PATH)]
+
+
+    prompt = PROMPT
 
-    pil_to_pdf_img2pdf(draw_images, pdf_out_path)
+    run_documents(pdf_paths)
 
+    if METRICS:
+        REGISTRY.dump(f'{OUTPUT_PATH}/metrics.json')
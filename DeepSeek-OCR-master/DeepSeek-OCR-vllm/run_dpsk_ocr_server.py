@@ -0,0 +1,241 @@
+import asyncio
+import io
+import json
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import torch
+if torch.version.cuda == '11.8':
+    os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+
+os.environ['VLLM_USE_V1'] = '0'
+os.environ["CUDA_VISIBLE_DEVICES"] = '0'
+
+import fitz
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from PIL import Image, ImageOps
+
+from engine import build_async_engine, build_sampling_params
+from metrics import REGISTRY, PAGES, page_status
+from scheduler import PriorityScheduler, DeadlineExceeded, PRIORITY_CLASSES, percentiles
+from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.image_process import DeepseekOCRProcessor
+from config import PROMPT, CROP_MODE, NUM_WORKERS, MAX_CONCURRENCY, SERVER_HOST, SERVER_PORT
+
+
+def load_image_bytes(data):
+    image = Image.open(io.BytesIO(data))
+    try:
+        image = ImageOps.exif_transpose(image)
+    except Exception as e:
+        print(f"error: {e}")
+    return image.convert('RGB')
+
+
+def pdf_bytes_to_images(data, dpi=144):
+    """pdf2images, same rasterization as run_dpsk_ocr_pdf.py"""
+    images = []
+    pdf_document = fitz.open(stream=data, filetype='pdf')
+    zoom = dpi / 72.0
+    matrix = fitz.Matrix(zoom, zoom)
+    Image.MAX_IMAGE_PIXELS = None
+    for page in pdf_document:
+        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+        images.append(Image.open(io.BytesIO(pixmap.tobytes("png"))))
+    pdf_document.close()
+    return images
+
+
+def preprocess_upload(data, prompt):
+    """runs on the worker pool: decode the upload and tokenize every page"""
+    if data[:5] == b'%PDF-':
+        images = pdf_bytes_to_images(data)
+    else:
+        images = [load_image_bytes(data)]
+
+    requests = []
+    for image in images:
+        if '<image>' in prompt:
+            image_features = DeepseekOCRProcessor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE, prompt=prompt)
+            requests.append({"prompt": prompt, "multi_modal_data": {"image": image_features}})
+        else:
+            requests.append({"prompt": prompt})
+    return requests
+
+
+def build_service_sampling_params():
+
+    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td>
+
+    return build_sampling_params(
+        temperature=0.0,
+        max_tokens=8192,
+        logits_processors=logits_processors,
+        skip_special_tokens=False,
+    )
+
+
+class ServiceStats:
+    """queue depth and latency of the service, exposed on /metrics"""
+
+    def __init__(self, window=2048):
+        self.preprocessing = 0
+        self.generating = 0
+        self.completed = 0
+        self.failed = 0
+        self.latency = deque(maxlen=window)
+        self.first_token_latency = deque(maxlen=window)
+
+    def to_dict(self):
+        return {
+            'queue_depth': self.preprocessing + self.generating,
+            'preprocessing': self.preprocessing,
+            'generating': self.generating,
+            'completed': self.completed,
+            'failed': self.failed,
+            'latency_s': percentiles(self.latency),
+            'first_token_latency_s': percentiles(self.first_token_latency),
+        }
+
+
+def sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def create_app(engine, sampling_params=None, num_workers=NUM_WORKERS, **scheduler_options):
+    """
+    engine: anything with the AsyncLLMEngine `generate(request, sampling_params, request_id)`
+    async-iterator interface, e.g. engine.StubAsyncEngine to run the service without a GPU.
+    Requests go through a PriorityScheduler (scheduler_options: max_running, reserved_slots,
+    tenant_weights), so interactive uploads are not queued behind bulk ones.
+    """
+    app = FastAPI(title='DeepSeek-OCR')
+    stats = ServiceStats()
+    scheduler = PriorityScheduler(engine, **scheduler_options)
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    if sampling_params is None:
+        sampling_params = build_service_sampling_params()
+
+    async def generate_page(page_idx, request, queue, start, schedule):
+        request_id = f'request-{uuid.uuid4().hex}'
+        printed_length = 0
+        final_output = ''
+        async for request_output in scheduler.generate(request, sampling_params, request_id, **schedule):
+            if request_output.outputs:
+                full_text = request_output.outputs[0].text
+                if printed_length == 0 and full_text:
+                    stats.first_token_latency.append(time.perf_counter() - start)
+                await queue.put(('delta', {'page': page_idx, 'text': full_text[printed_length:]}))
+                printed_length = len(full_text)
+                final_output = full_text
+                if request_output.finished:
+                    PAGES.inc(status=page_status(request_output.outputs[0]))
+        await queue.put(('page', {'page': page_idx, 'text': final_output}))
+
+    async def run_pages(requests, queue, start, schedule):
+        stats.generating += 1
+        tasks = [asyncio.create_task(generate_page(page_idx, request, queue, start, schedule))
+                 for page_idx, request in enumerate(requests)]
+        error = None
+        try:
+            await asyncio.gather(*tasks)
+            stats.completed += 1
+            stats.latency.append(time.perf_counter() - start)
+        except DeadlineExceeded as e:
+            error = {'error': str(e), 'status': 504}
+        except Exception as e:
+            error = {'error': str(e), 'status': 500}
+        finally:
+            # a failed page, or the client going away (events cancels this task), stops the
+            # sibling pages too, before the error is sent, so they do not keep generating on the engine
+            for page_task in tasks:
+                page_task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            stats.generating -= 1
+            if error is not None:
+                stats.failed += 1
+                await queue.put(('error', error))
+            await queue.put(None)
+
+    async def events(requests, start, schedule):
+        # pages of a pdf are generated concurrently and their deltas interleaved
+        queue = asyncio.Queue()
+        task = asyncio.create_task(run_pages(requests, queue, start, schedule))
+        try:
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            if not task.done():
+                task.cancel()
+
+    @app.get('/health')
+    async def health():
+        return {'status': 'ok'}
+
+    REGISTRY.gauge('ocr_service_queue_depth', 'uploads being preprocessed or generated',
+                   function=lambda: stats.preprocessing + stats.generating)
+    REGISTRY.gauge('ocr_service_completed', 'uploads completed', function=lambda: stats.completed)
+    REGISTRY.gauge('ocr_service_failed', 'uploads failed', function=lambda: stats.failed)
+
+    @app.get('/metrics')
+    async def metrics(format: str = 'json'):
+        """format=prometheus: the metrics registry in the Prometheus text format"""
+        if format == 'prometheus':
+            return PlainTextResponse(REGISTRY.to_prometheus(), media_type='text/plain; version=0.0.4')
+        return dict(stats.to_dict(), scheduler=scheduler.to_dict(), registry=REGISTRY.to_dict())
+
+    @app.post('/ocr')
+    async def ocr(file: UploadFile = File(...), prompt: str = Form(PROMPT), stream: bool = Form(True),
+                  priority: str = Form('interactive'), tenant: str = Form('default'),
+                  deadline_ms: Optional[int] = Form(None)):
+        """priority: interactive | bulk; deadline_ms: give up if not admitted to the engine within this time"""
+        start = time.perf_counter()
+        if priority not in PRIORITY_CLASSES:
+            return JSONResponse({'error': f'priority must be one of {PRIORITY_CLASSES}'}, status_code=400)
+        schedule = dict(priority=priority, tenant=tenant,
+                        deadline=time.monotonic() + deadline_ms / 1000 if deadline_ms is not None else None)
+        data = await file.read()
+
+        stats.preprocessing += 1
+        try:
+            requests = await asyncio.get_running_loop().run_in_executor(executor, preprocess_upload, data, prompt)
+        except Exception as e:
+            stats.failed += 1
+            return JSONResponse({'error': f'could not read upload: {e}'}, status_code=400)
+        finally:
+            stats.preprocessing -= 1
+
+        if stream:
+            async def event_stream():
+                async for event, payload in events(requests, start, schedule):
+                    yield sse(event, payload)
+                yield sse('done', {'pages': len(requests)})
+
+            return StreamingResponse(event_stream(), media_type='text/event-stream')
+
+        pages = [None] * len(requests)
+        async for event, payload in events(requests, start, schedule):
+            if event == 'error':
+                return JSONResponse({'error': payload['error']}, status_code=payload['status'])
+            if event == 'page':
+                pages[payload['page']] = payload['text']
+        return {'pages': pages}
+
+    @app.on_event('shutdown')
+    def shutdown():
+        executor.shutdown(wait=False)
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # the engine is loaded (and CUDA graphs captured) once for the lifetime of the service
+    app = create_app(build_async_engine(max_num_seqs=MAX_CONCURRENCY, gpu_memory_utilization=0.75))
+    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
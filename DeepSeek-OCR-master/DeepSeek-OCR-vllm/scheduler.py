@@ -0,0 +1,183 @@
+"""
+Priority-, fair-share- and deadline-aware admission in front of an async engine.
+
+The engine itself schedules first-come-first-served, so once thousands of bulk pages are
+queued inside it an interactive page has to wait behind all of them. The scheduler keeps
+the queue on this side instead and only lets MAX_CONCURRENCY requests into the engine:
+
+- priority classes: every waiting interactive request is admitted before any bulk one,
+  and SCHEDULER_RESERVED_SLOTS engine slots are never given to bulk work, so an
+  interactive request does not have to wait for a bulk page to finish;
+- deadlines: within a class the earliest deadline goes first, and a request still queued
+  at its deadline fails with DeadlineExceeded instead of occupying the engine;
+- fair share: otherwise requests are ordered by per-tenant virtual time, so a tenant that
+  queued 10k pages does not starve one that queued ten.
+
+tests/test_scheduler.py runs these against the stub engine.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+import numpy as np
+
+from config import MAX_CONCURRENCY, SCHEDULER_RESERVED_SLOTS
+
+PRIORITY_CLASSES = ('interactive', 'bulk')
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(np.asarray(values), [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+class ClassStats:
+
+    def __init__(self, window=4096):
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.expired = 0
+        self.queue_wait = deque(maxlen=window)
+        self.first_token_latency = deque(maxlen=window)
+        self.latency = deque(maxlen=window)
+
+    def to_dict(self):
+        return {
+            'waiting': self.waiting,
+            'running': self.running,
+            'completed': self.completed,
+            'expired': self.expired,
+            'queue_wait_s': percentiles(self.queue_wait),
+            'first_token_latency_s': percentiles(self.first_token_latency),
+            'latency_s': percentiles(self.latency),
+        }
+
+
+class Ticket:
+
+    def __init__(self, priority, tenant, deadline, virtual_time, seq):
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+        self.key = (PRIORITY_CLASSES.index(priority),
+                    deadline if deadline is not None else float('inf'),
+                    virtual_time, seq)
+        self.admitted = asyncio.Event()
+        self.abandoned = False
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class PriorityScheduler:
+    """
+    Wraps an engine with the AsyncLLMEngine `generate` interface and exposes the same
+    interface, plus priority / tenant / deadline (absolute time.monotonic()) arguments.
+    """
+
+    def __init__(self, engine, max_running=MAX_CONCURRENCY, reserved_slots=SCHEDULER_RESERVED_SLOTS,
+                 tenant_weights=None):
+        self.engine = engine
+        self.max_running = max_running
+        self.reserved_slots = min(reserved_slots, max_running - 1)
+        self.tenant_weights = tenant_weights or {}
+        self.running = 0
+        self.heap = []
+        self.seq = itertools.count()
+        self.tenant_virtual_time = {}
+        self.virtual_time = 0.0
+        self.stats = {priority: ClassStats() for priority in PRIORITY_CLASSES}
+
+    def _enqueue(self, priority, tenant, deadline):
+        # start-time fair queuing: a request starts no earlier than the tenant's last one
+        # finished in virtual time, and each costs 1 / weight
+        start = max(self.virtual_time, self.tenant_virtual_time.get(tenant, 0.0))
+        self.tenant_virtual_time[tenant] = start + 1.0 / self.tenant_weights.get(tenant, 1.0)
+        ticket = Ticket(priority, tenant, deadline, start, next(self.seq))
+        heapq.heappush(self.heap, ticket)
+        self.stats[priority].waiting += 1
+        return ticket
+
+    def _dispatch(self):
+        while self.heap and self.running < self.max_running:
+            ticket = self.heap[0]
+            if ticket.abandoned:
+                heapq.heappop(self.heap)
+                continue
+            if ticket.priority != 'interactive' and self.running >= self.max_running - self.reserved_slots:
+                break
+            heapq.heappop(self.heap)
+            self.virtual_time = max(self.virtual_time, ticket.key[2])
+            self.running += 1
+            self.stats[ticket.priority].waiting -= 1
+            self.stats[ticket.priority].running += 1
+            ticket.admitted.set()
+
+    def _release(self, ticket):
+        self.running -= 1
+        self.stats[ticket.priority].running -= 1
+        self._dispatch()
+
+    async def _wait(self, ticket):
+        try:
+            if ticket.deadline is None:
+                await ticket.admitted.wait()
+            else:
+                timeout = max(0.0, ticket.deadline - time.monotonic())
+                await asyncio.wait_for(ticket.admitted.wait(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.admitted.is_set():
+                # admitted in the same tick it gave up
+                self._release(ticket)
+            else:
+                ticket.abandoned = True
+                self.stats[ticket.priority].waiting -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats[ticket.priority].expired += 1
+                raise DeadlineExceeded(f'{ticket.priority} request from {ticket.tenant} missed its deadline in the queue')
+            raise
+
+    async def generate(self, request, sampling_params, request_id, priority='bulk', tenant='default', deadline=None):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f'unknown priority class: {priority}')
+
+        stats = self.stats[priority]
+        if deadline is not None and deadline <= time.monotonic():
+            # checked up front: whether a zero timeout still sees a free slot depends on the python version
+            stats.expired += 1
+            raise DeadlineExceeded(f'{priority} request from {tenant} arrived after its deadline')
+        start = time.perf_counter()
+        ticket = self._enqueue(priority, tenant, deadline)
+        self._dispatch()
+        await self._wait(ticket)
+        stats.queue_wait.append(time.perf_counter() - start)
+
+        first_token = True
+        try:
+            async for request_output in self.engine.generate(request, sampling_params, request_id):
+                if first_token and request_output.outputs and request_output.outputs[0].text:
+                    stats.first_token_latency.append(time.perf_counter() - start)
+                    first_token = False
+                yield request_output
+            stats.completed += 1
+            stats.latency.append(time.perf_counter() - start)
+        finally:
+            self._release(ticket)
+
+    def to_dict(self):
+        return {
+            'running': self.running,
+            'max_running': self.max_running,
+            'reserved_slots': self.reserved_slots,
+            'classes': {priority: stats.to_dict() for priority, stats in self.stats.items()},
+        }
+
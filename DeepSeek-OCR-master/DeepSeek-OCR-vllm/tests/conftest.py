@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other from the DeepSeek-OCR-vllm directory (python run_dpsk_ocr_*.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
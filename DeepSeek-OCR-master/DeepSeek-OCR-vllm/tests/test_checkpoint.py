@@ -0,0 +1,58 @@
+import os
+
+from process.checkpoint import PageJournal, atomic_write
+
+
+def test_only_finalized_records_are_synced_once_per_batch(tmp_path, monkeypatch):
+    syncs = []
+    monkeypatch.setattr(os, 'fsync', syncs.append)
+    journal = PageJournal(str(tmp_path / 'journal.jsonl'))
+    for page in range(3):
+        journal.record('a.pdf', page, f'page {page}')
+    assert syncs == []
+
+    journal.mark_finalized('a.pdf', 'b.png', 'c.png')
+    assert len(syncs) == 1
+    journal.close()
+
+
+def test_resume_replays_pages_and_finalized_keys(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = PageJournal(path)
+    journal.record('a.pdf', 0, 'first')
+    journal.record('b.pdf', 1, 'second')
+    journal.mark_finalized('a.pdf', 'c.png')
+    journal.close()
+
+    journal = PageJournal(path)
+    assert journal.replayed == 4
+    assert journal.is_finalized('a.pdf') and journal.is_finalized('c.png')
+    assert not journal.is_finalized('b.pdf')
+    assert journal.get('a.pdf', 0) is None
+    assert journal.get('b.pdf', 1) == 'second'
+    journal.close()
+
+    journal = PageJournal(path, resume=False)
+    assert journal.replayed == 0 and not journal.is_finalized('a.pdf')
+    journal.close()
+
+
+def test_atomic_write_is_synced_before_the_rename_and_the_directory_after(tmp_path, monkeypatch):
+    events = []
+    fsync, replace = os.fsync, os.replace
+
+    def record_fsync(fd):
+        events.append(('fsync', os.path.basename(os.readlink(f'/proc/self/fd/{fd}'))))
+        fsync(fd)
+
+    def record_replace(src, dst):
+        events.append(('replace', os.path.basename(dst)))
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'fsync', record_fsync)
+    monkeypatch.setattr(os, 'replace', record_replace)
+    path = tmp_path / 'page.mmd'
+    atomic_write(str(path), 'text')
+
+    assert events == [('fsync', 'page.mmd.tmp'), ('replace', 'page.mmd'), ('fsync', tmp_path.name)]
+    assert path.read_text() == 'text'
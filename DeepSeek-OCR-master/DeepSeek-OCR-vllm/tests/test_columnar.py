@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from process.checkpoint import PageJournal
+from process.columnar import ColumnarWriter, read_columnar
+
+pytest.importorskip('pyarrow')
+
+
+def row(image):
+    return {'image': image, 'mode': '1024/640/crop', 'prompt_tokens': 1, 'output_tokens': 2, 'latency_s': 0.5,
+            'raw': 'raw', 'cleaned': 'cleaned', 'box_labels': [], 'boxes': []}
+
+
+@pytest.mark.parametrize('fmt, path', [('arrow', 'results.00000.arrows'), ('parquet', 'results.00000.parquet')])
+def test_rows_are_fsynced_before_the_journal_marks_them(tmp_path, monkeypatch, fmt, path):
+    events = []
+    fsync = os.fsync
+
+    def record_fsync(fd):
+        events.append(('fsync', os.path.basename(os.readlink(f'/proc/self/fd/{fd}'))))
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', record_fsync)
+    journal = PageJournal(str(tmp_path / 'journal.jsonl'))
+
+    def finalize(keys):
+        events.append(('mark', list(keys)))
+        journal.mark_finalized(*keys)
+
+    writer = ColumnarWriter(str(tmp_path / path), fmt, row_group_size=2, on_durable=finalize)
+    for image in ('a', 'b', 'c'):
+        writer.append(image, row(image))
+    writer.close()
+    journal.close()
+
+    marks = [idx for idx, event in enumerate(events) if event[0] == 'mark']
+    assert [events[idx][1] for idx in marks] == ([['a', 'b'], ['c']] if fmt == 'arrow' else [['a', 'b', 'c']])
+    for idx in marks:
+        # the sink (the part, or its .tmp before the rename) was fsynced since the previous mark,
+        # and the journal line is fsynced after the mark
+        previous = max([mark for mark in marks if mark < idx], default=-1)
+        assert ('fsync', path) in events[previous + 1:idx] or ('fsync', path + '.tmp') in events[previous + 1:idx]
+        assert events[idx + 1] == ('fsync', 'journal.jsonl')
+    assert read_columnar(str(tmp_path / 'results'), fmt).column('image').to_pylist() == ['a', 'b', 'c']
@@ -0,0 +1,52 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import process.figures
+from process.figures import FigureWriter
+from process.grounding import parse_grounding
+
+# two boxes with the same (white) pixels
+PAGE = ('<|ref|>image<|/ref|><|det|>[[100, 100, 300, 300]]<|/det|>\n\n'
+        '<|ref|>image<|/ref|><|det|>[[500, 500, 700, 700]]<|/det|>\n')
+
+
+def write_pages(tmp_path, num_pages):
+    image = Image.new('RGB', (1000, 1000), 'white')
+    records = parse_grounding(PAGE).records
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        figures = FigureWriter(pool, str(tmp_path), fmt='png')
+        pages = [figures.submit(image, records, page_idx) for page_idx in range(num_pages)]
+        return [page.result() for page in pages]
+
+
+def test_identical_figures_are_written_once(tmp_path):
+    manifests = write_pages(tmp_path, 3)
+    entries = [entry for manifest in manifests for entry in manifest]
+    assert [entry['path'] for entry in entries] == ['images/0_0.png'] * 6
+    assert [entry['duplicate'] for entry in entries] == [False] + [True] * 5
+    assert os.listdir(tmp_path / 'images') == ['0_0.png']
+
+
+@pytest.mark.parametrize('failures', [1, 3])
+def test_duplicates_of_a_failed_write_are_written_themselves(tmp_path, monkeypatch, failures):
+    encode_figure = process.figures.encode_figure
+    calls = []
+
+    def failing_encode(*args, **kwargs):
+        calls.append(args)
+        if len(calls) <= failures:
+            raise OSError('disk full')
+        return encode_figure(*args, **kwargs)
+
+    monkeypatch.setattr(process.figures, 'encode_figure', failing_encode)
+    entries = [entry for manifest in write_pages(tmp_path, 3) for entry in manifest]
+
+    # no entry links a file that was never written
+    written = [entry for entry in entries if entry['path'] is not None]
+    assert len(written) == len(entries) - failures
+    for entry in written:
+        assert (tmp_path / entry['path']).is_file()
+    assert not any(entry['duplicate'] for entry in entries[:failures + 1])
@@ -0,0 +1,19 @@
+import json
+
+import pytest
+import torch
+from PIL import Image
+
+from process.image_process import DeepseekOCRProcessor
+
+
+@pytest.mark.parametrize('pixel_dtype', ['float32', 'bfloat16', 'uint8'])
+def test_processor_serializes_and_keeps_the_pixel_dtype(pixel_dtype):
+    processor = DeepseekOCRProcessor(pixel_dtype=pixel_dtype)
+    # vLLM / HF log and serialize processors
+    assert json.loads(processor.to_json_string())['pixel_dtype'] == pixel_dtype
+    assert 'DeepseekOCRProcessor' in repr(processor)
+
+    for size in [(600, 600), (1190, 1684)]:
+        features = processor.tokenize_with_images(images=[Image.new('RGB', size, 'white')], bos=True, eos=True, cropping=True)[0]
+        assert features[1].dtype == features[2].dtype == getattr(torch, pixel_dtype)
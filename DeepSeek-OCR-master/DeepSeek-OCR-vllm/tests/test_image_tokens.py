@@ -0,0 +1,69 @@
+import random
+
+import pytest
+from PIL import Image
+
+from config import MIN_CROPS, MAX_CROPS
+from process.image_process import DeepseekOCRProcessor
+from process.image_tokens import image_grid, num_image_tokens, token_table, worst_case_grid, worst_case_image_size
+
+# (base_size, image_size, crop_mode), as listed in config.py
+MODES = {
+    'tiny': (512, 512, False),
+    'small': (640, 640, False),
+    'base': (1024, 1024, False),
+    'large': (1280, 1280, False),
+    'gundam': (1024, 640, True),
+}
+
+
+def all_grids(min_num, max_num):
+    return [(w, h) for w in range(1, max_num + 1) for h in range(1, max_num + 1) if min_num <= w * h <= max_num]
+
+
+@pytest.mark.parametrize('max_num', [6, 9])
+@pytest.mark.parametrize('mode', MODES)
+def test_profiled_count_covers_every_grid(mode, max_num):
+    base_size, image_size, crop_mode = MODES[mode]
+    table = token_table(crop_mode, MIN_CROPS, max_num, base_size, image_size)
+    worst = table[worst_case_grid(crop_mode, MIN_CROPS, max_num, base_size, image_size)]
+    assert worst == max(table.values())
+
+    def tokens(width, height):
+        # what get_num_image_tokens returns for a width x height image in this mode
+        return table[image_grid(width, height, crop_mode, MIN_CROPS, max_num, image_size)]
+
+    # the image vLLM profiles with gets the worst case
+    assert tokens(*worst_case_image_size(crop_mode, MIN_CROPS, max_num, base_size, image_size)) == worst
+
+    for grid in all_grids(MIN_CROPS, max_num):
+        width, height = grid[0] * image_size, grid[1] * image_size
+        if crop_mode:
+            assert image_grid(width, height, crop_mode, MIN_CROPS, max_num, image_size) == grid
+        assert tokens(width, height) <= worst, grid
+
+    sizes = range(64, 8193, 97)
+    assert max(tokens(width, height) for width in sizes for height in sizes) <= worst
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_num_image_tokens_matches_tokenize_with_images(mode):
+    base_size, image_size, crop_mode = MODES[mode]
+    processor = DeepseekOCRProcessor()
+    processor.base_size, processor.image_size = base_size, image_size
+
+    rng = random.Random(f'image-tokens-{mode}')
+    sizes = [(rng.randint(16, 4096), rng.randint(16, 4096)) for _ in range(40)]
+    # the untiled edge, the profiling image and a4 pages
+    sizes += [(640, 640), (641, 640), (640, 641), (1190, 1684), (1684, 1190),
+              worst_case_image_size(crop_mode, MIN_CROPS, MAX_CROPS, base_size, image_size)]
+    for cropping in ([True, False] if crop_mode else [False]):
+        for width, height in sizes:
+            features = processor.tokenize_with_images(images=[Image.new('RGB', (width, height), 'white')],
+                                                      bos=True, eos=True, cropping=cropping)[0]
+            expected = features[5][0]
+            assert (features[0] == processor.image_token_id).sum().item() == expected
+            assert num_image_tokens(width, height, cropping, base_size=base_size, image_size=image_size) == expected, \
+                (width, height, cropping)
+            assert image_grid(width, height, cropping, image_size=image_size) == tuple(features[4][0].tolist()), \
+                (width, height, cropping)
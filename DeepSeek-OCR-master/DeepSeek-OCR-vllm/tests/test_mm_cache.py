@@ -0,0 +1,131 @@
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from config import PROMPT, TOKENIZER
+from process.image_process import DeepseekOCRProcessor
+from process.mm_cache import PayloadKeyedCache, features_digest, same_nested
+
+PROMPTS = [PROMPT, '<image>\nFree OCR.']
+SIZES = [(640, 640), (641, 640), (1190, 1684), (640, 3840), (2480, 300), (333, 1200)]
+
+
+def random_page(width, height, seed=0):
+    rng = random.Random(seed)
+    page = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(page)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle((x, y, x + rng.randint(5, 200), y + rng.randint(5, 40)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    return page
+
+
+class DictCache:
+    """the get / put interface of vLLM's ProcessingCache"""
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, model_id, modality, input_item, input_kwargs):
+        return self.items.get((model_id, modality, input_item))
+
+    def put(self, model_id, modality, input_item, input_kwargs, output_kwargs):
+        self.items[(model_id, modality, input_item)] = output_kwargs
+
+
+@pytest.mark.parametrize('pixel_dtype', ['float32', 'bfloat16', 'uint8'])
+def test_digest_is_stable_across_tokenization(pixel_dtype):
+    processor = DeepseekOCRProcessor(pixel_dtype=pixel_dtype)
+    page = random_page(1190, 1684)
+    features = processor.tokenize_with_images(images=[page], bos=True, eos=True, cropping=True)[0]
+    repeat = processor.tokenize_with_images(images=[page.copy()], bos=True, eos=True, cropping=True)[0]
+    assert features_digest(features) == features_digest(repeat)
+
+
+def test_digest_differs_by_page_mode_dtype_and_prompt():
+    page = random_page(1190, 1684)
+    base = DeepseekOCRProcessor(pixel_dtype='float32').tokenize_with_images(images=[page], bos=True, eos=True, cropping=True)[0]
+    others = [
+        DeepseekOCRProcessor(pixel_dtype='float32').tokenize_with_images(images=[page], bos=True, eos=True, cropping=False)[0],
+        DeepseekOCRProcessor(pixel_dtype='bfloat16').tokenize_with_images(images=[page], bos=True, eos=True, cropping=True)[0],
+        DeepseekOCRProcessor(pixel_dtype='float32').tokenize_with_images(images=[random_page(1190, 1684, seed=1)], bos=True, eos=True, cropping=True)[0],
+        DeepseekOCRProcessor(pixel_dtype='float32').tokenize_with_images(images=[page], bos=True, eos=True, cropping=True, prompt=PROMPTS[1])[0],
+    ]
+    assert all(features_digest(other) != features_digest(base) for other in others)
+
+
+def test_payload_keyed_cache_hits_on_an_equal_payload():
+    processor = DeepseekOCRProcessor()
+    page = random_page(1190, 1684)
+    features = processor.tokenize_with_images(images=[page], bos=True, eos=True, cropping=True)[0]
+    repeat = processor.tokenize_with_images(images=[page.copy()], bos=True, eos=True, cropping=True)[0]
+    other = processor.tokenize_with_images(images=[random_page(1190, 1684, seed=1)], bos=True, eos=True, cropping=True)[0]
+
+    shared = DictCache()
+    cache = PayloadKeyedCache(shared)
+    assert cache.get('model', 'image', features, {}) is None
+    cache.put('model', 'image', features, {}, 'processed')
+    # nothing is held on to once the miss has been stored
+    assert cache._missed == []
+
+    # a new processor (vLLM builds one per request) on the same cache
+    cache = PayloadKeyedCache(shared)
+    assert cache.get('model', 'image', repeat, {}) == 'processed'
+    assert cache.get('model', 'image', other, {}) is None
+    assert list(shared.items) == [('model', 'image', features_digest(features))]
+
+
+@pytest.mark.parametrize('cropping', [True, False])
+@pytest.mark.parametrize('prompt', PROMPTS)
+def test_cache_hit_prompt_matches_payload_input_ids(prompt, cropping):
+    # a hit tokenizes the request prompt (the tokenizer path of _call_hf_processor) and
+    # expands <image> with the payload's num_image_tokens; a miss uses the payload's input_ids
+    processor = DeepseekOCRProcessor()
+    image_token_id = processor.image_token_id
+    for width, height in SIZES:
+        features = processor.tokenize_with_images(images=[random_page(width, height)], bos=True, eos=True,
+                                                  cropping=cropping, prompt=prompt)[0]
+        prompt_ids = TOKENIZER(prompt, add_special_tokens=True).input_ids
+        expanded = []
+        for token_id in prompt_ids:
+            expanded += [image_token_id] * features[5][0] if token_id == image_token_id else [token_id]
+        assert expanded == features[0][0].tolist(), (width, height)
+
+
+def test_cached_and_uncached_processor_outputs_match():
+    pytest.importorskip('vllm')
+    from vllm.engine.arg_utils import EngineArgs
+    from vllm.multimodal import MULTIMODAL_REGISTRY
+
+    from engine import engine_args, register_model
+
+    register_model()
+    model_config = EngineArgs(**engine_args()).create_model_config()
+
+    for pixel_dtype in ('float32', 'bfloat16', 'uint8'):
+        processor = DeepseekOCRProcessor(pixel_dtype=pixel_dtype)
+        for cropping in (True, False):
+            for page_idx, (width, height) in enumerate(SIZES):
+                prompt = PROMPTS[page_idx % len(PROMPTS)]
+                page = random_page(width, height, seed=page_idx)
+                features = processor.tokenize_with_images(images=[page], bos=True, eos=True, cropping=cropping, prompt=prompt)
+                repeat = processor.tokenize_with_images(images=[page.copy()], bos=True, eos=True, cropping=cropping, prompt=prompt)
+
+                uncached_processor = MULTIMODAL_REGISTRY.create_processor(model_config, disable_cache=True)
+                expected = uncached_processor.apply(prompt, {"image": features}, {})
+                # a miss, then a hit on an equal payload
+                outputs = []
+                for payload in (features, repeat):
+                    cached_processor = MULTIMODAL_REGISTRY.create_processor(model_config, disable_cache=False)
+                    assert isinstance(cached_processor.cache, PayloadKeyedCache)
+                    outputs.append(cached_processor.apply(prompt, {"image": payload}, {}))
+
+                for output in outputs:
+                    assert output['prompt_token_ids'] == expected['prompt_token_ids']
+                    assert output['prompt_token_ids'] == features[0][0][0].tolist()
+                    assert output['mm_placeholders'] == expected['mm_placeholders']
+                    assert sorted(output['mm_kwargs']) == sorted(expected['mm_kwargs'])
+                    for name in expected['mm_kwargs']:
+                        assert same_nested(output['mm_kwargs'][name], expected['mm_kwargs'][name]), name
@@ -0,0 +1,55 @@
+import importlib
+import os
+
+import fitz
+import pytest
+
+import config
+import engine
+from process.checkpoint import PageJournal
+
+
+@pytest.fixture
+def runner(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, 'ENGINE', 'stub')
+    runner = importlib.import_module('run_dpsk_ocr_pdf')
+    monkeypatch.setattr(runner, 'llm', engine.StubEngine(tokens_per_sec=0))
+    monkeypatch.setattr(runner, 'prompt', config.PROMPT, raising=False)
+    monkeypatch.setattr(runner, 'OUTPUT_PATH', str(tmp_path / 'out'))
+    # window = 2 * MAX_CONCURRENCY
+    monkeypatch.setattr(runner, 'MAX_CONCURRENCY', 2)
+    monkeypatch.setattr(runner, 'CHECKPOINT', True)
+    monkeypatch.setattr(runner, 'RESUME', True)
+    monkeypatch.setattr(runner, 'SAVE_LAYOUT_PDF', False)
+    os.makedirs(runner.OUTPUT_PATH)
+    return runner
+
+
+def write_pdfs(directory, names):
+    paths = []
+    for name in names:
+        document = fitz.open()
+        document.new_page(width=300, height=400).insert_text((40, 60), name)
+        paths.append(str(directory / f'{name}.pdf'))
+        document.save(paths[-1])
+        document.close()
+    return paths
+
+
+def test_resume_continues_past_documents_complete_in_the_journal(runner, tmp_path):
+    pdf_paths = write_pdfs(tmp_path, [f'doc{idx}' for idx in range(7)])
+    # a previous run generated every page of the first six documents, then stopped
+    # before writing them; more of them than the window holds
+    journal = PageJournal(os.path.join(runner.OUTPUT_PATH, 'journal.jsonl'))
+    for pdf_path in pdf_paths[:6]:
+        journal.record(pdf_path, 0, f'journaled {os.path.basename(pdf_path)}<｜end▁of▁sentence｜>')
+    journal.close()
+
+    runner.run_documents(pdf_paths)
+
+    assert runner.llm.num_added == 1
+    for idx, pdf_path in enumerate(pdf_paths):
+        with open(os.path.join(runner.OUTPUT_PATH, f'doc{idx}', f'doc{idx}.mmd'), encoding='utf-8') as afile:
+            content = afile.read()
+        assert (f'journaled doc{idx}.pdf' in content) == (idx < 6)
+    assert PageJournal(os.path.join(runner.OUTPUT_PATH, 'journal.jsonl')).finalized == set(pdf_paths)
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+from engine import StubAsyncEngine, StubSamplingParams
+from scheduler import DeadlineExceeded, PriorityScheduler, percentiles
+
+
+class RecordingEngine(StubAsyncEngine):
+    """StubAsyncEngine that records the order requests reach the engine in"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.admitted = []
+
+    async def generate(self, request, sampling_params, request_id):
+        self.admitted.append(request_id)
+        async for output in super().generate(request, sampling_params, request_id):
+            yield output
+
+
+class BlockingEngine:
+    """holds every request in the engine until release is set"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.admitted = []
+
+    async def generate(self, request, sampling_params, request_id):
+        self.admitted.append(request_id)
+        await self.release.wait()
+        yield SimpleNamespace(outputs=[], finished=True)
+
+
+async def drain(scheduler, request_id, **schedule):
+    async for _ in scheduler.generate({}, StubSamplingParams(), request_id, **schedule):
+        pass
+
+
+def test_interactive_latency_under_saturating_bulk_load():
+    # bulk backfills from two tenants flood the queue while interactive pages trickle in
+    async def load_test(num_bulk=300, num_interactive=30, interactive_interval=0.02):
+        scheduler = PriorityScheduler(StubAsyncEngine(tokens_per_sec=50000), max_running=16, reserved_slots=2)
+        interactive = []
+
+        async def interactive_arrivals():
+            for idx in range(num_interactive):
+                await asyncio.sleep(interactive_interval)
+                interactive.append(asyncio.create_task(
+                    drain(scheduler, f'interactive-{idx}', priority='interactive', tenant=f'user-{idx % 4}')))
+
+        bulk = [drain(scheduler, f'bulk-{idx}', priority='bulk', tenant='tenant-a' if idx % 10 else 'tenant-b')
+                for idx in range(num_bulk)]
+        await asyncio.gather(interactive_arrivals(), *bulk)
+        await asyncio.gather(*interactive)
+        return scheduler
+
+    scheduler = asyncio.run(load_test())
+    interactive, bulk = scheduler.stats['interactive'], scheduler.stats['bulk']
+    assert interactive.completed == 30 and bulk.completed == 300
+    assert scheduler.running == 0 and not scheduler.heap
+    # the bulk queue is still deep when the last interactive page arrives
+    assert percentiles(bulk.queue_wait)['p95'] > 30 * 0.02
+    assert percentiles(interactive.latency)['p95'] < percentiles(bulk.latency)['p95']
+    assert percentiles(interactive.queue_wait)['p95'] < percentiles(bulk.queue_wait)['p50']
+
+
+@pytest.mark.parametrize('weights', [{'tenant-a': 3.0}, {'tenant-a': 1.0, 'tenant-b': 4.0}])
+def test_tenants_in_one_class_are_served_by_weight(weights):
+    async def run():
+        engine = RecordingEngine(tokens_per_sec=0)
+        scheduler = PriorityScheduler(engine, max_running=1, reserved_slots=0, tenant_weights=weights)
+        # tenant-b queues first and queues as much, neither may starve the other
+        await asyncio.gather(*(drain(scheduler, f'{tenant}-{idx}', priority='bulk', tenant=tenant)
+                               for tenant in ('tenant-b', 'tenant-a') for idx in range(200)))
+        return engine.admitted
+
+    admitted = asyncio.run(run())
+    served = Counter(request_id.rsplit('-', 1)[0] for request_id in admitted[:100])
+    share_a = weights.get('tenant-a', 1.0) / (weights.get('tenant-a', 1.0) + weights.get('tenant-b', 1.0))
+    assert abs(served['tenant-a'] - 100 * share_a) <= 2, served
+
+
+def test_expired_deadline_raises_without_taking_a_slot():
+    async def run():
+        engine = BlockingEngine()
+        scheduler = PriorityScheduler(engine, max_running=2, reserved_slots=0)
+
+        # a slot is free, but the deadline has already passed
+        with pytest.raises(DeadlineExceeded):
+            await drain(scheduler, 'late', priority='interactive', deadline=time.monotonic() - 1)
+        assert scheduler.running == 0 and not scheduler.heap
+        assert engine.admitted == []
+
+        # both slots busy: the request expires in the queue
+        running = [asyncio.create_task(drain(scheduler, f'bulk-{idx}', priority='bulk')) for idx in range(2)]
+        await asyncio.sleep(0)
+        assert scheduler.running == 2
+        with pytest.raises(DeadlineExceeded):
+            await drain(scheduler, 'queued', priority='interactive', deadline=time.monotonic() + 0.05)
+        assert scheduler.running == 2
+        assert scheduler.stats['interactive'].waiting == 0
+
+        # the expired ticket is skipped when a slot frees up, the next request gets it
+        waiting = asyncio.create_task(drain(scheduler, 'next', priority='bulk'))
+        engine.release.set()
+        await asyncio.gather(*running, waiting)
+        assert engine.admitted == ['bulk-0', 'bulk-1', 'next']
+        assert scheduler.running == 0 and not scheduler.heap
+        return scheduler.stats['interactive']
+
+    interactive = asyncio.run(run())
+    assert interactive.expired == 2
+    assert interactive.completed == 0
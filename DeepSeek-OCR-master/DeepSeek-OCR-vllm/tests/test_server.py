@@ -0,0 +1,110 @@
+import io
+import json
+
+import fitz
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image, ImageDraw
+
+from engine import STUB_PAGE, StubAsyncEngine, StubSamplingParams
+from run_dpsk_ocr_server import create_app
+
+
+def image_bytes():
+    page = Image.new('RGB', (800, 1000), 'white')
+    ImageDraw.Draw(page).rectangle((80, 80, 600, 140), fill='black')
+    data = io.BytesIO()
+    page.save(data, format='PNG')
+    return data.getvalue()
+
+
+def pdf_bytes(num_pages):
+    document = fitz.open()
+    for page_idx in range(num_pages):
+        document.new_page(width=300, height=400).insert_text((40, 60), f'page {page_idx}')
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def parse_sse(text):
+    events = []
+    for block in text.strip().split('\n\n'):
+        event, data = block.split('\n')
+        events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+    return events
+
+
+def make_client(engine, **scheduler_options):
+    return TestClient(create_app(engine, sampling_params=StubSamplingParams(), num_workers=2, **scheduler_options))
+
+
+@pytest.mark.parametrize('name, num_pages', [('page.png', 1), ('document.pdf', 3)])
+def test_stream_sends_deltas_pages_and_done(name, num_pages):
+    data = pdf_bytes(num_pages) if name.endswith('.pdf') else image_bytes()
+    with make_client(StubAsyncEngine(tokens_per_sec=0)) as client:
+        response = client.post('/ocr', files={'file': (name, data)}, data={'stream': 'true'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+
+    events = parse_sse(response.text)
+    assert events[-1] == ('done', {'pages': num_pages})
+    pages = {payload['page']: payload['text'] for event, payload in events if event == 'page'}
+    assert sorted(pages) == list(range(num_pages))
+    for page_idx, text in pages.items():
+        deltas = [payload['text'] for event, payload in events if event == 'delta' and payload['page'] == page_idx]
+        assert len(deltas) > 1
+        assert ''.join(deltas) == text == STUB_PAGE
+    assert not [event for event, _ in events if event == 'error']
+
+
+def test_non_stream_returns_every_page():
+    with make_client(StubAsyncEngine(tokens_per_sec=0)) as client:
+        response = client.post('/ocr', files={'file': ('document.pdf', pdf_bytes(2))}, data={'stream': 'false'})
+    assert response.status_code == 200
+    assert response.json() == {'pages': [STUB_PAGE, STUB_PAGE]}
+
+
+def test_missed_deadline_is_504_and_stops_sibling_pages():
+    # one engine slot: the first page runs for seconds, the others expire in the queue
+    engine = StubAsyncEngine(tokens_per_sec=50)
+    with make_client(engine, max_running=1, reserved_slots=0) as client:
+        response = client.post('/ocr', files={'file': ('document.pdf', pdf_bytes(3))},
+                               data={'stream': 'false', 'deadline_ms': '1000'})
+        assert response.status_code == 504
+        assert 'deadline' in response.json()['error']
+        # the page that was generating is cancelled before the error is sent
+        assert engine.num_running == 0
+
+        metrics = client.get('/metrics').json()
+        assert metrics['failed'] == 1
+        assert metrics['queue_depth'] == 0
+        assert metrics['scheduler']['running'] == 0
+        assert metrics['scheduler']['classes']['interactive']['expired'] == 2
+
+        response = client.post('/ocr', files={'file': ('document.pdf', pdf_bytes(2))},
+                               data={'stream': 'true', 'deadline_ms': '1000'})
+        events = parse_sse(response.text)
+        assert ('error', {'error': events[-2][1]['error'], 'status': 504}) == events[-2]
+        assert events[-1][0] == 'done'
+
+
+def test_metrics():
+    with make_client(StubAsyncEngine(tokens_per_sec=0)) as client:
+        client.post('/ocr', files={'file': ('page.png', image_bytes())}, data={'stream': 'false'})
+        client.post('/ocr', files={'file': ('page.png', image_bytes())}, data={'stream': 'false', 'priority': 'bulk'})
+        assert client.post('/ocr', files={'file': ('page.png', image_bytes())}, data={'priority': 'urgent'}).status_code == 400
+
+        metrics = client.get('/metrics').json()
+        assert metrics['completed'] == 2
+        assert metrics['failed'] == 0
+        assert metrics['queue_depth'] == 0
+        assert set(metrics['latency_s']) == {'p50', 'p95', 'p99'}
+        for priority in ('interactive', 'bulk'):
+            assert metrics['scheduler']['classes'][priority]['completed'] == 1
+        assert 'ocr_service_completed' in metrics['registry']
+
+        prometheus = client.get('/metrics', params={'format': 'prometheus'})
+        assert prometheus.headers['content-type'].startswith('text/plain')
+        assert 'ocr_service_completed 2' in prometheus.text
+        assert 'ocr_pages_total{status="ok"}' in prometheus.text
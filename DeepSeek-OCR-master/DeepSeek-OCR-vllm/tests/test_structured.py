@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from process.structured import StructuredWriter, read_structured
+
+
+def write_records(path, pages, **kwargs):
+    writer = StructuredWriter(path, **kwargs)
+    for page in pages:
+        writer.write({'page': page, 'text': 'x' * 200})
+        writer.sync()
+    return writer
+
+
+@pytest.mark.parametrize('name', ['results.jsonl', 'results.jsonl.gz'])
+def test_interrupted_run_is_read_up_to_the_last_complete_record(tmp_path, name):
+    path = str(tmp_path / name)
+    writer = write_records(path, range(5), in_place=True)
+    synced_size = os.path.getsize(path)
+    writer.write({'page': 5, 'text': 'y' * 5000})
+    writer.file.flush()
+    # crash: the writer is never closed, the last record is cut off
+    with open(path, 'rb+') as afile:
+        afile.truncate(synced_size + (os.path.getsize(path) - synced_size) // 2)
+
+    assert [record['page'] for record in read_structured(path)] == list(range(5))
+
+
+@pytest.mark.parametrize('name', ['results.jsonl', 'results.jsonl.gz'])
+def test_resumed_run_appends_after_a_torn_end(tmp_path, name):
+    path = str(tmp_path / name)
+    writer = write_records(path, range(3), in_place=True)
+    writer.write({'page': 3, 'text': 'y' * 5000})
+    writer.file.flush()
+    with open(path, 'rb+') as afile:
+        afile.truncate(os.path.getsize(path) - 7)
+
+    with StructuredWriter(path, append=True) as writer:
+        for page in (3, 4):
+            writer.write({'page': page})
+    assert [record['page'] for record in read_structured(path)] == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('name', ['results.jsonl', 'results.jsonl.gz'])
+def test_fresh_in_place_run_replaces_old_records(tmp_path, name):
+    path = str(tmp_path / name)
+    write_records(path, range(3), in_place=True).close()
+    write_records(path, [7], in_place=True).close()
+    assert [record['page'] for record in read_structured(path)] == [7]
+
+
+def test_default_writer_renames_on_close(tmp_path):
+    path = str(tmp_path / 'pages.jsonl')
+    writer = write_records(path, range(2))
+    assert not os.path.exists(path)
+    writer.close()
+    assert [record['page'] for record in read_structured(path)] == [0, 1]